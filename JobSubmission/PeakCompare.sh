@@ -67,9 +67,64 @@ print_config_file() {
 
 subset_file() {
   file=$1
+  # Block gzipped files are queried by region through their block index, so
+  # there is nothing to gain from filtering them first
+  if [[ "${file}" == *.gz ]]; then
+    ln -sf "$(realpath "${file}")" "${TEMP_DIRECTORY}/$(basename "${file}")"
+    return
+  fi
   grep "${CHROMOSOME}" "${file}" > "${TEMP_DIRECTORY}/$(basename "${file}")"
 }
 
+compare_regions() {
+  # Each task of an array job runs one shard of the regions. The regions can be
+  # on any chromosome, so the files are used as they are rather than subset.
+  # Shards are numbered from 0 whatever the array's range starts at (so that
+  # --array=1-4 works too).
+  local shard_index
+  shard_index=$(( ${SLURM_ARRAY_TASK_ID:-0} - ${SLURM_ARRAY_TASK_MIN:-0} ))
+  local shard_count
+  shard_count="${SLURM_ARRAY_TASK_COUNT:-1}"
+  mkdir -p "${RESULTS_DIRECTORY}"
+  local command
+  command="run"
+  regions_options=()
+  if [[ "${UNMERGED}" -eq 1 ]]; then
+    regions_options+=(--unmerged)
+  fi
+  if [[ -n "${SCREEN_BIN_SIZE}" ]]; then
+    command="screen"
+    regions_options+=(--bin_size "${SCREEN_BIN_SIZE}")
+    if [[ -n "${SCREEN_THRESHOLD}" ]]; then
+      regions_options+=(--threshold "${SCREEN_THRESHOLD}")
+    fi
+  else
+    if [[ -n "${RESULTS_STORE}" ]]; then
+      regions_options+=(--store "${RESULTS_STORE}")
+    fi
+    if [[ "${PLAN}" -eq 1 ]]; then
+      regions_options+=(--plan)
+    fi
+  fi
+  python3 \
+    "${PYTHON_SCRIPTS}/batch_compare.py" \
+    "${command}" \
+    --shard "${shard_index}/${shard_count}" \
+    --output "${RESULTS_DIRECTORY}/shard_${shard_index}.tsv" \
+    "${regions_options[@]}" \
+    --significance "${SIGNIFICANCE}" \
+    --window_size "${WINDOW_SIZE}" \
+    "${REGIONS_FILE}" \
+    "${REFERENCE_MERGED_PEAK_FILE}" \
+    "${REFERENCE_UNMERGED_PEAK_FILE}" \
+    "${REFERENCE_BIAS_TRACK_FILE}" \
+    "${REFERENCE_COVERAGE_TRACK_FILE}" \
+    "${COMPARISON_BIAS_TRACK_FILE}" \
+    "${COMPARISON_COVERAGE_TRACK_FILE}" \
+    "${COMPARISON_PVALUE_FILE}" \
+    "${CUTOFF}"
+}
+
 main() {
     config_file=$1
     if [[ -f "${CONDA_EXE%/bin/conda}/etc/profile.d/conda.sh" ]]; then
@@ -91,6 +146,11 @@ main() {
     fi
     mkdir -p "${TEMP_DIRECTORY}"
 
+    if [[ -n "${REGIONS_FILE}" ]]; then
+      compare_regions
+      exit $?
+    fi
+
     subset_file "${REFERENCE_MERGED_PEAK_FILE}"
     subset_file "${REFERENCE_UNMERGED_PEAK_FILE}"
     subset_file "${REFERENCE_BIAS_TRACK_FILE}"
@@ -99,10 +159,34 @@ main() {
     subset_file "${COMPARISON_COVERAGE_TRACK_FILE}"
     subset_file "${COMPARISON_PVALUE_FILE}"
 
+    extra_options=()
+    if [[ -n "${CACHE_DIRECTORY}" ]]; then
+      extra_options+=(--cache_directory "${CACHE_DIRECTORY}")
+      if [[ -n "${CACHE_SIZE}" ]]; then
+        extra_options+=(--cache_size "${CACHE_SIZE}")
+      fi
+    fi
+    if [[ -n "${TRACK_DIRECTORY}" ]]; then
+      extra_options+=(--output_directory "${TRACK_DIRECTORY}")
+    fi
+    if [[ -n "${CHUNK_SIZE}" ]]; then
+      extra_options+=(--chunk_size "${CHUNK_SIZE}")
+    fi
+    if [[ "${SPARSE}" -eq 1 ]]; then
+      extra_options+=(--sparse)
+    fi
+    if [[ -n "${RESULTS_STORE}" ]]; then
+      extra_options+=(--store "${RESULTS_STORE}")
+    fi
+    if [[ "${PLAN}" -eq 1 ]]; then
+      extra_options+=(--plan)
+    fi
+
     if [[ "${UNMERGED}" -eq 1 ]]; then
       python3 \
         "${PYTHON_SCRIPTS}/peak_compare.py" \
         --unmerged \
+        "${extra_options[@]}" \
         --significance "${SIGNIFICANCE}" \
         --window_size "${WINDOW_SIZE}" \
         "${CHROMOSOME}" \
@@ -119,6 +203,7 @@ main() {
     else
       python3 \
         "${PYTHON_SCRIPTS}/peak_compare.py" \
+        "${extra_options[@]}" \
         --significance "${SIGNIFICANCE}" \
         --window_size "${WINDOW_SIZE}" \
         "${CHROMOSOME}" \
@@ -134,9 +219,9 @@ main() {
         "${CUTOFF}"
     fi
 
-    rm "${TEMP_DIRECTORY}/${REFERENCE_SAMPLE_NAME}"*.bdg \
-      "${TEMP_DIRECTORY}/${COMPARISON_SAMPLE_NAME}"*.bdg \
-      "${TEMP_DIRECTORY}/${REFERENCE_SAMPLE_NAME}"*.bed
+    rm -f "${TEMP_DIRECTORY}/${REFERENCE_SAMPLE_NAME}"*.bdg* \
+      "${TEMP_DIRECTORY}/${COMPARISON_SAMPLE_NAME}"*.bdg* \
+      "${TEMP_DIRECTORY}/${REFERENCE_SAMPLE_NAME}"*.bed*
 }
 
 if [[ $# -ne 1 ]]; then usage; fi
@@ -1,5 +1,65 @@
+import gzip
+import importlib.util
+import io
+import mmap
+import multiprocessing
+import os
+import numpy as np
 import pandas as pd
-from typing import Optional, Union
+from bgzf import fetch_region, is_bgzf, is_gzipped
+from typing import (BinaryIO, Callable, Dict, Iterator, List, NamedTuple,
+                    Optional, Sequence, Tuple, Union)
+
+# A source is either a path on disk or an already opened binary buffer.
+Source = Union[str, BinaryIO]
+
+BEDGRAPH_DTYPES = {
+    "CHR": "object",
+    "START": "int64",
+    "END": "int64",
+    "SCORE": "float64"
+}
+BEDBASE_CI_DTYPES = {
+    "CHR": "object",
+    "BASE": "int64",
+    "LOWER_SCORE": "float64",
+    "UPPER_SCORE": "float64"
+}
+BEDBASE_DTYPES = {
+    "CHR": "object",
+    "BASE": "int64",
+    "SCORE": "float64"
+}
+BED_DTYPES = {
+    "CHR": "object",
+    "START": "int64",
+    "END": "int64"
+}
+BEDGRAPH_SUMMARY_DTYPES = {
+    "CHR": "object",
+    "START": "int64",
+    "END": "int64",
+    "MIN": "float64",
+    "MAX": "float64",
+    "MEAN": "float64",
+    "SUM": "float64"
+}
+
+PARSERS = ("auto", "pyarrow", "numpy", "parallel", "pandas")
+
+# The numpy tokenizer works through memory mapped files in blocks of roughly
+# this many bytes so that its scratch arrays stay small.
+NUMPY_PARSER_BLOCK_SIZE = 1 << 26
+# The parallel parser gives each process about this many blocks, so that
+# processes finishing early can pick up the remaining blocks.
+BLOCKS_PER_WORKER = 4
+# Without pyarrow, the auto parser reads plain bedgraph files at least this
+# large with the parallel parser.
+PARALLEL_PARSER_MINIMUM_SIZE = 1 << 28
+# Streaming readers hold this many lines of each file at a time. pyarrow
+# reads blocks of bytes instead, sized assuming lines of about this length.
+DEFAULT_CHUNK_SIZE = 1 << 20
+APPROXIMATE_LINE_LENGTH = 32
 
 
 class IncompatabilityError(Exception):
@@ -7,6 +67,734 @@ class IncompatabilityError(Exception):
     pass
 
 
+class UnsortedError(ValueError):
+    """Exception for when a file isn't sorted by chromosome and position"""
+    pass
+
+
+class _ChromosomeRuns(NamedTuple):
+    """
+    Represents the chromosome column of a block of lines as runs of lines
+    with the same chromosome.
+    """
+    names: np.ndarray
+    lengths: np.ndarray
+
+
+class Region(NamedTuple):
+    """
+    Represents a region of the genome.
+    """
+    chromosome: str
+    start: int
+    end: int
+
+
+def _enforce_dtypes(df: pd.DataFrame, dtypes: Dict[str, str]) -> pd.DataFrame:
+    """Casts the columns of a DataFrame that do not already have the expected
+    dtype. Columns that are already correctly typed are left untouched so that
+    data coming straight from a parser is not copied again.
+    """
+    mismatched_dtypes = {
+        column: dtype for column, dtype in dtypes.items()
+        if df[column].dtype != dtype
+    }
+    if not mismatched_dtypes:
+        return df
+    return df.astype(mismatched_dtypes)
+
+
+def _peek_lines(source: Source, number_of_lines: int) -> list:
+    """Reads the first few lines of a source without consuming them."""
+    if isinstance(source, str):
+        opener = gzip.open if is_gzipped(source) else open
+        with opener(source, 'rb') as file:
+            return [file.readline() for _ in range(number_of_lines)]
+    position = source.tell()
+    lines = [source.readline() for _ in range(number_of_lines)]
+    source.seek(position)
+    return lines
+
+
+def inspect_table(source: Source) -> Tuple[int, int]:
+    """Determines the layout of a tab separated genomic file.
+
+    Args:
+        source (Source): Path to (or binary buffer of) the file.
+
+    Returns:
+        Tuple[int, int]: The number of meta data lines to skip and the number
+        of columns in the first data line.
+    """
+    first_line, second_line = _peek_lines(source, 2)
+    # Some bedgraph files start with a meta data line
+    if first_line.startswith(b"track"):
+        return 1, len(second_line.rstrip(b"\r\n").split(b"\t"))
+    if first_line == b"":
+        return 0, 0
+    return 0, len(first_line.rstrip(b"\r\n").split(b"\t"))
+
+
+def is_pyarrow_available() -> bool:
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def _read_columns_pandas(source: Source,
+                         dtypes: Dict[str, str],
+                         skip_rows: int,
+                         column_indices: Sequence[int]
+                         ) -> Dict[str, np.ndarray]:
+    table = pd.read_csv(
+        source,
+        sep="\t",
+        header=None,
+        skiprows=skip_rows,
+        usecols=column_indices,
+        names=list(dtypes),
+        dtype=dtypes,
+        engine="c",
+        compression=(
+            "gzip" if isinstance(source, str) and is_gzipped(source)
+            else None
+        )
+    )
+    return {column: table[column].to_numpy() for column in dtypes}
+
+
+def _read_columns_pyarrow(source: Source,
+                          dtypes: Dict[str, str],
+                          skip_rows: int,
+                          column_indices: Sequence[int]
+                          ) -> Dict[str, np.ndarray]:
+    import pyarrow as pa
+    from pyarrow import csv
+
+    arrow_types = {
+        "object": pa.string(),
+        "int64": pa.int64(),
+        "float64": pa.float64()
+    }
+    if isinstance(source, str) and is_gzipped(source):
+        source = pa.input_stream(source, compression="gzip")
+    # pyarrow names columns f0, f1, ... when asked to generate names
+    generated_names = [f"f{i}" for i in column_indices]
+    table = csv.read_csv(
+        source,
+        read_options=csv.ReadOptions(
+            skip_rows=skip_rows,
+            autogenerate_column_names=True,
+            use_threads=True
+        ),
+        parse_options=csv.ParseOptions(delimiter="\t", quote_char=False),
+        convert_options=csv.ConvertOptions(
+            include_columns=generated_names,
+            column_types={
+                name: arrow_types[dtype]
+                for name, dtype in zip(generated_names, dtypes.values())
+            }
+        )
+    )
+    columns = {}
+    for name, (column, dtype) in zip(generated_names, dtypes.items()):
+        columns[column] = table.column(name).to_numpy().astype(
+            dtype, copy=False)
+    return columns
+
+
+def _parse_integer_field(buffer: np.ndarray,
+                         field_starts: np.ndarray,
+                         field_ends: np.ndarray) -> np.ndarray:
+    """Parses one column of unsigned integers from a tokenized block one
+    digit position at a time, which is much cheaper than casting bytes.
+    """
+    lengths = field_ends - field_starts
+    values = np.zeros(len(field_starts), dtype=np.int64)
+    for offset in range(int(lengths.max(initial=0))):
+        has_digit = offset < lengths
+        digits = buffer[np.where(has_digit, field_starts + offset, 0)]
+        digits = digits.astype(np.int64) - ord("0")
+        if np.any(has_digit & ((digits < 0) | (digits > 9))):
+            raise ValueError("Bedgraph block has non integer positions.")
+        values = np.where(has_digit, values * 10 + digits, values)
+    return values
+
+
+def _tokenize_field(buffer: np.ndarray,
+                    field_starts: np.ndarray,
+                    field_ends: np.ndarray) -> np.ndarray:
+    """Gathers one column of a tokenized block into a fixed width bytes
+    array, which numpy can then cast to the numeric type in a single call.
+    """
+    lengths = field_ends - field_starts
+    width = max(int(lengths.max(initial=0)), 1)
+    offsets = np.arange(width)
+    positions = np.minimum(field_starts[:, None] + offsets, len(buffer) - 1)
+    characters = np.where(
+        offsets < lengths[:, None],
+        buffer[positions],
+        np.uint8(0)
+    ).astype(np.uint8)
+    return np.ascontiguousarray(characters).view(f"S{width}")[:, 0]
+
+
+def _tokenize_bedgraph(buffer: np.ndarray) -> Dict[str, np.ndarray]:
+    """Splits a block of complete bedgraph lines into typed columns."""
+    chromosome_runs, columns = _tokenize_bedgraph_runs(buffer)
+    columns["CHR"] = np.repeat(
+        chromosome_runs.names, chromosome_runs.lengths)
+    return columns
+
+
+def _tokenize_bedgraph_runs(buffer: np.ndarray
+                            ) -> Tuple[_ChromosomeRuns,
+                                       Dict[str, np.ndarray]]:
+    """Splits a block of complete bedgraph lines into its chromosome runs
+    and typed position and score columns.
+    """
+    is_newline = buffer == ord("\n")
+    separators = np.flatnonzero(is_newline | (buffer == ord("\t")))
+    separator_is_newline = is_newline[separators]
+    if len(buffer) > 0 and not is_newline[-1]:
+        # Final line is missing its end of line character
+        separators = np.append(separators, len(buffer))
+        separator_is_newline = np.append(separator_is_newline, True)
+    number_of_lines = np.count_nonzero(separator_is_newline)
+    expected_pattern = np.tile([False, False, False, True], number_of_lines)
+    if not np.array_equal(separator_is_newline, expected_pattern):
+        raise ValueError("Bedgraph block does not have exactly 4 columns.")
+
+    separators = separators.reshape(number_of_lines, 4)
+    field_ends = separators.T
+    field_starts = np.empty_like(field_ends)
+    field_starts[0, 0] = 0
+    field_starts[0, 1:] = separators[:-1, 3] + 1
+    field_starts[1:] = field_ends[:-1] + 1
+
+    # Chromosomes come in long runs, so only the first line of each run
+    # needs to be decoded into a python string.
+    chromosomes = _tokenize_field(buffer, field_starts[0], field_ends[0])
+    run_starts = np.flatnonzero(
+        np.concatenate(([True], chromosomes[1:] != chromosomes[:-1])))
+    run_lengths = np.diff(np.append(run_starts, number_of_lines))
+    decoded_chromosomes = np.array(
+        [chromosome.decode() for chromosome in chromosomes[run_starts]],
+        dtype=object
+    )
+    return _ChromosomeRuns(decoded_chromosomes, run_lengths), {
+        "START": _parse_integer_field(buffer, field_starts[1], field_ends[1]),
+        "END": _parse_integer_field(buffer, field_starts[2], field_ends[2]),
+        "SCORE": _tokenize_field(
+            buffer, field_starts[3], field_ends[3]).astype(np.float64)
+    }
+
+
+def _next_line_start(buffer: np.ndarray, position: int) -> int:
+    """The position just after the first newline at or after position (or
+    the end of the buffer), looking through growing windows rather than the
+    rest of the buffer.
+    """
+    window = 1 << 16
+    while position < len(buffer):
+        newlines = np.flatnonzero(
+            buffer[position:position + window] == ord("\n"))
+        if len(newlines) > 0:
+            return position + int(newlines[0]) + 1
+        position += window
+        window *= 2
+    return len(buffer)
+
+
+def _block_bounds(buffer: np.ndarray,
+                  position: int,
+                  block_size: int) -> List[int]:
+    """Splits a buffer (from position) into blocks of about block_size
+    bytes. Blocks always finish on the end of a line so that no line is
+    split.
+    """
+    block_bounds = [position]
+    while block_bounds[-1] < len(buffer):
+        block_bounds.append(_next_line_start(
+            buffer, block_bounds[-1] + block_size - 1))
+    return block_bounds
+
+
+def _shared_array(length: int, dtype: str) -> np.ndarray:
+    """An array in anonymous shared memory, which processes forked after it
+    is made can write to.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    return np.frombuffer(
+        mmap.mmap(-1, max(length * itemsize, 1)), dtype=dtype, count=length)
+
+
+# The file being parsed by the parallel parser and the arrays its blocks are
+# written into. These are set before the worker processes are forked, so
+# that they share them rather than being sent copies.
+_parallel_buffer: Optional[np.ndarray] = None
+_parallel_columns: Dict[str, np.ndarray] = {}
+
+
+def _parse_block_into_columns(block_start: int,
+                              block_end: int,
+                              row: int) -> _ChromosomeRuns:
+    """Parses one block of the file being read by the parallel parser,
+    writing its positions and scores straight into the shared arrays.
+    """
+    chromosome_runs, block_columns = _tokenize_bedgraph_runs(
+        _parallel_buffer[block_start:block_end])
+    for column, values in block_columns.items():
+        _parallel_columns[column][row:row + len(values)] = values
+    return chromosome_runs
+
+
+def _read_bedgraph_numpy(source: Source,
+                         skip_rows: int,
+                         workers: int = 1) -> Dict[str, np.ndarray]:
+    """Reads a bedgraph file with the numpy tokenizer. With more than one
+    worker, an uncompressed file on disk is split into blocks that are parsed
+    by that many processes at once.
+    """
+    if isinstance(source, str) and is_gzipped(source):
+        # Compressed files can't be memory mapped, so are decompressed whole
+        with gzip.open(source, 'rb') as file:
+            buffer = np.frombuffer(file.read(), dtype=np.uint8)
+        workers = 1
+    elif isinstance(source, str):
+        # Plain ndarray view of the mapping avoids memmap's slicing overhead
+        buffer = np.asarray(np.memmap(source, dtype=np.uint8, mode="r"))
+    else:
+        buffer = np.frombuffer(source.read(), dtype=np.uint8)
+        workers = 1
+    position = 0
+    for _ in range(skip_rows):
+        position = _next_line_start(buffer, position)
+
+    block_size = NUMPY_PARSER_BLOCK_SIZE
+    if workers > 1:
+        block_size = min(block_size, max(
+            -(-(len(buffer) - position) // (workers * BLOCKS_PER_WORKER)),
+            1
+        ))
+    block_bounds = _block_bounds(buffer, position, block_size)
+
+    # Counting lines first lets every block be written into preallocated
+    # output arrays instead of concatenating the blocks afterwards.
+    line_counts = []
+    for block_start, block_end in zip(block_bounds[:-1], block_bounds[1:]):
+        block = buffer[block_start:block_end]
+        line_count = np.count_nonzero(block == ord("\n"))
+        if block_end == len(buffer) and len(block) > 0 and \
+                block[-1] != ord("\n"):
+            line_count += 1
+        line_counts.append(line_count)
+    rows = np.concatenate(([0], np.cumsum(line_counts))).astype(int)
+    workers = min(workers, len(line_counts))
+
+    if workers <= 1:
+        columns = {
+            column: np.empty(rows[-1], dtype=dtype)
+            for column, dtype in BEDGRAPH_DTYPES.items()
+        }
+        for block_start, block_end, row in zip(
+                block_bounds[:-1], block_bounds[1:], rows):
+            block_columns = _tokenize_bedgraph(buffer[block_start:block_end])
+            for column in columns:
+                columns[column][row:row + len(block_columns[column])] = \
+                    block_columns[column]
+        return columns
+
+    global _parallel_buffer, _parallel_columns
+    _parallel_buffer = buffer
+    _parallel_columns = {
+        column: _shared_array(rows[-1], dtype)
+        for column, dtype in BEDGRAPH_DTYPES.items()
+        if column != "CHR"
+    }
+    try:
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            chromosome_runs = pool.starmap(
+                _parse_block_into_columns,
+                zip(block_bounds[:-1], block_bounds[1:], rows[:-1].tolist()),
+                chunksize=1
+            )
+        columns = dict(_parallel_columns)
+    finally:
+        _parallel_buffer = None
+        _parallel_columns = {}
+    columns["CHR"] = np.repeat(
+        np.concatenate([runs.names for runs in chromosome_runs]),
+        np.concatenate([runs.lengths for runs in chromosome_runs])
+    )
+    return {column: columns[column] for column in BEDGRAPH_DTYPES}
+
+
+def read_columns(source: Source,
+                 dtypes: Dict[str, str],
+                 skip_rows: int = 0,
+                 parser: str = "auto",
+                 column_indices: Optional[Sequence[int]] = None,
+                 workers: int = 1
+                 ) -> Dict[str, np.ndarray]:
+    """Reads the leading (or chosen) columns of a tab separated file into
+    typed arrays.
+
+    Args:
+        source (Source): Path to (or binary buffer of) the file.
+        dtypes (Dict[str, str]): Names and dtypes of the columns to read, any
+            remaining columns are ignored.
+        skip_rows (int): The number of meta data lines at the top of the file.
+        parser (str): Which backend to use. One of "pyarrow" (multithreaded,
+            requires pyarrow to be installed), "numpy" (memory mapped
+            tokenizer, only for 4 column bedgraphs), "parallel" (the numpy
+            tokenizer run over blocks of the file by several processes),
+            "pandas" or "auto". "auto" uses pyarrow when it is installed.
+            Otherwise it uses the parallel parser for large, uncompressed
+            bedgraph files (if there is more than one worker) and pandas for
+            everything else.
+        column_indices (Optional[Sequence[int]]): Zero based, increasing
+            positions of the columns in dtypes. Defaults to the leading
+            columns.
+        workers (int): The number of processes the parallel parser can use,
+            such as execution_planner.core_budget().
+
+    Returns:
+        Dict[str, np.ndarray]: One array per requested column, each having the
+        requested dtype.
+    """
+    if parser not in PARSERS:
+        raise ValueError(f"Unknown parser {parser}, expected one of "
+                         f"{', '.join(PARSERS)}.")
+    if column_indices is None:
+        column_indices = range(len(dtypes))
+    if len(column_indices) != len(dtypes):
+        raise ValueError("One column index is needed for every dtype.")
+    is_bedgraph = dtypes == BEDGRAPH_DTYPES and \
+        list(column_indices) == list(range(len(dtypes)))
+
+    if parser == "auto":
+        if is_pyarrow_available():
+            parser = "pyarrow"
+        elif is_bedgraph and isinstance(source, str) and \
+                os.path.getsize(source) >= PARALLEL_PARSER_MINIMUM_SIZE and \
+                not is_gzipped(source) and workers > 1:
+            try:
+                return _read_bedgraph_numpy(source, skip_rows, workers)
+            except ValueError:
+                # The numpy tokenizer is stricter than pandas (such as about
+                # extra columns), so leave those files to pandas
+                pass
+            parser = "pandas"
+        else:
+            parser = "pandas"
+
+    if parser == "pyarrow":
+        return _read_columns_pyarrow(
+            source, dtypes, skip_rows, column_indices)
+    if parser in ("numpy", "parallel"):
+        if not is_bedgraph:
+            raise ValueError(f"The {parser} parser can only read bedgraph "
+                             "files.")
+        return _read_bedgraph_numpy(
+            source,
+            skip_rows,
+            workers=workers if parser == "parallel" else 1
+        )
+    return _read_columns_pandas(source, dtypes, skip_rows, column_indices)
+
+
+def read_column_chunks(source: Source,
+                       dtypes: Dict[str, str],
+                       skip_rows: int = 0,
+                       chunk_size: int = DEFAULT_CHUNK_SIZE,
+                       parser: str = "auto",
+                       column_indices: Optional[Sequence[int]] = None
+                       ) -> Iterator[Dict[str, np.ndarray]]:
+    """Reads the leading (or chosen) columns of a tab separated file a chunk
+    of lines at a time, so that only one chunk is held in memory.
+
+    Args:
+        source (Source): Path to (or binary buffer of) the file.
+        dtypes (Dict[str, str]): Names and dtypes of the columns to read, any
+            remaining columns are ignored.
+        skip_rows (int): The number of meta data lines at the top of the file.
+        chunk_size (int): Number of lines per chunk. The pyarrow parser reads
+            in blocks of bytes, so its chunks are only roughly this size.
+        parser (str): "pyarrow", "pandas" or "auto" (see read_columns()).
+        column_indices (Optional[Sequence[int]]): See read_columns().
+
+    Yields:
+        Dict[str, np.ndarray]: One array per requested column.
+    """
+    if parser == "auto":
+        parser = "pyarrow" if is_pyarrow_available() else "pandas"
+    if parser not in ("pyarrow", "pandas"):
+        raise ValueError(f"The {parser} parser can't read files in chunks.")
+    if column_indices is None:
+        column_indices = range(len(dtypes))
+    if len(column_indices) != len(dtypes):
+        raise ValueError("One column index is needed for every dtype.")
+    compression = (
+        "gzip" if isinstance(source, str) and is_gzipped(source) else None
+    )
+
+    if parser == "pandas":
+        with pd.read_csv(
+            source,
+            sep="\t",
+            header=None,
+            skiprows=skip_rows,
+            usecols=column_indices,
+            names=list(dtypes),
+            dtype=dtypes,
+            engine="c",
+            compression=compression,
+            chunksize=chunk_size
+        ) as chunks:
+            for chunk in chunks:
+                yield {column: chunk[column].to_numpy() for column in dtypes}
+        return
+
+    import pyarrow as pa
+    from pyarrow import csv
+
+    arrow_types = {
+        "object": pa.string(),
+        "int64": pa.int64(),
+        "float64": pa.float64()
+    }
+    if compression is not None:
+        source = pa.input_stream(source, compression="gzip")
+    generated_names = [f"f{i}" for i in column_indices]
+    reader = csv.open_csv(
+        source,
+        read_options=csv.ReadOptions(
+            skip_rows=skip_rows,
+            autogenerate_column_names=True,
+            block_size=chunk_size * APPROXIMATE_LINE_LENGTH
+        ),
+        parse_options=csv.ParseOptions(delimiter="\t", quote_char=False),
+        convert_options=csv.ConvertOptions(
+            include_columns=generated_names,
+            column_types={
+                name: arrow_types[dtype]
+                for name, dtype in zip(generated_names, dtypes.values())
+            }
+        )
+    )
+    for batch in reader:
+        yield {
+            column: batch.column(name).to_numpy(
+                zero_copy_only=False).astype(dtype, copy=False)
+            for name, (column, dtype) in zip(generated_names, dtypes.items())
+        }
+
+
+def read_region_chunks(file_path: str,
+                       dtypes: Dict[str, str],
+                       region: Region,
+                       chunk_size: int = DEFAULT_CHUNK_SIZE,
+                       parser: str = "auto"
+                       ) -> Iterator[Dict[str, np.ndarray]]:
+    """Streams the lines of a file that could overlap a region, a chunk at a
+    time (see read_column_chunks()). For BGZF compressed files, only the
+    blocks overlapping the region are decompressed, so the time taken
+    doesn't grow with the size of the file. Other files are streamed from
+    the start, and the lines yielded are a superset of the overlapping lines
+    either way.
+    """
+    source = file_path
+    if is_bgzf(file_path):
+        source = io.BytesIO(fetch_region(file_path, *region))
+        if source.getbuffer().nbytes == 0:
+            return
+    skip_rows, _ = inspect_table(source)
+    yield from read_column_chunks(
+        source, dtypes, skip_rows, chunk_size, parser)
+
+
+class SortOrderCheck:
+    """
+    Checks that the lines of a file are sorted by chromosome name and then
+    start position as it is streamed a chunk at a time, which readers that
+    stop early or binary search rely on.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._last_chromosome = None
+        self._last_start = None
+
+    def update(self, chromosomes: np.ndarray, starts: np.ndarray) -> None:
+        """Checks the next chunk of lines.
+
+        Raises:
+            UnsortedError: If the lines (including the last line of the
+            previous chunk) are out of order.
+        """
+        if len(chromosomes) == 0:
+            return
+        if self._last_chromosome is not None:
+            chromosomes = np.concatenate(
+                ([self._last_chromosome], chromosomes))
+            starts = np.concatenate(([self._last_start], starts))
+        is_same_chromosome = chromosomes[1:] == chromosomes[:-1]
+        # Only lines where the chromosome changes need a string comparison
+        changes = np.flatnonzero(~is_same_chromosome)
+        if np.any(is_same_chromosome & (starts[1:] < starts[:-1])) or \
+                np.any(chromosomes[changes + 1] < chromosomes[changes]):
+            raise UnsortedError(
+                f"{self.file_path} is not sorted by chromosome name and then "
+                "position. Sort it with sort_tracks.py first.")
+        self._last_chromosome = chromosomes[-1]
+        self._last_start = starts[-1]
+
+
+def is_sorted(file_path: str, parser: str = "auto") -> bool:
+    """Streams through a bedgraph or narrow peak file to check whether it is
+    sorted by chromosome name and then position.
+    """
+    skip_rows, number_of_columns = inspect_table(file_path)
+    if number_of_columns == 0:
+        return True
+    check = SortOrderCheck(file_path)
+    try:
+        for chunk in read_column_chunks(
+                file_path, BED_DTYPES, skip_rows, DEFAULT_CHUNK_SIZE, parser):
+            check.update(chunk["CHR"], chunk["START"])
+    except UnsortedError:
+        return False
+    return True
+
+
+def _read_table(file_path: str,
+                dtypes: Dict[str, str],
+                region: Optional[Region],
+                parser: str,
+                workers: int = 1) -> Tuple[int, Dict[str, np.ndarray]]:
+    """Reads a whole file, or just the lines overlapping a region.
+
+    Block gzipped files are queried through their block index so that only
+    the blocks overlapping the region are decompressed.
+
+    Returns:
+        Tuple[int, Dict[str, np.ndarray]]: The number of columns in the file
+        and the typed columns that were read.
+    """
+    source = file_path
+    if region is not None and is_bgzf(file_path):
+        source = io.BytesIO(fetch_region(file_path, *region))
+        if source.getbuffer().nbytes == 0:
+            return len(dtypes), {
+                column: np.empty(0, dtype=dtype)
+                for column, dtype in dtypes.items()
+            }
+    skip_rows, number_of_columns = inspect_table(source)
+    if number_of_columns < len(dtypes):
+        return number_of_columns, {}
+    columns = read_columns(
+        source, dtypes, skip_rows=skip_rows, parser=parser, workers=workers)
+    if region is not None:
+        overlaps_region = (
+            (columns["CHR"] == region.chromosome) &
+            (columns["START"] <= region.end) &
+            (columns["END"] >= region.start)
+        )
+        columns = {
+            column: values[overlaps_region]
+            for column, values in columns.items()
+        }
+    return number_of_columns, columns
+
+
+def _collapse_bases(chromosomes: np.ndarray,
+                    bases: np.ndarray,
+                    scores: np.ndarray) -> Dict[str, np.ndarray]:
+    """Joins neighbouring bases with the same score into intervals, where
+    base b covers [b, b + 1). Bases without a score (NaN) are left out.
+    """
+    has_score = ~np.isnan(scores)
+    chromosomes = chromosomes[has_score]
+    bases = bases[has_score]
+    scores = scores[has_score]
+    is_new_run = np.ones(len(bases), dtype=bool)
+    is_new_run[1:] = (
+        (chromosomes[1:] != chromosomes[:-1]) |
+        (bases[1:] != bases[:-1] + 1) |
+        (scores[1:] != scores[:-1])
+    )
+    run_starts = np.flatnonzero(is_new_run)
+    run_ends = np.append(run_starts[1:] - 1, len(bases) - 1)
+    return {
+        "CHR": chromosomes[run_starts],
+        "START": bases[run_starts],
+        "END": bases[run_ends] + 1,
+        "SCORE": scores[run_starts]
+    }
+
+
+def format_bedgraph_lines(bedgraph: "BedGraph",
+                          decimals: Optional[int] = None) -> str:
+    """Formats a bedgraph as text one column at a time (rather than one row
+    at a time as pd.DataFrame.to_csv() does).
+
+    Args:
+        bedgraph (BedGraph): The bedgraph to format.
+        decimals (Optional[int]): Scores are rounded to this many decimal
+            places. Defaults to full precision.
+
+    Returns:
+        str: The lines of the bedgraph, each ending in a new line.
+    """
+    if len(bedgraph.get()) == 0:
+        return ""
+    scores = bedgraph.get("SCORE").to_numpy()
+    if decimals is not None:
+        scores = np.round(scores, decimals)
+    columns = [
+        bedgraph.get("CHR").to_numpy().astype(str),
+        bedgraph.get("START").to_numpy().astype(str),
+        bedgraph.get("END").to_numpy().astype(str),
+        scores.astype(str)
+    ]
+    lines = columns[0]
+    for column in columns[1:]:
+        lines = np.strings.add(np.strings.add(lines, "\t"), column)
+    return "\n".join(lines.tolist()) + "\n"
+
+
+def format_chromosome_lines(chromosome: str,
+                            starts: np.ndarray,
+                            ends: np.ndarray,
+                            scores: np.ndarray,
+                            float_format: Optional[str] = None) -> str:
+    """format_bedgraph_lines() for the intervals of one chromosome, held as
+    arrays rather than a BedGraph (so no chromosome name is kept per line).
+
+    Args:
+        chromosome (str): Chromosome of the intervals.
+        starts (np.ndarray): Starts of the intervals.
+        ends (np.ndarray): Ends of the intervals.
+        scores (np.ndarray): Scores of the intervals.
+        float_format (Optional[str]): Format string for the scores, e.g.
+            "%.5f" (as GenomicData.write_file() takes). Defaults to full
+            precision.
+
+    Returns:
+        str: The lines of the intervals, each ending in a new line.
+    """
+    if len(starts) == 0:
+        return ""
+    if float_format is None:
+        scores = scores.astype(str)
+    else:
+        # Quicker than np.char.mod(), which formats each score as an array
+        scores = np.array([float_format % score for score in scores.tolist()])
+    lines = np.strings.add(f"{chromosome}\t", starts.astype(str))
+    for column in (ends.astype(str), scores):
+        lines = np.strings.add(np.strings.add(lines, "\t"), column)
+    return "\n".join(lines.tolist()) + "\n"
+
+
 class GenomicData:
     """
     Base class for genomic data representations (e.g., BedBase, BedGraph).
@@ -30,16 +818,26 @@ class GenomicData:
         else:
             return self.df[column_name]
 
-    def write_file(self, file_path: str) -> None:
+    def write_file(self,
+                   file_path: str,
+                   float_format: Optional[str] = None) -> None:
         """Writes a pandas DataFrame to a file in tab-separated format.
 
         Args:
             data (pd.DataFrame): The DataFrame to write to the file.
             file_path (str): The path to the output file.
+            float_format (Optional[str]): Format string for floating point
+                columns, e.g. "%.5f". Defaults to full precision.
         """
         try:
             with open(file_path, 'w') as file:
-                self.df.to_csv(file, sep="\t", header=False, index=False)
+                self.df.to_csv(
+                    file,
+                    sep="\t",
+                    header=False,
+                    index=False,
+                    float_format=float_format
+                )
         except (FileNotFoundError, IOError):
             print(f"Data could not be written to {file_path}.")
         except IsADirectoryError:
@@ -72,13 +870,8 @@ class BedGraph(GenomicData):
             "START": START,
             "END": END,
             "SCORE": SCORE
-        })
-        self.df = self.df.astype({
-            "CHR": 'object',
-            "START": 'int64',
-            "END": 'int64',
-            "SCORE": 'float64'
-        })
+        }, copy=False)
+        self.df = _enforce_dtypes(self.df, BEDGRAPH_DTYPES)
 
     def has_same_positions(self, comparison: 'BedGraph') -> bool:
         has_same_chromosome = self.df["CHR"].equals(comparison.df["CHR"])
@@ -88,31 +881,93 @@ class BedGraph(GenomicData):
             return True
         return False
 
+    def write_track(self,
+                    file_path: str,
+                    name: Optional[str] = None,
+                    decimals: Optional[int] = None) -> None:
+        """Writes the bedgraph in a form that can be loaded straight into a
+        genome browser.
+
+        Args:
+            file_path (str): The path to the output file.
+            name (Optional[str]): If given, a track line with this name is
+                written first.
+            decimals (Optional[int]): Scores are rounded to this many decimal
+                places. Defaults to full precision.
+        """
+        try:
+            with open(file_path, 'w') as file:
+                if name is not None:
+                    file.write(f'track type=bedGraph name="{name}"\n')
+                file.write(format_bedgraph_lines(self, decimals))
+        except (FileNotFoundError, IOError):
+            print(f"Data could not be written to {file_path}.")
+
     @classmethod
-    def read_from_file(cls, file_path: str) -> Optional["BedGraph"]:
+    def read_from_file(cls,
+                       file_path: str,
+                       parser: str = "auto",
+                       workers: int = 1) -> Optional["BedGraph"]:
         """Reads a bedgraph file into a pandas DataFrame.
 
         Args:
-            file_path (str): The path to the bedgraph file.
+            file_path (str): The path to the bedgraph file. This can be gzip
+                or BGZF compressed.
+            parser (str): The parser backend to use, see read_columns().
+            workers (int): Processes the parallel parser can use, see
+                read_columns().
 
         Returns:
             Optional[pd.DataFrame]: The DataFrame containing the bedgraph data,
             or None if an error occurred.
         """
-        try:
-            with open(file_path, 'r') as file:
-                first_line = file.readline()
+        return cls._read(file_path, None, parser, workers)
+
+    @classmethod
+    def read_region(cls,
+                    file_path: str,
+                    chromosome: str,
+                    start: int,
+                    end: int,
+                    parser: str = "auto",
+                    workers: int = 1) -> Optional["BedGraph"]:
+        """Reads the intervals of a bedgraph file that overlap a region. For
+        BGZF compressed files, only the blocks overlapping the region are
+        decompressed.
 
-            # Some bedgraph files start with a meta data line
-            if first_line.startswith("track"):
-                bedgraph = pd.read_table(file_path, sep="\t", skiprows=1)
-            else:
-                bedgraph = pd.read_table(file_path, sep="\t")
+        Args:
+            file_path (str): The path to the bedgraph file.
+            chromosome (str): Chromosome of the region.
+            start (int): Start of region.
+            end (int): End of region.
+            parser (str): The parser backend to use, see read_columns().
+            workers (int): Processes the parallel parser can use, see
+                read_columns().
+
+        Returns:
+            Optional[pd.DataFrame]: The DataFrame containing the bedgraph data,
+            or None if an error occurred.
+        """
+        return cls._read(
+            file_path, Region(chromosome, start, end), parser, workers)
 
-            if bedgraph.shape[1] != 4:
+    @classmethod
+    def _read(cls,
+              file_path: str,
+              region: Optional[Region],
+              parser: str,
+              workers: int = 1) -> Optional["BedGraph"]:
+        try:
+            number_of_columns, bedgraph = _read_table(
+                file_path,
+                BEDGRAPH_DTYPES,
+                region,
+                parser,
+                workers
+            )
+            if number_of_columns != 4:
                 raise ValueError(f"Bedgraph file at {file_path}"
                                  " does not have exactly 4 columns.")
-            bedgraph.columns = ["CHR", "START", "END", "SCORE"]
             return cls(
                 bedgraph["CHR"],
                 bedgraph["START"],
@@ -157,13 +1012,8 @@ class BedBaseCI(GenomicData):
             "BASE": BASE,
             "LOWER_SCORE": LOWER_SCORE,
             "UPPER_SCORE": UPPER_SCORE
-        })
-        self.df = self.df.astype({
-            "CHR": 'object',
-            "BASE": 'int64',
-            "LOWER_SCORE": 'float64',
-            "UPPER_SCORE": 'float64'
-        })
+        }, copy=False)
+        self.df = _enforce_dtypes(self.df, BEDBASE_CI_DTYPES)
 
     def has_same_positions(self, comparison: 'BedBaseCI') -> bool:
         has_same_chromosome = self.df["CHR"].equals(comparison.df["CHR"])
@@ -172,6 +1022,22 @@ class BedBaseCI(GenomicData):
             return True
         return False
 
+    def to_bedgraph(self, column: str) -> "BedGraph":
+        """Collapses one bound of the confidence intervals into runs of
+        equal values.
+
+        Args:
+            column (str): LOWER_SCORE or UPPER_SCORE.
+
+        Returns:
+            BedGraph: One interval per run, where base b covers [b, b + 1).
+        """
+        return BedGraph(**_collapse_bases(
+            self.df["CHR"].to_numpy(),
+            self.df["BASE"].to_numpy(),
+            self.df[column].to_numpy()
+        ))
+
 
 class BedBase(GenomicData):
     """
@@ -192,12 +1058,8 @@ class BedBase(GenomicData):
             "CHR": CHR,
             "BASE": BASE,
             "SCORE": SCORE
-        })
-        self.df = self.df.astype({
-            "CHR": 'object',
-            "BASE": 'int64',
-            "SCORE": 'float64'
-        })
+        }, copy=False)
+        self.df = _enforce_dtypes(self.df, BEDBASE_DTYPES)
 
     def has_same_positions(self, comparison: 'BedBase') -> bool:
         has_same_chromosome = self.df["CHR"].equals(comparison.df["CHR"])
@@ -206,6 +1068,50 @@ class BedBase(GenomicData):
             return True
         return False
 
+    def to_bedgraph(self) -> "BedGraph":
+        """Collapses the bases into runs of equal scores.
+
+        Returns:
+            BedGraph: One interval per run, where base b covers [b, b + 1).
+        """
+        return BedGraph(**_collapse_bases(
+            self.df["CHR"].to_numpy(),
+            self.df["BASE"].to_numpy(),
+            self.df["SCORE"].to_numpy()
+        ))
+
+
+class BedGraphSummary(GenomicData):
+    """
+    Represents a BedGraph summarised over fixed size bins with specific
+    columns: CHR, START, END, MIN, MAX, MEAN, SUM.
+    """
+
+    def __init__(self, CHR, START, END, MIN, MAX, MEAN, SUM):
+        """
+        Initializes a BedGraphSummary object.
+
+        Args:
+            CHR (pd.Series): Series representing the chromosome column.
+            START (pd.Series): Series representing start of bin.
+            END (pd.Series): Series representing end of bin.
+            MIN (pd.Series): Smallest score within the bin.
+            MAX (pd.Series): Largest score within the bin.
+            MEAN (pd.Series): Mean score over the bases of the bin that are
+                covered by the bedgraph.
+            SUM (pd.Series): Score summed over every base of the bin.
+        """
+        self.df = pd.DataFrame({
+            "CHR": CHR,
+            "START": START,
+            "END": END,
+            "MIN": MIN,
+            "MAX": MAX,
+            "MEAN": MEAN,
+            "SUM": SUM
+        }, copy=False)
+        self.df = _enforce_dtypes(self.df, BEDGRAPH_SUMMARY_DTYPES)
+
 
 class Bed(GenomicData):
     """
@@ -225,12 +1131,8 @@ class Bed(GenomicData):
             "CHR": CHR,
             "START": START,
             "END": END
-        })
-        self.df = self.df.astype({
-            "CHR": 'object',
-            "START": 'int64',
-            "END": 'int64'
-        })
+        }, copy=False)
+        self.df = _enforce_dtypes(self.df, BED_DTYPES)
 
     def has_same_positions(self, comparison: 'Bed') -> bool:
         has_same_chromosome = self.df["CHR"].equals(comparison.df["CHR"])
@@ -241,24 +1143,62 @@ class Bed(GenomicData):
         return False
 
     @classmethod
-    def read_from_file(cls, file_path: str) -> Optional["Bed"]:
+    def read_from_file(cls,
+                       file_path: str,
+                       parser: str = "auto") -> Optional["Bed"]:
         """Reads a BED3+7 file from MACS into a pandas DataFrame.
 
+        Args:
+            file_path (str): The path to the bedbase file. This can be gzip
+                or BGZF compressed.
+            parser (str): The parser backend to use, see read_columns().
+
+        Returns:
+            Optional[pd.DataFrame]: The DataFrame containing the bed data,
+            or None if an error occurred.
+        """
+        return cls._read(file_path, None, parser)
+
+    @classmethod
+    def read_region(cls,
+                    file_path: str,
+                    chromosome: str,
+                    start: int,
+                    end: int,
+                    parser: str = "auto") -> Optional["Bed"]:
+        """Reads the peaks of a BED3+7 file that overlap a region. For BGZF
+        compressed files, only the blocks overlapping the region are
+        decompressed.
+
         Args:
             file_path (str): The path to the bedbase file.
+            chromosome (str): Chromosome of the region.
+            start (int): Start of region.
+            end (int): End of region.
+            parser (str): The parser backend to use, see read_columns().
 
         Returns:
             Optional[pd.DataFrame]: The DataFrame containing the bed data,
             or None if an error occurred.
         """
+        return cls._read(file_path, Region(chromosome, start, end), parser)
+
+    @classmethod
+    def _read(cls,
+              file_path: str,
+              region: Optional[Region],
+              parser: str) -> Optional["Bed"]:
         try:
-            bed = pd.read_table(file_path, sep="\t", skiprows=1)
-            if bed.shape[1] < 3:
+            number_of_columns, bed = _read_table(
+                file_path,
+                BED_DTYPES,
+                region,
+                parser
+            )
+            if number_of_columns < 3:
                 raise ValueError(f"Bed file at {file_path}"
                                  " does not have enough columns.")
             # Remaining columns that might exist are useless
-            bed = bed.iloc[:, 0:3]
-            bed.columns = ["CHR", "START", "END"]
             return cls(
                 bed["CHR"],
                 bed["START"],
@@ -276,3 +1216,155 @@ class Bed(GenomicData):
         except OSError as e:
             print(f"OS error occurred: {e}")
             return None
+
+
+class _BedGraphCursor:
+    """
+    Buffered position in a bedgraph file that is being read in chunks.
+    """
+
+    def __init__(self, file_path: str, chunk_size: int, parser: str):
+        skip_rows, number_of_columns = inspect_table(file_path)
+        if number_of_columns not in (0, 4):
+            raise ValueError(f"Bedgraph file at {file_path} does not have 4 "
+                             f"columns, it has {number_of_columns}.")
+        self.file_path = file_path
+        self._chunks = read_column_chunks(
+            file_path, BEDGRAPH_DTYPES, skip_rows, chunk_size, parser)
+        self.columns = {
+            column: np.empty(0, dtype=dtype)
+            for column, dtype in BEDGRAPH_DTYPES.items()
+        }
+        self.is_exhausted = False
+        self._order = SortOrderCheck(file_path)
+
+    def __len__(self) -> int:
+        return len(self.columns["START"])
+
+    def fill(self) -> bool:
+        """Reads chunks until the buffer isn't empty.
+
+        Returns:
+            bool: False if the end of the file has been reached.
+        """
+        while len(self) == 0:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self.is_exhausted = True
+                return False
+            if len(chunk["CHR"]) == 0:
+                continue
+            self._order.update(chunk["CHR"], chunk["START"])
+            self.columns = chunk
+        return True
+
+    def rows_on(self, chromosome: str) -> int:
+        """Number of buffered rows (at the front) on a chromosome."""
+        return int(np.searchsorted(
+            self.columns["CHR"], chromosome, side="right"))
+
+    def drop(self, number_of_rows: int) -> None:
+        self.columns = {
+            column: values[number_of_rows:]
+            for column, values in self.columns.items()
+        }
+
+
+def merge_join_bedgraphs(file_paths: Sequence[str],
+                         function: Callable[..., np.ndarray],
+                         chunk_size: int = DEFAULT_CHUNK_SIZE,
+                         parser: str = "auto") -> Iterator[BedGraph]:
+    """Walks through several bedgraph files at once, splitting them into the
+    segments between every start and end found in any of them, and applies a
+    function to the scores of each segment.
+
+    Only positions covered by every file are kept. Each file must be sorted
+    by chromosome name (as MACS writes them) and then position. Files are
+    read a chunk at a time, so memory use doesn't depend on their size.
+
+    Args:
+        file_paths (Sequence[str]): Paths of the bedgraph files.
+        function (Callable[..., np.ndarray]): Called with one array of
+            segment scores per file (in the order of file_paths), returning
+            the score of each segment.
+        chunk_size (int): Number of lines read from each file at a time.
+        parser (str): "pyarrow", "pandas" or "auto" (see read_columns()).
+
+    Yields:
+        BedGraph: Consecutive chunks of the combined track.
+    """
+    cursors = [
+        _BedGraphCursor(file_path, chunk_size, parser)
+        for file_path in file_paths
+    ]
+    # Every cursor must have data for a segment to be covered by all files
+    while all(cursor.fill() for cursor in cursors):
+        chromosome = max(cursor.columns["CHR"][0] for cursor in cursors)
+        behind = [
+            cursor for cursor in cursors
+            if cursor.columns["CHR"][0] != chromosome
+        ]
+        if behind:
+            # Chromosomes missing from any file are skipped
+            for cursor in behind:
+                cursor.drop(int(np.searchsorted(
+                    cursor.columns["CHR"], chromosome, side="left")))
+            continue
+
+        rows = [cursor.rows_on(chromosome) for cursor in cursors]
+        # Segments can only be finished up to the point where some file
+        # might still have more of this chromosome in its next chunk
+        frontier = min(
+            (int(cursor.columns["END"][number_of_rows - 1])
+             for cursor, number_of_rows in zip(cursors, rows)
+             if number_of_rows == len(cursor)),
+            default=None
+        )
+        starts = [
+            cursor.columns["START"][:number_of_rows]
+            for cursor, number_of_rows in zip(cursors, rows)
+        ]
+        ends = [
+            cursor.columns["END"][:number_of_rows]
+            for cursor, number_of_rows in zip(cursors, rows)
+        ]
+        breakpoints = np.unique(np.concatenate(starts + ends))
+        if frontier is not None:
+            breakpoints = breakpoints[breakpoints <= frontier]
+        segment_starts = breakpoints[:-1]
+        segment_ends = breakpoints[1:]
+        is_covered = np.ones(len(segment_starts), dtype=bool)
+        segment_rows = []
+        for cursor_starts, cursor_ends in zip(starts, ends):
+            row = np.searchsorted(
+                cursor_starts, segment_starts, side="right") - 1
+            row = np.maximum(row, 0)
+            is_covered &= (cursor_starts[row] <= segment_starts) & \
+                (cursor_ends[row] >= segment_ends)
+            segment_rows.append(row)
+        if np.any(is_covered):
+            scores = [
+                cursor.columns["SCORE"][row[is_covered]]
+                for cursor, row in zip(cursors, segment_rows)
+            ]
+            yield BedGraph(
+                CHR=np.full(np.count_nonzero(is_covered), chromosome,
+                            dtype=object),
+                START=segment_starts[is_covered],
+                END=segment_ends[is_covered],
+                SCORE=np.asarray(function(*scores), dtype=np.float64)
+            )
+
+        for cursor, number_of_rows in zip(cursors, rows):
+            if frontier is None:
+                cursor.drop(number_of_rows)
+                continue
+            # Lines crossing the frontier are kept, minus the finished part
+            finished_rows = int(np.searchsorted(
+                cursor.columns["END"][:number_of_rows], frontier,
+                side="right"))
+            cursor.drop(finished_rows)
+            if len(cursor) > 0 and cursor.columns["CHR"][0] == chromosome:
+                cursor.columns["START"] = cursor.columns["START"].copy()
+                cursor.columns["START"][0] = max(
+                    cursor.columns["START"][0], frontier)
@@ -0,0 +1,130 @@
+import json
+import os
+import numpy as np
+from file_digests import FileDigests, hash_values
+from typing import Dict, List, Optional
+
+# Increase this whenever the way a cached artifact is calculated changes, so
+# that artifacts made by older versions are no longer used.
+CACHE_VERSION = "2"
+DEFAULT_MAX_SIZE = 1 << 30
+ARTIFACT_SUFFIX = ".npz"
+FILE_DIGESTS_NAME = "file_digests.json"
+
+
+def _atomic_path(path: str) -> str:
+    # Several jobs can share one cache, so temporary files are made unique
+    # to the process writing them
+    return f"{path}.{os.getpid()}.tmp"
+
+
+class ArtifactCache:
+    """
+    A directory of arrays derived from input files (such as the peak labels
+    and p-value confidence intervals of a reference sample over a region).
+
+    Artifacts are keyed by the contents of the files they were derived from
+    and the parameters used, so they are reused whenever the same inputs come
+    up again, even if the files have been rewritten in the meantime. Digests
+    of input files are kept alongside the artifacts (keyed by size and
+    modification time) so unchanged files are only hashed once.
+
+    The cache is kept under a maximum size by deleting the least recently
+    used artifacts. Files are written atomically so the cache can be shared
+    by jobs running at the same time.
+    """
+
+    def __init__(self, directory: str, max_size: int = DEFAULT_MAX_SIZE):
+        """
+        Args:
+            directory (str): Directory holding the cache (created if it
+                doesn't exist).
+            max_size (int): Maximum total size of the artifacts in bytes.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        self._digests_path = os.path.join(directory, FILE_DIGESTS_NAME)
+        try:
+            with open(self._digests_path, "r") as digests_file:
+                saved_digests = json.load(digests_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            saved_digests = {}
+        self._digests = FileDigests(saved_digests, self._save_digests)
+
+    def _save_digests(self, file_path: str, entry: dict) -> None:
+        temporary_path = _atomic_path(self._digests_path)
+        with open(temporary_path, "w") as digests_file:
+            json.dump(self._digests.entries(), digests_file)
+        os.replace(temporary_path, self._digests_path)
+
+    def key(self,
+            kind: str,
+            input_files: List[str],
+            parameters: Dict[str, str]) -> str:
+        """Fingerprints an artifact.
+
+        Args:
+            kind (str): What the artifact is, e.g. "peak_labels".
+            input_files (List[str]): Files the artifact is derived from (in a
+                fixed order).
+            parameters (Dict[str, str]): Everything else the artifact depends
+                on, such as the region.
+
+        Returns:
+            str: The key of the artifact.
+        """
+        values = [CACHE_VERSION, kind]
+        for file_path in input_files:
+            values.append(self._digests.digest(file_path))
+        for name in sorted(parameters):
+            values.extend([name, str(parameters[name])])
+        return hash_values(values)
+
+    def _artifact_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}{ARTIFACT_SUFFIX}")
+
+    def load(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        """Loads an artifact, or returns None if it isn't in the cache."""
+        artifact_path = self._artifact_path(key)
+        try:
+            with np.load(artifact_path, allow_pickle=False) as artifact:
+                arrays = {name: artifact[name] for name in artifact.files}
+            # The modification time records when the artifact was last
+            # used (access times are often disabled on shared filesystems)
+            os.utime(artifact_path)
+        except (FileNotFoundError, ValueError, OSError):
+            # Evicted by another job or left corrupt, either way recalculate
+            return None
+        return arrays
+
+    def store(self, key: str, arrays: Dict[str, np.ndarray]) -> None:
+        """Adds an artifact to the cache, then evicts the least recently
+        used artifacts until the cache fits within its maximum size.
+        """
+        artifact_path = self._artifact_path(key)
+        temporary_path = _atomic_path(artifact_path)
+        with open(temporary_path, "wb") as artifact_file:
+            np.savez(artifact_file, **arrays)
+        os.replace(temporary_path, artifact_path)
+        self._evict()
+
+    def _evict(self) -> None:
+        artifacts = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(ARTIFACT_SUFFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            artifacts.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in artifacts)
+        for _, size, artifact_path in sorted(artifacts):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(artifact_path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
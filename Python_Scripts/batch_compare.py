@@ -0,0 +1,848 @@
+import argparse
+import functools
+import multiprocessing
+import sys
+import numpy as np
+import pandas as pd
+from binned_compare import (
+    DEFAULT_BIN_SIZE,
+    BinnedMetric,
+    Intervals,
+    calculate_metric_binned
+)
+from chunked_compare import ComparisonFiles
+from create_confidence_intervals import (
+    calculate_pvalue_ci,
+    segmented_lambda_ci
+)
+from determine_metric import (
+    PeakCounts,
+    count_peaks_segmented,
+    metric_from_counts
+)
+from execution_planner import (
+    GROUP_BASES,
+    core_budget,
+    log_peak_memory,
+    log_plan,
+    plan_batch,
+    regions_per_batch,
+    resource_budget
+)
+from extract_region import interval_scores_at
+from IO import Bed, BedGraph, GenomicData
+from results_store import ResultsStore, comparison_parameters
+from typing import Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+# Number of newly calculated regions added to a results store at a time
+STORE_BATCH_SIZE = 1000
+# How values that aren't numbers (such as a metric of 0/0) are written, in
+# both partial and merged result files
+NAN_TEXT = "NaN"
+RESULT_COLUMNS = [
+    "region",
+    "chromosome",
+    "start",
+    "end",
+    "pseudopeaks",
+    "reference_peaks",
+    "metric"
+]
+SCREEN_COLUMNS = [
+    "region",
+    "chromosome",
+    "start",
+    "end",
+    "approximate_metric",
+    "error_bound",
+    "refined",
+    "metric"
+]
+# The files of the shard being run. This is set before worker processes are
+# forked, so that they share the loaded files instead of each being sent a
+# copy.
+_shard_tracks: Optional["ShardTracks"] = None
+
+
+class Shard(NamedTuple):
+    """
+    Represents one of a number of shards (numbered from 0).
+    """
+    index: int
+    count: int
+
+
+def parse_shard(shard: str) -> Shard:
+    """Parses a shard given as i/N (with 0 <= i < N)."""
+    try:
+        index, count = (int(value) for value in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard must be given as i/N, got {shard}.")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Shard index must be between 0 and {count - 1}, "
+                         f"got {shard}.")
+    return Shard(index, count)
+
+
+def assign_shards(region_lengths: np.ndarray, count: int) -> np.ndarray:
+    """Splits regions into shards with (about) the same total number of
+    bases. Each shard gets a consecutive run of regions, so that a shard
+    reads as few chromosomes as possible.
+
+    Args:
+        region_lengths (np.ndarray): Number of bases in each region.
+        count (int): Number of shards.
+
+    Returns:
+        np.ndarray: The shard of each region. This only depends on the
+        region lengths, so every shard agrees on it.
+    """
+    total_bases = region_lengths.sum()
+    if total_bases == 0:
+        return np.zeros(len(region_lengths), dtype=np.int64)
+    # Regions go to the shard that their middle base falls in
+    middles = np.cumsum(region_lengths) - region_lengths / 2
+    return np.minimum(
+        (middles * count / total_bases).astype(np.int64), count - 1)
+
+
+class _LoadedTrack:
+    """
+    A bedgraph (or peak) file held in memory, split by chromosome so that
+    the intervals overlapping a region can be found with a binary search.
+    """
+
+    def __init__(self, data: GenomicData, chromosomes: Set[str]):
+        self._chromosomes: Dict[str, Tuple[np.ndarray, ...]] = {}
+        df = data.get()
+        df = df.loc[df["CHR"].isin(chromosomes)]
+        for chromosome, intervals in df.groupby("CHR", sort=False):
+            intervals = intervals.sort_values("START", kind="stable")
+            ends = intervals["END"].to_numpy()
+            self._chromosomes[chromosome] = (
+                intervals["START"].to_numpy(),
+                ends,
+                # Peaks can overlap, so their ends needn't be sorted
+                np.maximum.accumulate(ends) if len(ends) else ends,
+                intervals["SCORE"].to_numpy()
+                if "SCORE" in intervals else np.ones(len(intervals))
+            )
+
+    def intervals(self, chromosome: str, start: int, end: int) -> Intervals:
+        """The starts, ends and scores of the intervals that could overlap a
+        region (with the end of the region included).
+        """
+        empty = np.empty(0, dtype=np.int64)
+        starts, ends, furthest_ends, scores = self._chromosomes.get(
+            chromosome, (empty, empty, empty, np.empty(0)))
+        first = int(np.searchsorted(furthest_ends, start, side="right"))
+        last = int(np.searchsorted(starts, end, side="right"))
+        return starts[first:last], ends[first:last], scores[first:last]
+
+    def scores_at(self, chromosome: str, bases: np.ndarray) -> np.ndarray:
+        """The score of each of the bases given (on one chromosome), NaN for
+        bases not in the file.
+        """
+        empty = np.empty(0, dtype=np.int64)
+        starts, ends, _, scores = self._chromosomes.get(
+            chromosome, (empty, empty, empty, np.empty(0)))
+        return interval_scores_at(starts, ends, scores, bases)
+
+
+def _fill_with_minimum(scores: np.ndarray,
+                       segment_starts: np.ndarray) -> np.ndarray:
+    # As convert_to_bedbase() does, with the smallest score of each segment
+    minimums = np.fmin.reduceat(scores, segment_starts)
+    segment_lengths = np.diff(np.append(segment_starts, len(scores)))
+    return np.where(
+        np.isnan(scores), np.repeat(minimums, segment_lengths), scores)
+
+
+class ShardTracks(NamedTuple):
+    """
+    Represents the files of a comparison, loaded for the chromosomes of a
+    shard.
+    """
+    merged_peaks: _LoadedTrack
+    unmerged_peaks: _LoadedTrack
+    reference_bias: _LoadedTrack
+    reference_coverage: _LoadedTrack
+    comparison_bias: _LoadedTrack
+    comparison_coverage: _LoadedTrack
+    comparison_pvalues: _LoadedTrack
+
+
+def load_tracks(files: ComparisonFiles,
+                chromosomes: Set[str]) -> Optional[ShardTracks]:
+    """Reads every file once, keeping only the chromosomes given.
+
+    Returns:
+        Optional[ShardTracks]: The loaded files, or None if any of them
+        couldn't be read.
+    """
+    peak_files = {
+        files.reference_merged_peaks,
+        files.reference_unmerged_peaks
+    }
+    loaded = []
+    for file_path in files:
+        if file_path in peak_files:
+            data = Bed.read_from_file(file_path)
+        else:
+            data = BedGraph.read_from_file(
+                file_path, workers=core_budget())
+        if data is None:
+            return None
+        loaded.append(_LoadedTrack(data, chromosomes))
+    return ShardTracks(*loaded)
+
+
+def _pvalue_ci(bias: _LoadedTrack,
+               coverage: _LoadedTrack,
+               chromosome: str,
+               bases: np.ndarray,
+               segment_starts: np.ndarray,
+               significance: float,
+               window_size: int):
+    lambda_ci = segmented_lambda_ci(
+        _fill_with_minimum(bias.scores_at(chromosome, bases), segment_starts),
+        segment_starts,
+        significance,
+        window_size
+    )
+    return calculate_pvalue_ci(
+        _fill_with_minimum(
+            coverage.scores_at(chromosome, bases), segment_starts),
+        lambda_ci
+    )
+
+
+def count_regions(tracks: ShardTracks,
+                  chromosome: str,
+                  starts: np.ndarray,
+                  ends: np.ndarray,
+                  cutoff: float,
+                  significance: float = 0.95,
+                  window_size: int = 50,
+                  include_merged_peaks: bool = True
+                  ) -> Tuple[np.ndarray, np.ndarray]:
+    """Counts the pseudopeaks and reference peaks of many regions on one
+    chromosome at once, giving the same counts as count_region() does for
+    each of them.
+
+    The bases of every region are laid end to end, so that each step is one
+    call over all of them rather than one call per region (which mostly
+    costs the overhead of the call for small regions).
+
+    Args:
+        starts (np.ndarray): Start of each region.
+        ends (np.ndarray): End of each region (included).
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The number of pseudopeaks and
+        reference peaks in each region.
+    """
+    region_lengths = ends - starts + 1
+    segment_starts = np.cumsum(region_lengths) - region_lengths
+    bases = np.arange(region_lengths.sum()) + \
+        np.repeat(starts - segment_starts, region_lengths)
+    peak_type = (
+        np.nan_to_num(tracks.merged_peaks.scores_at(chromosome, bases)) +
+        np.nan_to_num(tracks.unmerged_peaks.scores_at(chromosome, bases))
+    )
+    reference_pvalue_ci = _pvalue_ci(
+        tracks.reference_bias, tracks.reference_coverage,
+        chromosome, bases, segment_starts, significance, window_size)
+    comparison_pvalue_ci = _pvalue_ci(
+        tracks.comparison_bias, tracks.comparison_coverage,
+        chromosome, bases, segment_starts, significance, window_size)
+    return count_peaks_segmented(
+        reference_pvalue_ci.lower,
+        comparison_pvalue_ci.upper,
+        _fill_with_minimum(
+            tracks.comparison_pvalues.scores_at(chromosome, bases),
+            segment_starts),
+        peak_type,
+        segment_starts,
+        cutoff,
+        include_merged_peaks
+    )
+
+
+def count_region(tracks: ShardTracks,
+                 chromosome: str,
+                 start: int,
+                 end: int,
+                 cutoff: float,
+                 significance: float = 0.95,
+                 window_size: int = 50,
+                 include_merged_peaks: bool = True) -> PeakCounts:
+    """Counts the pseudopeaks and reference peaks of one region, giving the
+    same counts as peak_compare.py does for the region.
+    """
+    number_of_pseudopeaks, number_of_reference_peaks = count_regions(
+        tracks,
+        chromosome,
+        np.array([start], dtype=np.int64),
+        np.array([end], dtype=np.int64),
+        cutoff,
+        significance,
+        window_size,
+        include_merged_peaks
+    )
+    return PeakCounts(int(number_of_pseudopeaks[0]),
+                      int(number_of_reference_peaks[0]))
+
+
+def screen_region(tracks: ShardTracks,
+                  chromosome: str,
+                  start: int,
+                  end: int,
+                  cutoff: float,
+                  significance: float = 0.95,
+                  window_size: int = 50,
+                  include_merged_peaks: bool = True,
+                  bin_size: int = DEFAULT_BIN_SIZE) -> BinnedMetric:
+    """Approximates the metric of one region with calculate_metric_binned().
+    """
+    return calculate_metric_binned(
+        *(track.intervals(chromosome, start, end) for track in tracks),
+        start,
+        end,
+        cutoff,
+        significance,
+        window_size,
+        include_merged_peaks,
+        bin_size
+    )
+
+
+def read_regions(file_path: str) -> Optional[pd.DataFrame]:
+    """Reads a list of regions (chromosome, start and end, the same as
+    peak_compare.py takes them), numbering them in the order they appear.
+    """
+    regions = Bed.read_from_file(file_path)
+    if regions is None:
+        return None
+    regions = regions.get().rename(columns={
+        "CHR": "chromosome", "START": "start", "END": "end"
+    })
+    regions.insert(0, "region", np.arange(len(regions)))
+    return regions
+
+
+def shard_regions(regions: pd.DataFrame, shard: Shard) -> pd.DataFrame:
+    """The regions that belong to a shard (see assign_shards())."""
+    shards = assign_shards(
+        (regions["end"] - regions["start"] + 1).to_numpy(), shard.count)
+    return regions.loc[shards == shard.index]
+
+
+def _region_groups(batch: List[tuple]) -> Iterator[List[tuple]]:
+    """Splits a batch of regions into runs of regions on the same chromosome
+    with up to GROUP_BASES bases between them (a longer region is a group of
+    its own).
+    """
+    group: List[tuple] = []
+    group_bases = 0
+    for region in batch:
+        _, chromosome, start, end = region
+        length = end - start + 1
+        if group and (chromosome != group[0][1] or
+                      group_bases + length > GROUP_BASES):
+            yield group
+            group = []
+            group_bases = 0
+        group.append(region)
+        group_bases += length
+    if group:
+        yield group
+
+
+def _count_batch(batch: List[tuple],
+                 cutoff: float,
+                 significance: float,
+                 window_size: int,
+                 include_merged_peaks: bool) -> List[tuple]:
+    """Counts the peaks of a batch of regions (region number, chromosome,
+    start and end) in the files of the shard being run.
+    """
+    results = []
+    for group in _region_groups(batch):
+        regions, chromosomes, starts, ends = zip(*group)
+        pseudopeaks, reference_peaks = count_regions(
+            _shard_tracks,
+            chromosomes[0],
+            np.array(starts, dtype=np.int64),
+            np.array(ends, dtype=np.int64),
+            cutoff,
+            significance,
+            window_size,
+            include_merged_peaks
+        )
+        results.extend(zip(regions, chromosomes, starts, ends,
+                           pseudopeaks.tolist(), reference_peaks.tolist()))
+    return results
+
+
+def _count_batches(batches: List[List[tuple]],
+                   workers: int,
+                   **parameters) -> Iterator[List[tuple]]:
+    """Counts batches of regions (see _count_batch()) in order, using a pool
+    of worker processes if there is more than one worker.
+    """
+    count_batch = functools.partial(_count_batch, **parameters)
+    if workers == 1:
+        yield from map(count_batch, batches)
+        return
+    # Forked workers see the loaded files without them being copied
+    with multiprocessing.get_context("fork").Pool(workers) as pool:
+        yield from pool.imap(count_batch, batches)
+        pool.close()
+        pool.join()
+
+
+def run_shard(regions: pd.DataFrame,
+              shard: Shard,
+              files: ComparisonFiles,
+              cutoff: float,
+              significance: float,
+              window_size: int,
+              include_merged_peaks: bool,
+              store: Optional[ResultsStore] = None,
+              workers: int = 1,
+              batch_size: Optional[int] = None) -> Optional[pd.DataFrame]:
+    """Calculates the metric for the regions that belong to a shard.
+
+    Args:
+        store (Optional[ResultsStore]): If given, regions already in the
+            store are looked up rather than calculated, and newly calculated
+            regions are added to it (every STORE_BATCH_SIZE regions, so that
+            an interrupted job keeps what it has done).
+        workers (int): Number of processes to calculate regions with.
+        batch_size (Optional[int]): Number of regions given to a worker at a
+            time. Defaults to regions_per_batch().
+
+    Returns:
+        Optional[pd.DataFrame]: The results (RESULT_COLUMNS) of the shard's
+        regions, or None if the files couldn't be read.
+    """
+    regions = shard_regions(regions, shard)
+    stored = pd.DataFrame(columns=RESULT_COLUMNS)
+    if store is not None:
+        comparison = store.comparison_key(
+            files,
+            comparison_parameters(
+                cutoff, significance, window_size, include_merged_peaks)
+        )
+        stored = regions.merge(
+            store.lookup(comparison, regions),
+            on=["chromosome", "start", "end"]
+        )[RESULT_COLUMNS]
+        regions = regions.loc[~regions["region"].isin(stored["region"])]
+    if len(regions) == 0:
+        return stored
+    global _shard_tracks
+    _shard_tracks = load_tracks(files, set(regions["chromosome"]))
+    if _shard_tracks is None:
+        return None
+    if batch_size is None:
+        batch_size = regions_per_batch(len(regions), workers)
+    regions_to_count = list(regions[
+        ["region", "chromosome", "start", "end"]
+    ].itertuples(index=False, name=None))
+    batches = [
+        regions_to_count[first:first + batch_size]
+        for first in range(0, len(regions_to_count), batch_size)
+    ]
+    results = []
+    number_stored = 0
+    for batch_results in _count_batches(
+            batches,
+            workers,
+            cutoff=cutoff,
+            significance=significance,
+            window_size=window_size,
+            include_merged_peaks=include_merged_peaks):
+        results.extend(batch_results)
+        if store is not None and \
+                len(results) - number_stored >= STORE_BATCH_SIZE:
+            store.insert(comparison, _with_metric(results[number_stored:]))
+            number_stored = len(results)
+    _shard_tracks = None
+    results = _with_metric(results)
+    if store is not None:
+        store.insert(comparison, results.iloc[number_stored:])
+        results = pd.concat(
+            [stored, results], ignore_index=True
+        ).sort_values("region", ignore_index=True)
+    return results
+
+
+def _with_metric(results: List[tuple]) -> pd.DataFrame:
+    results = pd.DataFrame(results, columns=RESULT_COLUMNS[:-1])
+    results["metric"] = metric_from_counts(results["pseudopeaks"],
+                                           results["reference_peaks"])
+    return results
+
+
+def screen_shard(regions: pd.DataFrame,
+                 shard: Shard,
+                 files: ComparisonFiles,
+                 cutoff: float,
+                 significance: float,
+                 window_size: int,
+                 include_merged_peaks: bool,
+                 bin_size: int = DEFAULT_BIN_SIZE,
+                 threshold: Optional[float] = None,
+                 tolerance: float = 0) -> Optional[pd.DataFrame]:
+    """Approximates the metric for the regions that belong to a shard, then
+    calculates the exact metric for those that could be on either side of a
+    threshold.
+
+    Args:
+        threshold (Optional[float]): Regions whose approximate metric is
+            within its error bound (plus the tolerance) of this are
+            calculated exactly. If None, no regions are.
+        tolerance (float): Extra leeway given to the error bound, as it
+            doesn't cover everything that the approximation changes.
+
+    Returns:
+        Optional[pd.DataFrame]: The results (SCREEN_COLUMNS) of the shard's
+        regions, or None if the files couldn't be read. Regions that were
+        calculated exactly have refined set, the exact metric of the others
+        is left as NaN (which an exact metric of 0/0 also is).
+    """
+    regions = shard_regions(regions, shard)
+    tracks = load_tracks(files, set(regions["chromosome"]))
+    if tracks is None:
+        return None
+    results = []
+    for region in regions.itertuples(index=False):
+        arguments = (
+            tracks,
+            region.chromosome,
+            region.start,
+            region.end,
+            cutoff,
+            significance,
+            window_size,
+            include_merged_peaks
+        )
+        approximation = screen_region(*arguments, bin_size)
+        refined = threshold is not None and \
+            abs(approximation.metric - threshold) <= \
+            approximation.error_bound + tolerance
+        metric = np.nan
+        if refined:
+            peak_counts = count_region(*arguments)
+            metric = metric_from_counts(peak_counts.number_of_pseudopeaks,
+                                        peak_counts.number_of_reference_peaks)
+        results.append((
+            region.region,
+            region.chromosome,
+            region.start,
+            region.end,
+            approximation.metric,
+            approximation.error_bound,
+            refined,
+            metric
+        ))
+    return pd.DataFrame(results, columns=SCREEN_COLUMNS)
+
+
+def write_partial(results: pd.DataFrame,
+                  shard: Shard,
+                  file_path: str) -> None:
+    """Writes the results of one shard, with a line saying which shard they
+    are from (so that merging can tell if a shard is missing).
+    """
+    with open(file_path, "w") as file:
+        file.write(f"# shard {shard.index}/{shard.count}\n")
+        results.to_csv(file, sep="\t", index=False, na_rep=NAN_TEXT)
+
+
+def _read_partial(file_path: str) -> Tuple[Shard, pd.DataFrame]:
+    with open(file_path, "r") as file:
+        first_line = file.readline()
+        if not first_line.startswith("# shard "):
+            raise ValueError(f"{file_path} is not a partial result file.")
+        shard = parse_shard(first_line[len("# shard "):].strip())
+        return shard, pd.read_csv(
+            file, sep="\t", float_precision="round_trip")
+
+
+def merge_partials(file_paths: List[str],
+                   regions: pd.DataFrame) -> Tuple[pd.DataFrame, List[int]]:
+    """Combines the partial result files of a sharded run into one table.
+
+    Args:
+        file_paths (List[str]): The partial result files.
+        regions (pd.DataFrame): The regions file given to every shard.
+
+    Returns:
+        Tuple[pd.DataFrame, List[int]]: The results in the order of the
+        regions file (regions whose shard is missing are left out), and the
+        shards that are missing.
+    """
+    shard_count = None
+    found_shards = set()
+    partials = []
+    for file_path in file_paths:
+        shard, partial = _read_partial(file_path)
+        if shard_count is not None and shard.count != shard_count:
+            raise ValueError(f"{file_path} is from a run with {shard.count} "
+                             f"shards, not {shard_count}.")
+        shard_count = shard.count
+        found_shards.add(shard.index)
+        partials.append(partial)
+    if shard_count is None:
+        raise ValueError("No partial result files were given.")
+    missing_shards = sorted(set(range(shard_count)) - found_shards)
+
+    results = pd.concat(partials, ignore_index=True)
+    merged = regions.merge(
+        results.drop(columns=["chromosome", "start", "end"]),
+        on="region",
+        how="inner"
+    )
+    # Keep the counts as integers even with regions looked up in a results
+    # store (which may not have counts)
+    for column in ("pseudopeaks", "reference_peaks"):
+        if column in merged:
+            merged[column] = merged[column].astype("Int64")
+    return merged[results.columns], missing_shards
+
+
+def _add_comparison_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--unmerged",
+        action="store_true",
+        help=("Set this if you want to discount peaks that are a result of "
+              "merging when calculating the metric.")
+    )
+    parser.add_argument(
+        "--significance",
+        default=0.95,
+        type=float,
+        help=("The significance used when calculating confidence intervals.")
+    )
+    parser.add_argument(
+        "--window_size",
+        default=50,
+        type=int,
+        help=("The window size used when calculating confidence intervals.")
+    )
+    parser.add_argument(
+        "reference_merged_peaks_file",
+        help=("The narrow peak file from reference dataset where peaks are "
+              "merged.")
+    )
+    parser.add_argument(
+        "reference_unmerged_peaks_file",
+        help=("The narrow peak file from reference dataset where peaks are "
+              "not merged.")
+    )
+    parser.add_argument(
+        "reference_bias_track_file",
+        help="The bias track file for the reference dataset."
+    )
+    parser.add_argument(
+        "reference_coverage_track_file",
+        help="The coverage track (pileup) file for the reference dataset."
+    )
+    parser.add_argument(
+        "comparison_bias_track_file",
+        help="The bias track file for the comparison dataset."
+    )
+    parser.add_argument(
+        "comparison_coverage_track_file",
+        help="The coverage track (pileup) file for the comparison dataset."
+    )
+    parser.add_argument(
+        "comparison_pvalues_file",
+        help="The pvalues for the comparison dataset."
+    )
+    parser.add_argument(
+        "cutoff",
+        type=float,
+        help="The cutoff used to call peaks in the reference dataset."
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="BatchCompare",
+        description=("Determine the metric for a list of regions, split "
+                     "into shards that can be run as separate jobs (such as "
+                     "the tasks of a SLURM array).")
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser(
+        "run",
+        help="Calculate the metric for the regions of one shard."
+    )
+    run_parser.add_argument(
+        "--shard",
+        default="0/1",
+        help=("Which shard to run, as i/N for the i-th of N shards "
+              "(counting from 0). Shards have about the same total number "
+              "of bases.")
+    )
+    run_parser.add_argument(
+        "--output",
+        required=True,
+        help="File to write this shard's results to."
+    )
+    run_parser.add_argument(
+        "--store",
+        help=("SQLite results store (see results_store.py). Regions already "
+              "in it are looked up instead of calculated, and new ones are "
+              "added to it.")
+    )
+    run_parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="Number of processes to calculate regions with."
+    )
+    run_parser.add_argument(
+        "--plan",
+        action="store_true",
+        help=("Choose the number of workers and regions per batch from the "
+              "memory and cores the job has, the lengths of the regions and "
+              "the size of the files. The plan and its predicted and actual "
+              "peak memory are printed to stderr. Can't be used with "
+              "--workers.")
+    )
+    run_parser.add_argument(
+        "regions_file",
+        help=("Tab separated file of regions (chromosome, start and end, as "
+              "given to peak_compare.py).")
+    )
+    _add_comparison_arguments(run_parser)
+    screen_parser = subparsers.add_parser(
+        "screen",
+        help=("Quickly approximate the metric for the regions of one shard, "
+              "only calculating it exactly for regions near a threshold.")
+    )
+    screen_parser.add_argument("--shard", default="0/1")
+    screen_parser.add_argument("--output", required=True)
+    screen_parser.add_argument(
+        "--bin_size",
+        default=DEFAULT_BIN_SIZE,
+        type=int,
+        help="Number of bases in each bin of the approximation."
+    )
+    screen_parser.add_argument(
+        "--threshold",
+        type=float,
+        help=("Regions whose approximate metric could be on either side of "
+              "this are calculated exactly. If not given, none are.")
+    )
+    screen_parser.add_argument(
+        "--tolerance",
+        default=0,
+        type=float,
+        help=("Regions within their error bound plus this of the threshold "
+              "are calculated exactly.")
+    )
+    screen_parser.add_argument("regions_file")
+    _add_comparison_arguments(screen_parser)
+    merge_parser = subparsers.add_parser(
+        "merge",
+        help="Combine the results of every shard into one table."
+    )
+    merge_parser.add_argument(
+        "--output",
+        help="File to write the table to. Defaults to standard output."
+    )
+    merge_parser.add_argument("regions_file")
+    merge_parser.add_argument("partial_files", nargs="+")
+    args = parser.parse_args()
+
+    regions = read_regions(args.regions_file)
+    if regions is None:
+        sys.exit(1)
+    if args.command in ("run", "screen"):
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as error:
+            print(error)
+            sys.exit(1)
+        files = ComparisonFiles(*(
+            getattr(args, f"{field}_file")
+            for field in ComparisonFiles._fields
+        ))
+        if args.command == "run":
+            if args.workers < 1:
+                print("--workers must be at least 1.")
+                sys.exit(1)
+            plan = None
+            batch_size = None
+            if args.plan:
+                if args.workers != 1:
+                    print("--plan can't be used with --workers.")
+                    sys.exit(1)
+                shard_lengths = shard_regions(regions, shard)
+                shard_lengths = (
+                    shard_lengths["end"] - shard_lengths["start"] + 1)
+                plan = plan_batch(
+                    files[2:], shard_lengths.tolist(), resource_budget())
+                log_plan(plan)
+                args.workers = plan.workers
+                batch_size = plan.batch_size
+            store = ResultsStore(args.store) \
+                if args.store is not None else None
+            results = run_shard(
+                regions,
+                shard,
+                files,
+                args.cutoff,
+                args.significance,
+                args.window_size,
+                include_merged_peaks=(not args.unmerged),
+                store=store,
+                workers=args.workers,
+                batch_size=batch_size
+            )
+            if store is not None:
+                store.close()
+            if plan is not None:
+                log_peak_memory(plan)
+        else:
+            results = screen_shard(
+                regions,
+                shard,
+                files,
+                args.cutoff,
+                args.significance,
+                args.window_size,
+                include_merged_peaks=(not args.unmerged),
+                bin_size=args.bin_size,
+                threshold=args.threshold,
+                tolerance=args.tolerance
+            )
+        if results is None:
+            sys.exit(1)
+        write_partial(results, shard, args.output)
+    else:
+        try:
+            merged, missing_shards = merge_partials(
+                args.partial_files, regions)
+        except (FileNotFoundError, ValueError) as error:
+            print(error)
+            sys.exit(1)
+        merged.to_csv(
+            args.output if args.output is not None else sys.stdout,
+            sep="\t",
+            index=False,
+            na_rep=NAN_TEXT
+        )
+        if missing_shards:
+            print("Results are missing for shards: "
+                  f"{', '.join(str(shard) for shard in missing_shards)}. "
+                  f"{len(regions) - len(merged)} regions have been left "
+                  "out.",
+                  file=sys.stderr)
+            sys.exit(1)
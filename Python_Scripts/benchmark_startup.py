@@ -0,0 +1,68 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import List
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+ENTRY_POINTS = [
+    "peak_compare",
+    "peak_compare_matrix",
+    "get_cutoff",
+    "cutoff_analysis",
+    "call_peaks",
+    "compare_tracks",
+    "build_bias_track",
+    "peak_call_pipeline"
+]
+
+
+def time_command(command: List[str], repeats: int) -> float:
+    """The median wall clock time of running a command, in seconds."""
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        subprocess.run(
+            command,
+            cwd=SCRIPT_DIRECTORY,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True
+        )
+        timings.append(time.perf_counter() - start_time)
+    return statistics.median(timings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="BenchmarkStartup",
+        description=("Time how long each entry point takes to start: "
+                     "importing it, and running it with --help (which "
+                     "parses arguments but does no work). Many short jobs "
+                     "in an array pay this cost every time.")
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=5,
+        help="Number of times to run each command (the median is reported)."
+    )
+    parser.add_argument(
+        "entry_points",
+        nargs="*",
+        default=ENTRY_POINTS,
+        help="Scripts to time (without .py). Defaults to all entry points."
+    )
+    args = parser.parse_args()
+
+    interpreter = time_command([sys.executable, "-c", "pass"], args.repeats)
+    print("entry_point\timport_seconds\thelp_seconds")
+    print(f"(interpreter)\t{interpreter:.3f}\t{interpreter:.3f}")
+    for entry_point in args.entry_points:
+        import_time = time_command(
+            [sys.executable, "-c", f"import {entry_point}"], args.repeats)
+        help_time = time_command(
+            [sys.executable, f"{entry_point}.py", "--help"], args.repeats)
+        print(f"{entry_point}\t{import_time:.3f}\t{help_time:.3f}")
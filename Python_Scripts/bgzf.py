@@ -0,0 +1,373 @@
+import argparse
+import os
+import struct
+import zlib
+from typing import Iterator, List, NamedTuple, Tuple
+
+# Every BGZF block is a gzip member with a 'BC' extra field holding the size
+# of the block. This lets a reader jump straight to any block.
+BGZF_HEADER = struct.Struct("<4BI2BH2BHH")
+BGZF_FOOTER = struct.Struct("<II")
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+# bgzip keeps the uncompressed payload of each block below this size so that
+# the compressed block always fits in 64KiB.
+MAX_BLOCK_DATA_SIZE = 0xff00
+EOF_BLOCK = bytes.fromhex(
+    "1f8b08040000000000ff0600424302001b0003000000000000000000")
+INDEX_SUFFIX = ".bgi"
+INDEX_HEADER = "#bgzf_block_index"
+
+
+class IndexEntry(NamedTuple):
+    """
+    Represents the lines of one chromosome that start within one BGZF block.
+    """
+    block_offset: int
+    line_offset: int
+    chromosome: str
+    first_start: int
+    last_end: int
+
+
+def is_gzipped(file_path: str) -> bool:
+    with open(file_path, "rb") as file:
+        return file.read(2) == b"\x1f\x8b"
+
+
+def is_bgzf(file_path: str) -> bool:
+    """Checks whether a file is block gzipped (as written by bgzip)."""
+    with open(file_path, "rb") as file:
+        header = file.read(BGZF_HEADER.size)
+    if len(header) < BGZF_HEADER.size or not header.startswith(BGZF_MAGIC):
+        return False
+    *_, subfield_1, subfield_2, _, _ = BGZF_HEADER.unpack(header)
+    return (subfield_1, subfield_2) == (ord("B"), ord("C"))
+
+
+def read_block(file, block_offset: int) -> Tuple[bytes, int]:
+    """Decompresses the BGZF block found at an offset in an open file.
+
+    Args:
+        file: File object opened in binary mode.
+        block_offset (int): Offset of the start of the block in the file.
+
+    Returns:
+        Tuple[bytes, int]: The decompressed data and the offset of the next
+        block.
+    """
+    file.seek(block_offset)
+    header = file.read(BGZF_HEADER.size)
+    if len(header) < BGZF_HEADER.size or not header.startswith(BGZF_MAGIC):
+        raise ValueError(f"No BGZF block found at offset {block_offset}.")
+    *_, extra_length, _, _, _, block_size = BGZF_HEADER.unpack(header)
+    # The BC subfield is 6 bytes long, anything else in the extra field is
+    # skipped over
+    file.seek(extra_length - 6, os.SEEK_CUR)
+    data_length = block_size + 1 - BGZF_HEADER.size - \
+        (extra_length - 6) - BGZF_FOOTER.size
+    compressed_data = file.read(data_length)
+    _, uncompressed_size = BGZF_FOOTER.unpack(file.read(BGZF_FOOTER.size))
+    data = zlib.decompress(compressed_data, -15)
+    if len(data) != uncompressed_size:
+        raise ValueError(f"BGZF block at offset {block_offset} is corrupt.")
+    return data, block_offset + block_size + 1
+
+
+def iter_blocks(file_path: str) -> Iterator[Tuple[int, bytes]]:
+    """Yields the offset and decompressed data of every non-empty block."""
+    file_size = os.path.getsize(file_path)
+    with open(file_path, "rb") as file:
+        block_offset = 0
+        while block_offset < file_size:
+            data, next_offset = read_block(file, block_offset)
+            if data:
+                yield block_offset, data
+            block_offset = next_offset
+
+
+def _compress_block(data: bytes, compression_level: int) -> bytes:
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -15)
+    compressed_data = compressor.compress(data) + compressor.flush()
+    block_size = BGZF_HEADER.size + len(compressed_data) + BGZF_FOOTER.size
+    header = BGZF_HEADER.pack(
+        0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord("B"), ord("C"), 2,
+        block_size - 1
+    )
+    footer = BGZF_FOOTER.pack(zlib.crc32(data), len(data))
+    return header + compressed_data + footer
+
+
+def compress_file(input_path: str,
+                  output_path: str,
+                  compression_level: int = 6) -> None:
+    """Block gzips a text file, ending blocks on line boundaries wherever a
+    line fits in a block. The output can be read by any gzip reader.
+
+    Args:
+        input_path (str): Path to the plain text file.
+        output_path (str): Path to write the BGZF file to.
+        compression_level (int): zlib compression level (1-9).
+    """
+    with open(input_path, "rb") as input_file, \
+            open(output_path, "wb") as output_file:
+        pending = b""
+        while True:
+            chunk = input_file.read(MAX_BLOCK_DATA_SIZE)
+            pending += chunk
+            while len(pending) >= MAX_BLOCK_DATA_SIZE or \
+                    (not chunk and pending):
+                block_data = pending[:MAX_BLOCK_DATA_SIZE]
+                last_newline = block_data.rfind(b"\n")
+                if chunk and last_newline != -1:
+                    block_data = block_data[:last_newline + 1]
+                output_file.write(
+                    _compress_block(block_data, compression_level))
+                pending = pending[len(block_data):]
+            if not chunk:
+                break
+        output_file.write(EOF_BLOCK)
+
+
+def _line_fields(line: bytes) -> Tuple[str, int, int]:
+    chromosome, start, end = line.split(b"\t", 3)[:3]
+    return chromosome.decode(), int(start), int(end)
+
+
+def _index_lines(block_offset: int,
+                 line_offset: int,
+                 lines: bytes) -> List[IndexEntry]:
+    """Creates one index entry per chromosome for lines starting in a
+    block.
+    """
+    split_lines = [line for line in lines.split(b"\n") if line]
+    first_chromosome = _line_fields(split_lines[0])[0]
+    last_chromosome = _line_fields(split_lines[-1])[0]
+    if first_chromosome == last_chromosome:
+        runs = [(split_lines[0], split_lines[-1])]
+    else:
+        # Only blocks that cross a chromosome boundary need every line
+        # looked at.
+        runs = []
+        run_start = split_lines[0]
+        previous_line = split_lines[0]
+        for line in split_lines[1:]:
+            if not line.startswith(run_start.split(b"\t", 1)[0] + b"\t"):
+                runs.append((run_start, previous_line))
+                run_start = line
+            previous_line = line
+        runs.append((run_start, previous_line))
+    entries = []
+    for first_line, last_line in runs:
+        chromosome, first_start, _ = _line_fields(first_line)
+        _, _, last_end = _line_fields(last_line)
+        entries.append(IndexEntry(
+            block_offset, line_offset, chromosome, first_start, last_end))
+    return entries
+
+
+def build_index(file_path: str) -> List[IndexEntry]:
+    """Scans a BGZF bedgraph or narrow peak file once to find the genomic
+    span of the lines starting in each block.
+
+    Returns:
+        List[IndexEntry]: Entries in file order.
+    """
+    entries = []
+    blocks = iter_blocks(file_path)
+    current = next(blocks, None)
+    line_offset = 0
+    is_first_block = True
+    while current is not None:
+        block_offset, data = current
+        following = next(blocks, None)
+        if is_first_block:
+            # Skip meta data lines at the top of the file
+            while data.startswith((b"track", b"#"), line_offset):
+                line_offset = data.index(b"\n", line_offset) + 1
+            is_first_block = False
+        lines = data[line_offset:]
+        next_line_offset = 0
+        if not data.endswith(b"\n") and following is not None:
+            next_line_offset = following[1].find(b"\n") + 1
+            if next_line_offset == 0:
+                raise ValueError(
+                    f"{file_path} has a line longer than a BGZF block.")
+            lines += following[1][:next_line_offset]
+        if lines:
+            entries.extend(_index_lines(block_offset, line_offset, lines))
+        current = following
+        line_offset = next_line_offset
+    _check_sorted(file_path, entries)
+    return entries
+
+
+def _check_sorted(file_path: str, entries: List[IndexEntry]) -> None:
+    """Region queries pick out consecutive blocks, so each chromosome must
+    be in one piece and in order of position.
+    """
+    finished_chromosomes = set()
+    previous = None
+    for entry in entries:
+        if previous is not None and entry.chromosome == previous.chromosome:
+            is_sorted = entry.first_start >= previous.first_start
+        else:
+            is_sorted = entry.chromosome not in finished_chromosomes
+            if previous is not None:
+                finished_chromosomes.add(previous.chromosome)
+        if not is_sorted:
+            raise ValueError(f"{file_path} is not sorted by chromosome and "
+                             "position, so can't be indexed. Sort it with "
+                             "sort_tracks.py first.")
+        previous = entry
+
+
+def index_path(file_path: str) -> str:
+    # Resolve symbolic links so that linked copies share the same index
+    return os.path.realpath(file_path) + INDEX_SUFFIX
+
+
+def write_index(file_path: str, entries: List[IndexEntry]) -> None:
+    stat = os.stat(file_path)
+    # Jobs in an array often index the same file at the same time, so the
+    # index is written to a file unique to this process and then moved into
+    # place. Readers only ever see a whole index.
+    temporary_path = f"{index_path(file_path)}.{os.getpid()}.tmp"
+    try:
+        with open(temporary_path, "w") as index_file:
+            index_file.write(f"{INDEX_HEADER}\t{stat.st_size}\t"
+                             f"{stat.st_mtime_ns}\t{len(entries)}\n")
+            for entry in entries:
+                index_file.write("\t".join(map(str, entry)) + "\n")
+        os.replace(temporary_path, index_path(file_path))
+    except OSError:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def _read_index(file_path: str) -> List[IndexEntry]:
+    """Reads a saved index, returning an empty list if it is missing, out
+    of date with the BGZF file or malformed (such as one cut short by a job
+    that was killed while writing it).
+    """
+    stat = os.stat(file_path)
+    try:
+        with open(index_path(file_path), "r") as index_file:
+            header = index_file.readline().rstrip("\n").split("\t")
+            if header[:-1] != [INDEX_HEADER,
+                               str(stat.st_size),
+                               str(stat.st_mtime_ns)]:
+                return []
+            entries = []
+            for line in index_file:
+                block_offset, line_offset, chromosome, start, end = \
+                    line.rstrip("\n").split("\t")
+                entries.append(IndexEntry(
+                    int(block_offset),
+                    int(line_offset),
+                    chromosome,
+                    int(start),
+                    int(end)
+                ))
+            if len(entries) != int(header[-1]):
+                return []
+            return entries
+    except (FileNotFoundError, ValueError, UnicodeDecodeError):
+        return []
+
+
+def load_index(file_path: str) -> List[IndexEntry]:
+    """Loads the block index of a BGZF file, building (and saving) it if it
+    doesn't exist yet.
+    """
+    entries = _read_index(file_path)
+    if entries:
+        return entries
+    entries = build_index(file_path)
+    try:
+        write_index(file_path, entries)
+    except OSError:
+        # Read only locations can still be queried, just not cached
+        pass
+    return entries
+
+
+def fetch_region(file_path: str,
+                 chromosome: str,
+                 start: int,
+                 end: int) -> bytes:
+    """Decompresses only the blocks of a BGZF file that hold lines overlapping
+    a region.
+
+    Args:
+        file_path (str): Path to the BGZF file.
+        chromosome (str): Chromosome of the region.
+        start (int): Start of region.
+        end (int): End of region.
+
+    Returns:
+        bytes: Complete lines covering the region. This is a superset of the
+        overlapping lines, as neighbouring lines in the same blocks are kept.
+    """
+    entries = [
+        entry for entry in load_index(file_path)
+        if entry.chromosome == chromosome
+        and entry.first_start <= end
+        and entry.last_end >= start
+    ]
+    if not entries:
+        return b""
+    first_offset = entries[0].block_offset
+    last_offset = entries[-1].block_offset
+    file_size = os.path.getsize(file_path)
+    data = []
+    with open(file_path, "rb") as file:
+        block_offset = first_offset
+        while block_offset <= last_offset:
+            block_data, block_offset = read_block(file, block_offset)
+            data.append(block_data)
+        data[0] = data[0][entries[0].line_offset:]
+        # The last line that starts in the final block may continue into the
+        # blocks after it
+        while not data[-1].endswith(b"\n") and block_offset < file_size:
+            block_data, block_offset = read_block(file, block_offset)
+            if not block_data:
+                continue
+            newline = block_data.find(b"\n")
+            data.append(block_data[:newline + 1] if newline != -1
+                        else block_data)
+    return b"".join(data)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="bgzf",
+        description=("Block gzip bedgraph and narrow peak files and index "
+                     "them for region queries.")
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compress_parser = subparsers.add_parser(
+        "compress",
+        help="Compress a file to <file>.gz and index it."
+    )
+    compress_parser.add_argument("file_path")
+    compress_parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="Keep the uncompressed file after compressing it."
+    )
+    index_parser = subparsers.add_parser(
+        "index",
+        help="(Re)build the block index of a BGZF file."
+    )
+    index_parser.add_argument("file_path")
+    args = parser.parse_args()
+
+    if args.command == "compress":
+        compressed_path = args.file_path + ".gz"
+        compress_file(args.file_path, compressed_path)
+        write_index(compressed_path, build_index(compressed_path))
+        if not args.keep:
+            os.remove(args.file_path)
+    else:
+        write_index(args.file_path, build_index(args.file_path))
@@ -0,0 +1,256 @@
+import numpy as np
+from create_confidence_intervals import calculate_pavlue
+from extract_region import interval_scores_at
+from scipy.special import ndtri
+from typing import NamedTuple, Tuple
+from zoom_track import summarise_bins
+
+DEFAULT_BIN_SIZE = 50
+
+# Starts, ends and scores of the intervals of a track
+Intervals = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+class BinnedMetric(NamedTuple):
+    """
+    Represents the metric of a region calculated with confidence intervals
+    at bin resolution, along with how far the metric could move if each
+    base's lambda were anywhere within the range of its bin.
+    """
+    metric: float
+    error_bound: float
+
+
+class _BiasBins(NamedTuple):
+    """
+    Represents a bias track summarised over the bins of a region, with bases
+    missing from the track given the smallest score in the region (as
+    convert_to_bedbase() does).
+    """
+    minimum: np.ndarray
+    maximum: np.ndarray
+    mean: np.ndarray
+    mean_square: np.ndarray
+
+
+def _bin_edges(start: int, end: int, bin_size: int) -> Tuple[int, int]:
+    """The first bin of a region and the number of bins it overlaps. Bins
+    are aligned to multiples of bin_size, so that regions share them.
+    """
+    first_bin = start // bin_size
+    return first_bin, end // bin_size - first_bin + 1
+
+
+def _bases_in_bins(start: int, end: int, bin_size: int) -> np.ndarray:
+    """The number of bases of the region in each bin (the first and last
+    bins can be partly outside of it).
+    """
+    first_bin, number_of_bins = _bin_edges(start, end, bin_size)
+    bin_starts = (first_bin + np.arange(number_of_bins)) * bin_size
+    return (np.minimum(bin_starts + bin_size, end + 1) -
+            np.maximum(bin_starts, start))
+
+
+def _region_minimum(intervals: Intervals, start: int, end: int) -> float:
+    starts, ends, scores = intervals
+    overlaps_region = (starts <= end) & (ends > start)
+    if not np.any(overlaps_region):
+        return np.nan
+    return scores[overlaps_region].min()
+
+
+def summarise_bias(intervals: Intervals,
+                   start: int,
+                   end: int,
+                   bin_size: int) -> _BiasBins:
+    """Summarises the intervals of a bias track over the bins of a region."""
+    starts, ends, scores = intervals
+    first_bin, number_of_bins = _bin_edges(start, end, bin_size)
+    offset = first_bin * bin_size
+    starts = np.clip(starts, start, end + 1) - offset
+    ends = np.clip(ends, start, end + 1) - offset
+    summary = summarise_bins(starts, ends, scores, bin_size, number_of_bins)
+    covered = summarise_bins(
+        starts, ends, np.ones(len(scores)), bin_size, number_of_bins)["SUM"]
+    squares = summarise_bins(
+        starts, ends, scores ** 2, bin_size, number_of_bins)["SUM"]
+
+    bases = _bases_in_bins(start, end, bin_size)
+    region_minimum = _region_minimum(intervals, start, end)
+    missing = bases - covered
+    is_partly_missing = missing > 0
+    return _BiasBins(
+        minimum=np.where(is_partly_missing,
+                         np.fmin(summary["MIN"], region_minimum),
+                         summary["MIN"]),
+        maximum=np.where(is_partly_missing,
+                         np.fmax(summary["MAX"], region_minimum),
+                         summary["MAX"]),
+        mean=(summary["SUM"] + missing * region_minimum) / bases,
+        mean_square=(squares + missing * region_minimum ** 2) / bases
+    )
+
+
+def binned_standard_errors(bias: _BiasBins,
+                           bases: np.ndarray,
+                           window_size: int = 50,
+                           bin_size: int = DEFAULT_BIN_SIZE) -> np.ndarray:
+    """The bin resolution version of the standard errors worked out by
+    calculate_lambda_ci(). Each bin's window is the bins within
+    window_size // 2 bases of it. The variance of the window is worked out
+    from the bins' means and mean squares, so it still reflects variation
+    within bins. With a bin_size of 1, this is the same as for single bases.
+    """
+    half_window = -(-(window_size // 2) // bin_size)
+    number_of_bins = len(bases)
+    bins = np.arange(number_of_bins)
+    window_starts = np.maximum(bins - half_window, 0)
+    window_ends = np.minimum(bins + half_window + 1, number_of_bins)
+
+    def window_sums(values: np.ndarray) -> np.ndarray:
+        cumulative = np.concatenate(([0], np.cumsum(values)))
+        return cumulative[window_ends] - cumulative[window_starts]
+
+    window_bases = window_sums(bases)
+    window_means = window_sums(bias.mean * bases) / window_bases
+    variances = np.maximum(
+        window_sums(bias.mean_square * bases) / window_bases -
+        window_means ** 2,
+        0
+    )
+    # A base's window never holds more bases than this
+    sample_sizes = np.minimum(window_bases, 2 * (window_size // 2) + 1)
+    return np.sqrt(variances / sample_sizes)
+
+
+def calculate_metric_binned(merged_peaks: Intervals,
+                            unmerged_peaks: Intervals,
+                            reference_bias: Intervals,
+                            reference_coverage: Intervals,
+                            comparison_bias: Intervals,
+                            comparison_coverage: Intervals,
+                            comparison_pvalues: Intervals,
+                            start: int,
+                            end: int,
+                            cutoff: float,
+                            significance: float = 0.95,
+                            window_size: int = 50,
+                            include_merged_peaks: bool = True,
+                            bin_size: int = DEFAULT_BIN_SIZE) -> BinnedMetric:
+    """Approximates the metric over a region for quickly screening many
+    regions.
+
+    The lambda confidence intervals (the slow part of the exact calculation)
+    are worked out for bins of bases from each bin's mean bias. Everything
+    else is exact: the region is split into pieces wherever any track, peak
+    or bin changes, and each piece is looked at once rather than base by
+    base. The error bound comes from redoing this with every lambda at the
+    smallest and largest bias of its bin, giving the fewest and most
+    pseudopeaks there could be (so long as the standard errors are right).
+
+    Args:
+        merged_peaks (Intervals): The reference's merged peaks (their scores
+            aren't used).
+        unmerged_peaks (Intervals): The reference's unmerged peaks.
+        reference_bias (Intervals): The reference's bias track.
+        reference_coverage (Intervals): The reference's coverage track.
+        comparison_bias (Intervals): The comparison's bias track.
+        comparison_coverage (Intervals): The comparison's coverage track.
+        comparison_pvalues (Intervals): The comparison's p-values.
+        start (int): Start of the region.
+        end (int): End of the region (included).
+        cutoff (float): The cutoff used to call peaks in the reference.
+        significance (float): See calculate_lambda_ci().
+        window_size (int): See calculate_lambda_ci().
+        include_merged_peaks (bool): See calculate_metric().
+        bin_size (int): Number of bases in each bin.
+
+    Returns:
+        BinnedMetric: The approximate metric and its error bound.
+    """
+    first_bin, number_of_bins = _bin_edges(start, end, bin_size)
+    tracks = (merged_peaks, unmerged_peaks, reference_coverage,
+              comparison_coverage, comparison_pvalues)
+    breakpoints = np.concatenate(
+        [[start, end + 1],
+         (first_bin + np.arange(1, number_of_bins)) * bin_size] +
+        [edges for starts, ends, _ in tracks for edges in (starts, ends)]
+    )
+    breakpoints = np.unique(np.clip(breakpoints, start, end + 1))
+    piece_starts = breakpoints[:-1]
+    piece_lengths = np.diff(breakpoints)
+    piece_bins = piece_starts // bin_size - first_bin
+
+    peak_type = np.nan_to_num(interval_scores_at(
+        merged_peaks[0],
+        merged_peaks[1],
+        np.ones(len(merged_peaks[0])),
+        piece_starts
+    )) + np.nan_to_num(interval_scores_at(
+        unmerged_peaks[0],
+        unmerged_peaks[1],
+        np.ones(len(unmerged_peaks[0])),
+        piece_starts
+    ))
+    is_peak_before_merging = peak_type == 2
+    is_peak_after_merging = peak_type == 1
+    if include_merged_peaks:
+        number_of_reference_peaks = piece_lengths[peak_type > 1].sum()
+    else:
+        number_of_reference_peaks = piece_lengths[is_peak_after_merging].sum()
+
+    def filled_scores(intervals: Intervals) -> np.ndarray:
+        return np.nan_to_num(interval_scores_at(*intervals, piece_starts),
+                             nan=_region_minimum(intervals, start, end))
+
+    # The criteria for peaks after merging don't involve lambda, so are the
+    # same whichever lambdas are used
+    pvalues_above_cutoff = piece_lengths[
+        (filled_scores(comparison_pvalues) > cutoff) &
+        is_peak_after_merging
+    ].sum()
+    reference_reads = filled_scores(reference_coverage)
+    comparison_reads = filled_scores(comparison_coverage)
+
+    bases = _bases_in_bins(start, end, bin_size)
+    z_a = ndtri(significance)
+    reference_bins = summarise_bias(reference_bias, start, end, bin_size)
+    comparison_bins = summarise_bias(comparison_bias, start, end, bin_size)
+    reference_errors = z_a * binned_standard_errors(
+        reference_bins, bases, window_size, bin_size)
+    comparison_errors = z_a * binned_standard_errors(
+        comparison_bins, bases, window_size, bin_size)
+    comparison_minimum = np.nanmin(comparison_bins.minimum)
+
+    def count_pseudopeaks(reference_lambdas: np.ndarray,
+                          comparison_lambdas: np.ndarray) -> int:
+        # The same criteria as determine_psuedopeaks(), for each piece
+        reference_lower_pvalues = np.nan_to_num(calculate_pavlue(
+            reference_reads,
+            (reference_lambdas + reference_errors)[piece_bins]
+        ))
+        comparison_upper_pvalues = np.nan_to_num(calculate_pavlue(
+            comparison_reads,
+            np.clip(comparison_lambdas - comparison_errors,
+                    a_min=comparison_minimum, a_max=None)[piece_bins]
+        ))
+        is_pseudopeak = comparison_upper_pvalues > reference_lower_pvalues
+        is_pseudopeak &= is_peak_before_merging
+        return piece_lengths[is_pseudopeak].sum() + pvalues_above_cutoff
+
+    # A higher lambda gives a lower p-value, so the most pseudopeaks come
+    # from the largest reference lambdas and smallest comparison lambdas
+    number_of_pseudopeaks = count_pseudopeaks(
+        reference_bins.mean, comparison_bins.mean)
+    fewest_pseudopeaks = count_pseudopeaks(
+        reference_bins.minimum, comparison_bins.maximum)
+    most_pseudopeaks = count_pseudopeaks(
+        reference_bins.maximum, comparison_bins.minimum)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        metric = np.divide(number_of_pseudopeaks, number_of_reference_peaks)
+        error_bound = np.divide(
+            max(most_pseudopeaks - number_of_pseudopeaks,
+                number_of_pseudopeaks - fewest_pseudopeaks),
+            number_of_reference_peaks
+        )
+    return BinnedMetric(metric=float(metric), error_bound=float(error_bound))
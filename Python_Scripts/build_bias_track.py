@@ -0,0 +1,299 @@
+import argparse
+import sys
+import numpy as np
+import pandas as pd
+from IO import (
+    format_chromosome_lines,
+    inspect_table,
+    read_column_chunks
+)
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+# macs3 filterdup writes single end reads as 6 column BED files (strand in
+# the last column) and paired end reads as 3 column BEDPE files.
+READ_DTYPES = {
+    "CHR": "object",
+    "START": "int64",
+    "END": "int64"
+}
+STRAND_COLUMN_INDEX = 5
+STRAND_DTYPES = {**READ_DTYPES, "STRAND": "object"}
+SCORE_FORMAT = "%.5f"
+# Lines of the reads file parsed (and lines of the track formatted) at a
+# time, which keeps the text of only a few megabytes of lines in memory
+CHUNK_SIZE = 1 << 16
+
+
+class Reads(NamedTuple):
+    """
+    Represents the reads of one chromosome by the span that macs3 pileup -B
+    extends in both directions. Single end reads are represented by their 5'
+    end (so start and end are equal). Paired end reads are represented by
+    their fragment, which macs3 pileup never extends.
+    """
+    starts: np.ndarray
+    ends: np.ndarray
+    is_paired: bool
+
+
+class BiasIntervals(NamedTuple):
+    """
+    Represents the bias track of one chromosome.
+    """
+    chromosome: str
+    starts: np.ndarray
+    ends: np.ndarray
+    scores: np.ndarray
+
+
+# A step function holds the value values[i] over [positions[i],
+# positions[i + 1]) and 0 everywhere else.
+StepFunction = Tuple[np.ndarray, np.ndarray]
+
+
+def read_reads(file_path: str,
+               is_paired: bool,
+               parser: str = "auto") -> Dict[str, Reads]:
+    """Reads the filtered reads written by macs3 filterdup.
+
+    Args:
+        file_path (str): Path to the BED or BEDPE file of reads.
+        is_paired (bool): Whether the file is BEDPE.
+        parser (str): Which backend to read the file with (see
+            IO.read_column_chunks).
+
+    Returns:
+        Dict[str, Reads]: The reads of each chromosome, in file order.
+    """
+    skip_rows, _ = inspect_table(file_path)
+    if is_paired:
+        dtypes = READ_DTYPES
+        column_indices = None
+    else:
+        dtypes = STRAND_DTYPES
+        column_indices = [0, 1, 2, STRAND_COLUMN_INDEX]
+    # Reads are grouped by chromosome a chunk at a time, so that only the
+    # positions of every read are held rather than their text columns
+    anchor_starts: Dict[str, List[np.ndarray]] = {}
+    anchor_ends: Dict[str, List[np.ndarray]] = {}
+    for columns in read_column_chunks(
+            file_path, dtypes, skip_rows, CHUNK_SIZE, parser,
+            column_indices):
+        if is_paired:
+            chunk_starts = columns["START"]
+            chunk_ends = columns["END"]
+        else:
+            # The 5' end of a read on the minus strand is its end
+            chunk_starts = np.where(
+                columns["STRAND"] == "-", columns["END"], columns["START"])
+            chunk_ends = chunk_starts
+        chromosome_codes, chromosomes = pd.factorize(columns["CHR"])
+        read_order = np.argsort(chromosome_codes, kind="stable")
+        boundaries = np.searchsorted(
+            chromosome_codes[read_order], np.arange(len(chromosomes) + 1))
+        for code, chromosome in enumerate(chromosomes):
+            chromosome_reads = \
+                read_order[boundaries[code]:boundaries[code + 1]]
+            anchor_starts.setdefault(chromosome, []).append(
+                chunk_starts[chromosome_reads])
+            anchor_ends.setdefault(chromosome, []).append(
+                chunk_ends[chromosome_reads])
+    return {
+        chromosome: Reads(
+            np.concatenate(anchor_starts[chromosome]),
+            np.concatenate(anchor_ends[chromosome]),
+            is_paired
+        )
+        for chromosome in anchor_starts
+    }
+
+
+def pileup(reads: Reads, extension: int) -> StepFunction:
+    """Counts the reads covering each position after extending them by the
+    same amount in both directions (as macs3 pileup -B does).
+
+    Args:
+        reads (Reads): Reads of one chromosome.
+        extension (int): Bases to extend single end reads by on each side.
+            Paired end fragments are not extended.
+
+    Returns:
+        StepFunction: The pileup.
+    """
+    if reads.is_paired:
+        extension = 0
+    starts = np.maximum(reads.starts - extension, 0)
+    ends = reads.ends + extension
+    positions, inverse = np.unique(
+        np.concatenate((starts, ends)), return_inverse=True)
+    changes = np.bincount(
+        inverse,
+        weights=np.repeat([1.0, -1.0], len(starts)),
+        minlength=len(positions)
+    )
+    return positions, np.cumsum(changes)
+
+
+def step_function_maximum(step_functions: List[StepFunction]
+                          ) -> StepFunction:
+    """The largest value of any of the step functions at every position."""
+    # Sorted and deduplicated by hand, as np.unique() can hash rather than
+    # sort, which is several times slower for arrays this large
+    positions = np.concatenate(
+        [step_positions for step_positions, _ in step_functions])
+    positions.sort()
+    positions = positions[np.concatenate(
+        ([True], positions[1:] != positions[:-1]))]
+    maximum = np.zeros(len(positions))
+    for step_positions, step_values in step_functions:
+        steps = np.searchsorted(step_positions, positions, side="right") - 1
+        maximum = np.maximum(
+            maximum,
+            np.where(steps >= 0, step_values[np.maximum(steps, 0)], 0)
+        )
+    return positions, maximum
+
+
+def build_bias_track(reads: Dict[str, Reads],
+                     fragment_length: int,
+                     number_of_reads: int,
+                     small_local_size: int,
+                     large_local_size: int,
+                     genome_size: int,
+                     read_ratio: float = 1.0) -> Iterator[BiasIntervals]:
+    """Builds the MACS local lambda (bias) track in one pass.
+
+    The fragment, small local and large local pileups are computed in memory
+    and combined per chromosome. This gives the same track as running macs3
+    pileup -B three times followed by macs3 bdgopt and bdgcmp. Chromosomes
+    are built one at a time, so that each can be written out before the next
+    is started.
+
+    Args:
+        reads (Dict[str, Reads]): Reads of the background sample (control if
+            there is one, treatment otherwise).
+        fragment_length (int): Fragment length of the background sample.
+        number_of_reads (int): Number of reads in the background sample.
+        small_local_size (int): Size of the small local window (slocal).
+        large_local_size (int): Size of the large local window (llocal).
+        genome_size (int): Effective genome size.
+        read_ratio (float): The treatment to control read ratio that the
+            track is scaled by (1 when there is no control).
+
+    Yields:
+        BiasIntervals: The bias track of each chromosome.
+    """
+    global_background = number_of_reads * fragment_length / genome_size
+    # Chromosomes are written in sorted order, as MACS writes them
+    for chromosome, chromosome_reads in sorted(reads.items()):
+        fragment = pileup(chromosome_reads, fragment_length // 2)
+        if chromosome_reads.is_paired:
+            # Paired end fragments are never extended, so all three pileups
+            # are the same
+            small_local = large_local = fragment
+        else:
+            small_local = pileup(chromosome_reads, small_local_size // 2)
+            large_local = pileup(chromosome_reads, large_local_size // 2)
+        positions, values = step_function_maximum([
+            (small_local[0], small_local[1] *
+             fragment_length / small_local_size),
+            (large_local[0], large_local[1] *
+             fragment_length / large_local_size),
+            fragment
+        ])
+        if positions[0] > 0:
+            positions = np.insert(positions, 0, 0)
+            values = np.insert(values, 0, 0)
+        # The value at the last position only applies beyond the track
+        values = np.maximum(values[:-1], global_background) * read_ratio
+
+        # Merge neighbouring intervals with the same score
+        is_new_interval = np.concatenate(([True], values[1:] != values[:-1]))
+        interval_starts = positions[:-1][is_new_interval]
+        yield BiasIntervals(
+            chromosome,
+            interval_starts,
+            np.append(interval_starts[1:], positions[-1]),
+            values[is_new_interval]
+        )
+
+
+def write_bias_track(bias_track: Iterable[BiasIntervals],
+                     file_path: str,
+                     float_format: str = SCORE_FORMAT,
+                     chunk_size: int = CHUNK_SIZE) -> None:
+    """Writes each chromosome of the bias track as soon as it is built, at
+    most chunk_size lines at a time.
+    """
+    with open(file_path, "w") as file:
+        for intervals in bias_track:
+            for first in range(0, len(intervals.starts), chunk_size):
+                chunk = slice(first, first + chunk_size)
+                file.write(format_chromosome_lines(
+                    intervals.chromosome,
+                    intervals.starts[chunk],
+                    intervals.ends[chunk],
+                    intervals.scores[chunk],
+                    float_format
+                ))
+
+
+def get_read_ratio(treatment_reads: Optional[int],
+                   control_reads: int) -> float:
+    if treatment_reads is None:
+        return 1.0
+    return treatment_reads / control_reads
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="BuildBiasTrack",
+        description=("Build the bias track (local lambda) of a sample from "
+                     "its filtered reads without intermediate files.")
+    )
+    parser.add_argument(
+        "--paired",
+        action="store_true",
+        help="The reads file is BEDPE (paired end fragments)."
+    )
+    parser.add_argument(
+        "--treatment_reads",
+        type=int,
+        help=("Number of treatment reads. Give this when the reads file is "
+              "a control to scale the track by the treatment to control "
+              "read ratio.")
+    )
+    parser.add_argument(
+        "--parser",
+        choices=["auto", "pyarrow", "pandas"],
+        default="auto",
+        help="Backend to read the reads file with."
+    )
+    parser.add_argument("reads_file", help="Output of macs3 filterdup.")
+    parser.add_argument("fragment_length", type=int)
+    parser.add_argument("number_of_reads", type=int)
+    parser.add_argument("small_local_size", type=int)
+    parser.add_argument("large_local_size", type=int)
+    parser.add_argument("genome_size", type=float)
+    parser.add_argument("output_file")
+    args = parser.parse_args()
+
+    try:
+        reads = read_reads(args.reads_file, args.paired, args.parser)
+    except (FileNotFoundError, IOError) as error:
+        print(f"Could not read {args.reads_file}: {error}")
+        sys.exit(1)
+    bias_track = build_bias_track(
+        reads,
+        args.fragment_length,
+        args.number_of_reads,
+        args.small_local_size,
+        args.large_local_size,
+        args.genome_size,
+        get_read_ratio(args.treatment_reads, args.number_of_reads)
+    )
+    try:
+        write_bias_track(bias_track, args.output_file)
+    except (FileNotFoundError, IOError) as error:
+        print(f"Could not write {args.output_file}: {error}")
+        sys.exit(1)
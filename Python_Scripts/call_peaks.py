@@ -0,0 +1,225 @@
+import argparse
+import sys
+import numpy as np
+import pandas as pd
+from IO import BedGraph
+from typing import Dict, List, Sequence, Tuple
+
+# Defaults used by macs3 bdgpeakcall
+DEFAULT_MIN_LENGTH = 200
+DEFAULT_MAX_GAP = 30
+
+
+def group_into_peaks(chromosome_codes: np.ndarray,
+                     starts: np.ndarray,
+                     ends: np.ndarray,
+                     max_gap: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Groups intervals (sorted by position) that are on the same chromosome
+    and no more than max_gap apart into peaks.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Index of the first and last interval
+        of each peak.
+    """
+    if len(starts) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    is_new_peak = np.ones(len(starts), dtype=bool)
+    is_new_peak[1:] = (
+        (chromosome_codes[1:] != chromosome_codes[:-1]) |
+        (starts[1:] - ends[:-1] > max_gap)
+    )
+    first_intervals = np.flatnonzero(is_new_peak)
+    last_intervals = np.append(first_intervals[1:] - 1, len(starts) - 1)
+    return first_intervals, last_intervals
+
+
+def _merge_equal_scores(chromosomes: np.ndarray,
+                        starts: np.ndarray,
+                        ends: np.ndarray,
+                        scores: np.ndarray
+                        ) -> Tuple[np.ndarray, ...]:
+    """Joins neighbouring intervals with the same score, as MACS does when it
+    loads a bedgraph (this moves the summits of flat topped peaks).
+    """
+    is_new_run = np.ones(len(starts), dtype=bool)
+    is_new_run[1:] = (
+        (chromosomes[1:] != chromosomes[:-1]) |
+        (scores[1:] != scores[:-1])
+    )
+    run_starts = np.flatnonzero(is_new_run)
+    run_ends = np.append(run_starts[1:] - 1, len(starts) - 1)
+    return (chromosomes[run_starts],
+            starts[run_starts],
+            ends[run_ends],
+            scores[run_starts])
+
+
+def call_peaks(pvalues: BedGraph,
+               cutoff: float,
+               min_length: int = DEFAULT_MIN_LENGTH,
+               max_gaps: Sequence[int] = (DEFAULT_MAX_GAP,)
+               ) -> Dict[int, pd.DataFrame]:
+    """Calls peaks on a p-value track for several maximum gaps at once,
+    giving the same peaks as running macs3 bdgpeakcall once per gap.
+
+    The intervals scoring above the cutoff are found once, then grouped into
+    peaks for each gap.
+
+    Args:
+        pvalues (BedGraph): The p-value track (sorted by position within each
+            chromosome).
+        cutoff (float): Intervals must score above this to be in a peak.
+        min_length (int): Peaks shorter than this are discarded.
+        max_gaps (Sequence[int]): Intervals this close together (or closer)
+            are merged into one peak.
+
+    Returns:
+        Dict[int, pd.DataFrame]: The peaks (CHR, START, END, SCORE and
+        SUMMIT) for each gap, sorted by chromosome name.
+    """
+    # MACS stores scores as single precision floats
+    chromosomes, starts, ends, scores = _merge_equal_scores(
+        pvalues.get("CHR").to_numpy(),
+        pvalues.get("START").to_numpy(),
+        pvalues.get("END").to_numpy(),
+        pvalues.get("SCORE").to_numpy().astype(np.float32)
+    )
+    chromosome_order = np.argsort(chromosomes, kind="stable")
+    above_cutoff = chromosome_order[scores[chromosome_order] > cutoff]
+    chromosomes = chromosomes[above_cutoff]
+    chromosome_codes = pd.factorize(chromosomes)[0]
+    starts = starts[above_cutoff]
+    ends = ends[above_cutoff]
+    scores = scores[above_cutoff]
+    # Summits are placed in the middle of the highest scoring intervals
+    midpoints = (starts + ends) // 2
+
+    peaks = {}
+    for max_gap in max_gaps:
+        first_intervals, last_intervals = group_into_peaks(
+            chromosome_codes, starts, ends, max_gap)
+        is_long_enough = \
+            ends[last_intervals] - starts[first_intervals] >= min_length
+        first_intervals = first_intervals[is_long_enough]
+        last_intervals = last_intervals[is_long_enough]
+        interval_counts = last_intervals - first_intervals + 1
+        peak_ids = np.repeat(np.arange(len(first_intervals)), interval_counts)
+        peak_intervals = (
+            np.arange(len(peak_ids)) -
+            np.repeat(np.cumsum(interval_counts) - interval_counts,
+                      interval_counts) +
+            np.repeat(first_intervals, interval_counts)
+        )
+        peak_scores = scores[peak_intervals]
+        summit_scores = np.maximum.reduceat(
+            peak_scores, np.cumsum(interval_counts) - interval_counts
+        ) if len(first_intervals) else np.empty(0, dtype=np.float32)
+
+        # When several intervals share the highest score, MACS picks the
+        # middle one (the earlier one if there is an even number of them)
+        is_summit = peak_scores == summit_scores[peak_ids]
+        summit_counts = np.bincount(
+            peak_ids[is_summit], minlength=len(first_intervals))
+        summit_ranks = np.cumsum(is_summit) - np.repeat(
+            np.cumsum(summit_counts) - summit_counts, interval_counts)
+        is_chosen_summit = is_summit & (
+            summit_ranks == (summit_counts[peak_ids] + 1) // 2)
+        summits = np.empty(len(first_intervals), dtype=np.int64)
+        summits[peak_ids[is_chosen_summit]] = \
+            midpoints[peak_intervals[is_chosen_summit]]
+
+        peaks[max_gap] = pd.DataFrame({
+            "CHR": chromosomes[first_intervals],
+            "START": starts[first_intervals],
+            "END": ends[last_intervals],
+            "SCORE": summit_scores,
+            "SUMMIT": summits
+        })
+    return peaks
+
+
+def write_narrow_peak(peaks: pd.DataFrame, file_path: str, name: str) -> None:
+    """Writes peaks in the narrowPeak format used by macs3 bdgpeakcall
+    (including its track line and peak names).
+
+    Args:
+        peaks (pd.DataFrame): Peaks from call_peaks().
+        file_path (str): Path of the file to write.
+        name (str): Name of the track, peaks are named <name>_narrowPeak<n>.
+    """
+    narrow_peak = pd.DataFrame({
+        "CHR": peaks["CHR"],
+        "START": peaks["START"],
+        "END": peaks["END"],
+        "NAME": [
+            f"{name}_narrowPeak{number}"
+            for number in range(1, len(peaks) + 1)
+        ],
+        "SCORE": (10 * peaks["SCORE"].to_numpy(np.float64)).astype(np.int64),
+        "STRAND": ".",
+        # bdgpeakcall doesn't calculate fold changes, p-values or q-values
+        "FOLD_CHANGE": 0,
+        "PVALUE": 0,
+        "QVALUE": 0,
+        "SUMMIT": peaks["SUMMIT"] - peaks["START"]
+    })
+    with open(file_path, "w") as file:
+        file.write(f'track type=narrowPeak name="{name}" '
+                   f'description="{name}" nextItemButton=on\n')
+        narrow_peak.to_csv(file, sep="\t", header=False, index=False)
+
+
+def _parse_outputs(outputs: List[List[str]]) -> Dict[int, str]:
+    parsed_outputs = {}
+    for max_gap, file_path in outputs:
+        if not max_gap.isdigit():
+            raise ValueError(f"Maximum gap must be a non-negative integer, "
+                             f"got {max_gap}.")
+        parsed_outputs[int(max_gap)] = file_path
+    return parsed_outputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="CallPeaks",
+        description=("Call peaks on a p-value track, writing one narrowPeak "
+                     "file per maximum gap from a single pass over the "
+                     "track.")
+    )
+    parser.add_argument(
+        "--min_length",
+        type=int,
+        default=DEFAULT_MIN_LENGTH,
+        help="Minimum length of a peak."
+    )
+    parser.add_argument(
+        "--output",
+        nargs=2,
+        action="append",
+        required=True,
+        metavar=("MAX_GAP", "FILE"),
+        help=("Maximum gap between regions that are merged into one peak, "
+              "and the file to write these peaks to. Can be given more than "
+              "once.")
+    )
+    parser.add_argument("pvalue_file", help="The p-value bedgraph file.")
+    parser.add_argument("cutoff", type=float)
+    args = parser.parse_args()
+
+    try:
+        outputs = _parse_outputs(args.output)
+    except ValueError as error:
+        print(error)
+        sys.exit(1)
+    pvalues = BedGraph.read_from_file(args.pvalue_file)
+    if pvalues is None:
+        sys.exit(1)
+    peaks = call_peaks(
+        pvalues,
+        args.cutoff,
+        min_length=args.min_length,
+        max_gaps=list(outputs)
+    )
+    for max_gap, file_path in outputs.items():
+        # Named after the output file, as bdgpeakcall does
+        write_narrow_peak(peaks[max_gap], file_path, file_path)
@@ -0,0 +1,186 @@
+import json
+import os
+import threading
+from file_digests import FileDigests, hash_values
+from typing import Dict, List, Optional
+
+
+class Checkpoints:
+    """
+    Records which stages of a pipeline have finished, the fingerprint of
+    everything each stage depended on and the digests of the files it wrote.
+
+    A stage's fingerprint covers its parameters, the contents of its input
+    files and the contents of the files written by the stages it depends on.
+    A stage only needs to be rerun if its fingerprint changes or its outputs
+    have changed since it last ran. Because upstream outputs are compared by
+    content, a rerun stage that writes identical files doesn't cause the
+    stages after it to rerun.
+
+    An output that has been replaced by a compressed copy (see
+    record_compressed()) still counts as unchanged while the compressed copy
+    is, so compressing the files of a finished pipeline doesn't cause the
+    stages that wrote them to rerun.
+
+    The manifest is saved after every change, so an interrupted pipeline can
+    pick up from the last stage that finished.
+    """
+
+    def __init__(self, manifest_path: str):
+        """
+        Loads the manifest of a previous run, if there is one.
+
+        Args:
+            manifest_path (str): Path of the JSON manifest.
+        """
+        self.manifest_path = manifest_path
+        self._lock = threading.Lock()
+        self._stages: Dict[str, dict] = {}
+        self._files = FileDigests()
+        # Compressed copies keyed by the path of the file they replaced
+        self._compressed: Dict[str, dict] = {}
+        try:
+            with open(manifest_path, "r") as manifest_file:
+                manifest = json.load(manifest_file)
+            self._stages = manifest["stages"]
+            self._files = FileDigests(manifest["files"])
+            self._compressed = manifest.get("compressed", {})
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass
+
+    def _save(self) -> None:
+        # Written to a temporary file first so that a job killed mid write
+        # doesn't leave a corrupt manifest behind
+        temporary_path = f"{self.manifest_path}.tmp"
+        with open(temporary_path, "w") as manifest_file:
+            json.dump({"stages": self._stages,
+                       "files": self._files.entries(),
+                       "compressed": self._compressed},
+                      manifest_file, indent=1, sort_keys=True)
+        os.replace(temporary_path, self.manifest_path)
+
+    def file_digest(self, file_path: str) -> Optional[str]:
+        """The digest of a file's contents, or None if it doesn't exist."""
+        try:
+            return self._files.digest(file_path)
+        except FileNotFoundError:
+            return None
+
+    def compressed_path(self, file_path: str) -> Optional[str]:
+        """The path of the compressed copy that replaced a file, or None if
+        there isn't one or it has changed since it was recorded.
+        """
+        with self._lock:
+            compressed = self._compressed.get(os.path.realpath(file_path))
+        if compressed is None or self.file_digest(compressed["path"]) != \
+                compressed["compressed_digest"]:
+            return None
+        return compressed["path"]
+
+    def output_digest(self, file_path: str) -> Optional[str]:
+        """The digest of a file's contents. If the file has been replaced by
+        a compressed copy that is unchanged, this is the digest the file had
+        when it was compressed.
+        """
+        digest = self.file_digest(file_path)
+        if digest is not None or self.compressed_path(file_path) is None:
+            return digest
+        with self._lock:
+            return self._compressed[os.path.realpath(file_path)]["digest"]
+
+    def record_compressed(self, file_path: str, compressed_path: str) -> None:
+        """Records that a file is about to be replaced by a compressed copy
+        of it, fingerprinting both.
+        """
+        digest = self.file_digest(file_path)
+        compressed_digest = self.file_digest(compressed_path)
+        for path, path_digest in ((file_path, digest),
+                                  (compressed_path, compressed_digest)):
+            if path_digest is None:
+                raise FileNotFoundError(f"{path} does not exist.")
+        with self._lock:
+            self._compressed[os.path.realpath(file_path)] = {
+                "path": os.path.realpath(compressed_path),
+                "digest": digest,
+                "compressed_digest": compressed_digest
+            }
+            self._save()
+
+    def fingerprint(self,
+                    stage_name: str,
+                    parameters: Dict[str, str],
+                    input_files: List[str],
+                    dependencies: List[str]) -> str:
+        """Fingerprints everything that a stage's outputs depend on.
+
+        Args:
+            stage_name (str): Name of the stage.
+            parameters (Dict[str, str]): Values of the config variables (and
+                values found by earlier stages) that the stage uses.
+            input_files (List[str]): Files from outside of the pipeline that
+                the stage reads.
+            dependencies (List[str]): Stages whose outputs the stage reads.
+                These must have been recorded already.
+
+        Returns:
+            str: The fingerprint.
+        """
+        values = [stage_name]
+        for name in sorted(parameters):
+            values.extend([name, parameters[name]])
+        for file_path in input_files:
+            values.extend([file_path, str(self.file_digest(file_path))])
+        with self._lock:
+            for dependency in sorted(dependencies):
+                values.append(dependency)
+                for output, digest in sorted(
+                        self._stages[dependency]["outputs"].items()):
+                    values.extend([output, digest])
+        return hash_values(values)
+
+    def completed_run(self,
+                      stage_name: str,
+                      fingerprint: str) -> Optional[Dict[str, str]]:
+        """Finds a previous run of a stage that can be reused.
+
+        Returns:
+            Optional[Dict[str, str]]: The values the stage added to the
+            context when it ran, or None if the stage needs to be rerun.
+        """
+        with self._lock:
+            record = self._stages.get(stage_name)
+        if record is None or record["fingerprint"] != fingerprint:
+            return None
+        for output, digest in record["outputs"].items():
+            if self.output_digest(output) != digest:
+                return None
+        return record["context"]
+
+    def invalidate(self, stage_name: str) -> None:
+        """Forgets a stage, so that it reruns if the pipeline is stopped
+        before it finishes.
+        """
+        with self._lock:
+            if self._stages.pop(stage_name, None) is not None:
+                self._save()
+
+    def record(self,
+               stage_name: str,
+               fingerprint: str,
+               outputs: List[str],
+               context_updates: Dict[str, str]) -> None:
+        """Records a stage that has just finished."""
+        digests = {}
+        for output in outputs:
+            digest = self.file_digest(output)
+            if digest is None:
+                raise FileNotFoundError(
+                    f"{stage_name} did not write {output}.")
+            digests[os.path.realpath(output)] = digest
+        with self._lock:
+            self._stages[stage_name] = {
+                "fingerprint": fingerprint,
+                "outputs": digests,
+                "context": context_updates
+            }
+            self._save()
@@ -0,0 +1,276 @@
+import numpy as np
+from create_confidence_intervals import (
+    ConfidenceInterval,
+    calculate_lambda_ci,
+    calculate_pvalue_ci
+)
+from determine_metric import count_peaks, metric_from_counts
+from extract_region import interval_scores_at_bases
+from IO import (
+    BEDGRAPH_DTYPES,
+    Bed,
+    Region,
+    SortOrderCheck,
+    read_region_chunks
+)
+from typing import NamedTuple
+
+# Number of bases looked at in one go
+DEFAULT_BASE_CHUNK_SIZE = 1_000_000
+
+
+class ComparisonFiles(NamedTuple):
+    """
+    Represents the files that peak_compare.py reads.
+    """
+    reference_merged_peaks: str
+    reference_unmerged_peaks: str
+    reference_bias_track: str
+    reference_coverage_track: str
+    comparison_bias_track: str
+    comparison_coverage_track: str
+    comparison_pvalues: str
+
+
+class _RegionTrack:
+    """
+    Streams the intervals of a bedgraph file that overlap a region, so that
+    the scores of consecutive stretches of bases can be looked up without
+    holding the whole region in memory. Only the blocks around the region are
+    decompressed for BGZF files. The file must be sorted by chromosome name
+    and then position (UnsortedError is raised if it isn't).
+    """
+
+    def __init__(self,
+                 file_path: str,
+                 chromosome: str,
+                 start: int,
+                 end: int,
+                 parser: str = "auto"):
+        self._chunks = read_region_chunks(
+            file_path, BEDGRAPH_DTYPES, Region(chromosome, start, end),
+            parser=parser)
+        self.chromosome = chromosome
+        self.start = start
+        self.end = end
+        self.columns = {
+            column: np.empty(0, dtype=dtype)
+            for column, dtype in BEDGRAPH_DTYPES.items()
+            if column != "CHR"
+        }
+        self.is_exhausted = False
+        self._order = SortOrderCheck(file_path)
+
+    def _read_past(self, base: int) -> None:
+        """Reads chunks until an interval ending after base is buffered."""
+        while not self.is_exhausted and (
+                len(self.columns["END"]) == 0 or
+                self.columns["END"][-1] <= base):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self.is_exhausted = True
+                break
+            self._order.update(chunk["CHR"], chunk["START"])
+            on_chromosome = chunk["CHR"] == self.chromosome
+            overlaps_region = on_chromosome & \
+                (chunk["START"] <= self.end) & (chunk["END"] > self.start)
+            self.columns = {
+                column: np.concatenate(
+                    (values, chunk[column][overlaps_region]))
+                for column, values in self.columns.items()
+            }
+            # Nothing after this can overlap the region
+            if np.any(on_chromosome & (chunk["START"] > self.end)):
+                self.is_exhausted = True
+
+    def scores(self, first_base: int, last_base: int) -> np.ndarray:
+        """The score of each base from first_base to last_base (inclusive),
+        NaN for bases not in the file. Calls must not go backwards.
+        """
+        self._read_past(last_base)
+        finished_rows = int(np.searchsorted(
+            self.columns["END"], first_base, side="right"))
+        self.columns = {
+            column: values[finished_rows:]
+            for column, values in self.columns.items()
+        }
+        return interval_scores_at_bases(
+            self.columns["START"],
+            self.columns["END"],
+            self.columns["SCORE"],
+            first_base,
+            last_base
+        )
+
+
+def region_minimum(file_path: str,
+                   chromosome: str,
+                   start: int,
+                   end: int,
+                   parser: str = "auto") -> float:
+    """The smallest score of a bedgraph file over a region (streamed, so
+    that it can be found before the region is split into chunks). Only the
+    blocks around the region are decompressed for BGZF files.
+    """
+    minimum = np.nan
+    for chunk in read_region_chunks(
+            file_path, BEDGRAPH_DTYPES, Region(chromosome, start, end),
+            parser=parser):
+        overlaps_region = (chunk["CHR"] == chromosome) & \
+            (chunk["START"] <= end) & (chunk["END"] > start)
+        if np.any(overlaps_region):
+            minimum = np.fmin(minimum, chunk["SCORE"][overlaps_region].min())
+    return minimum
+
+
+class _SampleTracks:
+    """
+    The bias and coverage tracks of a sample, read a chunk at a time.
+    """
+
+    def __init__(self,
+                 bias_track_file: str,
+                 coverage_track_file: str,
+                 chromosome: str,
+                 start: int,
+                 end: int):
+        self.bias = _RegionTrack(bias_track_file, chromosome, start, end)
+        self.coverage = _RegionTrack(
+            coverage_track_file, chromosome, start, end)
+        # Both are needed for the whole region before any chunk can be
+        # calculated, so they are found with a separate pass of each file
+        self.bias_minimum = region_minimum(
+            bias_track_file, chromosome, start, end)
+        self.coverage_minimum = region_minimum(
+            coverage_track_file, chromosome, start, end)
+
+    def pvalue_ci(self,
+                  chunk_start: int,
+                  chunk_end: int,
+                  halo_start: int,
+                  halo_end: int,
+                  significance: float,
+                  window_size: int) -> ConfidenceInterval:
+        """The p-value confidence intervals of a chunk, calculated from the
+        bias track over the chunk and its halo.
+        """
+        lambdas = np.nan_to_num(
+            self.bias.scores(halo_start, halo_end), nan=self.bias_minimum)
+        lambda_ci = calculate_lambda_ci(
+            lambdas,
+            significance,
+            window_size,
+            minimum_lambda=self.bias_minimum
+        )
+        chunk = slice(chunk_start - halo_start, chunk_end - halo_start + 1)
+        reads = np.nan_to_num(
+            self.coverage.scores(chunk_start, chunk_end),
+            nan=self.coverage_minimum
+        )
+        return calculate_pvalue_ci(
+            reads,
+            ConfidenceInterval(lower=lambda_ci.lower[chunk],
+                               upper=lambda_ci.upper[chunk])
+        )
+
+
+def _peak_bases(peaks: Bed, first_base: int, last_base: int) -> np.ndarray:
+    """1 for bases within a peak, 0 for those that aren't."""
+    return np.nan_to_num(interval_scores_at_bases(
+        peaks.get("START").to_numpy(),
+        peaks.get("END").to_numpy(),
+        np.ones(len(peaks.get())),
+        first_base,
+        last_base
+    ), nan=0)
+
+
+def calculate_metric_in_chunks(files: ComparisonFiles,
+                               chromosome: str,
+                               start: int,
+                               end: int,
+                               cutoff: float,
+                               significance: float = 0.95,
+                               window_size: int = 50,
+                               include_merged_peaks: bool = True,
+                               chunk_size: int = DEFAULT_BASE_CHUNK_SIZE
+                               ) -> float:
+    """Calculates the metric over a region a chunk of bases at a time, so
+    that memory use doesn't grow with the length of the region.
+
+    Each chunk's confidence intervals are calculated with a halo of
+    window_size // 2 bases on either side, so the windows of bases near the
+    edge of a chunk are the same as they would be for the whole region. Only
+    the running counts of peaks and pseudopeaks are kept between chunks. The
+    result is the same as peak_compare.main() gives.
+
+    Args:
+        files (ComparisonFiles): The files to compare.
+        chromosome (str): Chromosome of the region.
+        start (int): Start of the region.
+        end (int): End of the region (included).
+        cutoff (float): The cutoff used to call peaks in the reference.
+        significance (float): See calculate_lambda_ci().
+        window_size (int): See calculate_lambda_ci().
+        include_merged_peaks (bool): See calculate_metric().
+        chunk_size (int): Number of bases in each chunk.
+
+    Returns:
+        float: The metric.
+    """
+    # Peaks are few compared to bases, so they are read in one go
+    merged_peaks = Bed.read_region(
+        files.reference_merged_peaks, chromosome, start, end)
+    unmerged_peaks = Bed.read_region(
+        files.reference_unmerged_peaks, chromosome, start, end)
+    reference = _SampleTracks(
+        files.reference_bias_track,
+        files.reference_coverage_track,
+        chromosome,
+        start,
+        end
+    )
+    comparison = _SampleTracks(
+        files.comparison_bias_track,
+        files.comparison_coverage_track,
+        chromosome,
+        start,
+        end
+    )
+    comparison_pvalues = _RegionTrack(
+        files.comparison_pvalues, chromosome, start, end)
+    comparison_pvalue_minimum = region_minimum(
+        files.comparison_pvalues, chromosome, start, end)
+
+    halo = window_size // 2
+    number_of_pseudopeaks = 0
+    number_of_reference_peaks = 0
+    for chunk_start in range(start, end + 1, chunk_size):
+        chunk_end = min(chunk_start + chunk_size - 1, end)
+        halo_start = max(start, chunk_start - halo)
+        halo_end = min(end, chunk_end + halo)
+
+        peak_type = _peak_bases(merged_peaks, chunk_start, chunk_end) + \
+            _peak_bases(unmerged_peaks, chunk_start, chunk_end)
+        reference_pvalue_ci = reference.pvalue_ci(
+            chunk_start, chunk_end, halo_start, halo_end,
+            significance, window_size)
+        comparison_pvalue_ci = comparison.pvalue_ci(
+            chunk_start, chunk_end, halo_start, halo_end,
+            significance, window_size)
+        pvalue = np.nan_to_num(
+            comparison_pvalues.scores(chunk_start, chunk_end),
+            nan=comparison_pvalue_minimum
+        )
+
+        peak_counts = count_peaks(
+            reference_pvalue_ci.lower,
+            comparison_pvalue_ci.upper,
+            pvalue,
+            peak_type,
+            cutoff,
+            include_merged_peaks
+        )
+        number_of_pseudopeaks += peak_counts.number_of_pseudopeaks
+        number_of_reference_peaks += peak_counts.number_of_reference_peaks
+    return metric_from_counts(number_of_pseudopeaks, number_of_reference_peaks)
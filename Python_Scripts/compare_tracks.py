@@ -0,0 +1,122 @@
+import argparse
+import sys
+import numpy as np
+from IO import DEFAULT_CHUNK_SIZE, BedGraph, merge_join_bedgraphs
+from scipy.special import pdtrc
+from typing import Dict, Iterator, Optional, Tuple
+
+SCORE_FORMAT = "%.5f"
+
+
+def poisson_score(observed: np.ndarray, expected: np.ndarray) -> np.ndarray:
+    """-log10 of the probability of seeing more reads than observed, the
+    score given by macs3 bdgcmp -m ppois.
+    """
+    # pdtrc() is the poisson survival function, which can underflow to 0 (an
+    # infinite score) as it does in scipy.stats
+    with np.errstate(divide="ignore"):
+        return -np.log(pdtrc(np.floor(observed), expected)) / np.log(10)
+
+
+METHODS = {
+    "ppois": poisson_score,
+    "max": np.maximum,
+    "subtract": np.subtract
+}
+
+
+def _merge_runs(columns: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """Joins neighbouring, touching intervals that have the same score."""
+    is_new_run = np.ones(len(columns["START"]), dtype=bool)
+    is_new_run[1:] = (
+        (columns["CHR"][1:] != columns["CHR"][:-1]) |
+        (columns["START"][1:] != columns["END"][:-1]) |
+        (columns["SCORE"][1:] != columns["SCORE"][:-1])
+    )
+    run_starts = np.flatnonzero(is_new_run)
+    run_ends = np.append(run_starts[1:] - 1, len(is_new_run) - 1)
+    return {
+        "CHR": columns["CHR"][run_starts],
+        "START": columns["START"][run_starts],
+        "END": columns["END"][run_ends],
+        "SCORE": columns["SCORE"][run_starts]
+    }
+
+
+def write_bedgraph_chunks(chunks: Iterator[BedGraph],
+                          file_path: str,
+                          float_format: Optional[str] = SCORE_FORMAT) -> None:
+    """Writes chunks of a track to one bedgraph file, joining neighbouring
+    intervals with the same score (also across chunks) as MACS does.
+    """
+    held_back: Optional[Tuple] = None
+    with open(file_path, "w") as file:
+        for chunk in chunks:
+            columns = {
+                column: chunk.get(column).to_numpy()
+                for column in ("CHR", "START", "END", "SCORE")
+            }
+            if held_back is not None:
+                columns = {
+                    column: np.concatenate(([value], columns[column]))
+                    for column, value in zip(columns, held_back)
+                }
+            columns = _merge_runs(columns)
+            # The last interval might continue into the next chunk
+            held_back = tuple(values[-1] for values in columns.values())
+            BedGraph(**{
+                column: values[:-1] for column, values in columns.items()
+            }).get().to_csv(
+                file,
+                sep="\t",
+                header=False,
+                index=False,
+                float_format=float_format
+            )
+        if held_back is not None:
+            BedGraph(*([value] for value in held_back)).get().to_csv(
+                file,
+                sep="\t",
+                header=False,
+                index=False,
+                float_format=float_format
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="CompareTracks",
+        description=("Combine two sorted bedgraph files interval by "
+                     "interval, reading them in chunks.")
+    )
+    parser.add_argument(
+        "-m",
+        "--method",
+        choices=list(METHODS),
+        default="ppois",
+        help=("ppois gives the poisson p-value score of the first track "
+              "(reads) given the second (lambdas), as macs3 bdgcmp does.")
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="Number of lines read from each file at a time."
+    )
+    parser.add_argument("treatment_file")
+    parser.add_argument("control_file")
+    parser.add_argument("output_file")
+    args = parser.parse_args()
+
+    try:
+        write_bedgraph_chunks(
+            merge_join_bedgraphs(
+                [args.treatment_file, args.control_file],
+                METHODS[args.method],
+                chunk_size=args.chunk_size
+            ),
+            args.output_file
+        )
+    except (FileNotFoundError, ValueError) as error:
+        print(error)
+        sys.exit(1)
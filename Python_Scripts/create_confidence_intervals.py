@@ -1,8 +1,13 @@
 import numpy as np
 import pandas as pd
 from IO import BedBase, BedBaseCI, IncompatabilityError
-from scipy.stats import poisson, norm
-from typing import NamedTuple
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.special import ndtri, pdtr
+from typing import NamedTuple, Optional, Tuple
+
+# Windows are gathered this many at a time when calculating variances, which
+# keeps the gathered copies to a few megabytes.
+VARIANCE_BLOCK_SIZE = 1 << 13
 
 
 class ConfidenceInterval(NamedTuple):
@@ -13,42 +18,134 @@ class ConfidenceInterval(NamedTuple):
     upper: np.ndarray
 
 
-def calculate_lambda_ci(lambdas: np.ndarray,
+def segmented_window_variances(values: np.ndarray,
+                               segment_starts: np.ndarray,
+                               window_size: int = 50
+                               ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Calculates the variance of the window around each value, for many
+    segments (such as regions) laid end to end in one array. Windows are
+    truncated at the edges of their segment, so no window reaches into a
+    neighbouring segment.
+
+    Windows of the same length are gathered (a block at a time) into the
+    rows of a contiguous array, and each row is summed the same way np.var()
+    sums a window. The variances are therefore exactly the same as working
+    through the windows one by one.
+
+    Args:
+        values: The values of every segment, one after another.
+        segment_starts: Index of the first value of each segment, in
+            increasing order starting at 0. Segments can't be empty.
+        window_size: The size of the sliding window to calculate variance.
+
+    Returns:
+        The variance of the window around each value, and the number of
+        values in that window.
+    """
+    half_window = window_size // 2
+    number_of_values = len(values)
+    segment_lengths = np.diff(np.append(segment_starts, number_of_values))
+    indices = np.arange(number_of_values)
+    window_starts = np.maximum(
+        indices - half_window,
+        np.repeat(segment_starts, segment_lengths)
+    )
+    window_ends = np.minimum(
+        indices + half_window + 1,
+        np.repeat(segment_starts + segment_lengths, segment_lengths)
+    )
+    sample_sizes = window_ends - window_starts
+
+    variances = np.empty(number_of_values)
+    # Most windows are full length, the rest are near the edge of a segment
+    for sample_size in np.unique(sample_sizes):
+        windows = sliding_window_view(values, int(sample_size))
+        with_size = np.flatnonzero(sample_sizes == sample_size)
+        for first in range(0, len(with_size), VARIANCE_BLOCK_SIZE):
+            block_indices = with_size[first:first + VARIANCE_BLOCK_SIZE]
+            block = windows[window_starts[block_indices]]
+            means = np.add.reduce(block, axis=1) / sample_size
+            deviations = block - means[:, None]
+            variances[block_indices] = np.add.reduce(
+                deviations * deviations, axis=1) / sample_size
+    return variances, sample_sizes
+
+
+def segmented_lambda_ci(lambdas: np.ndarray,
+                        segment_starts: np.ndarray,
                         significance: float = 0.95,
-                        window_size: int = 50) -> ConfidenceInterval:
+                        window_size: int = 50,
+                        minimum_lambdas: Optional[np.ndarray] = None
+                        ) -> ConfidenceInterval:
     """
-    Calculates confidence intervals for lambda values, considering variance in
-    surrounding values, handling edge cases correctly.
+    calculate_lambda_ci() for many segments (such as regions) laid end to end
+    in one array, each treated as if it were passed on its own.
 
     Args:
-        lambdas: A NumPy array of lambda values.
+        lambdas: The lambda values of every segment, one after another.
+        segment_starts: Index of the first value of each segment (see
+            segmented_window_variances()).
         significance: The significance level for the confidence interval
         (e.g., 0.95 for a 95% CI).
         window_size: The size of the sliding window to calculate variance.
+        minimum_lambdas: Lower bounds of each segment are kept at or above
+        its value. Defaults to the smallest lambda of each segment.
 
     Returns:
         A ConfidenceInterval object containing the lower and upper bounds of
         the confidence interval.
     """
-    variances = np.zeros_like(lambdas)
-    sample_sizes = np.zeros_like(lambdas)
-    for i in range(len(lambdas)):
-        start = max(0, i - window_size // 2)
-        end = min(len(lambdas), i + window_size // 2 + 1)
-        window = lambdas[start:end]
-        variances[i] = np.var(window)
-        sample_sizes[i] = len(window)
-
+    if len(lambdas) == 0:
+        return ConfidenceInterval(lower=lambdas.copy(), upper=lambdas.copy())
+    variances, sample_sizes = segmented_window_variances(
+        lambdas, segment_starts, window_size)
     standard_errors = np.sqrt(variances / sample_sizes)
-    z_a = norm.ppf(significance)
+    z_a = ndtri(significance)
     lower = lambdas - z_a * standard_errors
     upper = lambdas + z_a * standard_errors
 
     # Poisson distribution doesn't take kindly to non-positive lambdas
-    lower = np.clip(lower, a_min=np.min(lambdas), a_max=None)
+    if minimum_lambdas is None:
+        minimum_lambdas = np.minimum.reduceat(lambdas, segment_starts)
+    segment_lengths = np.diff(np.append(segment_starts, len(lambdas)))
+    lower = np.clip(
+        lower, a_min=np.repeat(minimum_lambdas, segment_lengths), a_max=None)
     return ConfidenceInterval(lower=lower, upper=upper)
 
 
+def calculate_lambda_ci(lambdas: np.ndarray,
+                        significance: float = 0.95,
+                        window_size: int = 50,
+                        minimum_lambda: Optional[float] = None
+                        ) -> ConfidenceInterval:
+    """
+    Calculates confidence intervals for lambda values, considering variance in
+    surrounding values, handling edge cases correctly.
+
+    Args:
+        lambdas: A NumPy array of lambda values.
+        significance: The significance level for the confidence interval
+        (e.g., 0.95 for a 95% CI).
+        window_size: The size of the sliding window to calculate variance.
+        minimum_lambda: Lower bounds are kept at or above this. Defaults to
+        the smallest of the lambdas (give the smallest lambda of the whole
+        region when only passing part of it).
+
+    Returns:
+        A ConfidenceInterval object containing the lower and upper bounds of
+        the confidence interval.
+    """
+    return segmented_lambda_ci(
+        lambdas,
+        np.zeros(1, dtype=np.int64),
+        significance,
+        window_size,
+        minimum_lambdas=(
+            None if minimum_lambda is None else np.array([minimum_lambda]))
+    )
+
+
 def generate_bias_track_ci(bias_bedbase: BedBase,
                            significance: float = 0.95,
                            window_size: int = 50) -> BedBaseCI:
@@ -67,7 +164,24 @@ def generate_bias_track_ci(bias_bedbase: BedBase,
 
 
 def calculate_pavlue(reads: np.ndarray, lambdas: np.ndarray) -> np.ndarray:
-    return poisson.cdf(reads, lambdas)
+    # The poisson CDF (pdtr() rounds reads down, as poisson.cdf() does).
+    # scipy.special is used rather than scipy.stats as it is much quicker to
+    # import.
+    return pdtr(reads, lambdas)
+
+
+def calculate_pvalue_ci(reads: np.ndarray,
+                        lambda_ci: ConfidenceInterval) -> ConfidenceInterval:
+    """The confidence interval of the p-value of each base's reads, given the
+    confidence interval of its lambda.
+    """
+    # A higher lambda in the poisson distribution will cause the same number
+    # of reads to generate a lower pvalue. To stay consistent with naming, we
+    # switch the order of upper and lower below.
+    return ConfidenceInterval(
+        lower=np.nan_to_num(calculate_pavlue(reads, lambda_ci.upper)),
+        upper=np.nan_to_num(calculate_pavlue(reads, lambda_ci.lower))
+    )
 
 
 def generate_pvalue_ci(bias_bedbase: BedBase,
@@ -98,22 +212,17 @@ def generate_pvalue_ci(bias_bedbase: BedBase,
         significance,
         window_size
     )
-
-    # A higher lambda in the poisson distribution will cause the same number
-    # of reads to generate a lower pvalue. To stay consistent with naming, we
-    # switch the order of upper and lower below.
-    lower_pvalue = calculate_pavlue(
-        coverage_bedbase.get("SCORE"),
-        bias_bedbase_ci.get("UPPER_SCORE")
-    )
-    upper_pvalue = calculate_pavlue(
-        coverage_bedbase.get("SCORE"),
-        bias_bedbase_ci.get("LOWER_SCORE")
+    pvalue_ci = calculate_pvalue_ci(
+        coverage_bedbase.get("SCORE").to_numpy(),
+        ConfidenceInterval(
+            lower=bias_bedbase_ci.get("LOWER_SCORE").to_numpy(),
+            upper=bias_bedbase_ci.get("UPPER_SCORE").to_numpy()
+        )
     )
     pvalues_bedbase_ci = BedBaseCI(
         CHR=coverage_bedbase.get("CHR"),
         BASE=coverage_bedbase.get("BASE"),
-        LOWER_SCORE=pd.Series(np.nan_to_num(lower_pvalue)),
-        UPPER_SCORE=pd.Series(np.nan_to_num(upper_pvalue))
+        LOWER_SCORE=pd.Series(pvalue_ci.lower),
+        UPPER_SCORE=pd.Series(pvalue_ci.upper)
     )
     return pvalues_bedbase_ci
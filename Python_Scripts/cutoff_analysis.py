@@ -0,0 +1,280 @@
+import argparse
+import sys
+import numpy as np
+import pandas as pd
+from call_peaks import DEFAULT_MAX_GAP, DEFAULT_MIN_LENGTH
+from get_cutoff import select_cutoff
+from IO import BedGraph
+from typing import Tuple
+
+DEFAULT_STEPS = 100
+MAX_SCORE = 1000
+
+
+def get_candidate_cutoffs(scores: np.ndarray,
+                          steps: int = DEFAULT_STEPS) -> np.ndarray:
+    """Evenly spaced cutoffs between the smallest (non-negative) and largest
+    scores, matching the cutoffs that MACS tries.
+    """
+    minimum_score = max(0, float(np.min(scores)))
+    maximum_score = min(float(np.max(scores)), MAX_SCORE)
+    if maximum_score <= minimum_score:
+        return np.array([minimum_score])
+    step = (maximum_score - minimum_score) / steps
+    return np.round(np.arange(minimum_score, maximum_score, step), 3)
+
+
+class IncrementalPeaks:
+    """
+    The peaks (intervals no more than max_gap apart, joined together) formed
+    by a growing set of intervals, along with the number and total length of
+    those that are at least min_length long.
+
+    Peaks are kept as runs of interval indices (in position order), so
+    adding intervals only looks at the intervals within max_gap of them and
+    the ends of the peaks they touch. Adding every interval of a track one
+    batch at a time therefore costs about as much as one pass over it,
+    however many batches there are.
+    """
+
+    def __init__(self,
+                 chromosome_codes: np.ndarray,
+                 starts: np.ndarray,
+                 ends: np.ndarray,
+                 max_gap: int,
+                 min_length: int):
+        """
+        Args:
+            chromosome_codes: Integer code for the chromosome of each
+                interval.
+            starts: Start of each interval.
+            ends: End of each interval.
+            max_gap: Intervals closer together than or equal to this are
+                merged.
+            min_length: Peaks shorter than this aren't counted.
+
+        The intervals must be sorted by position and not overlap.
+        """
+        self.max_gap = max_gap
+        self.min_length = min_length
+        # Chromosomes are laid end to end, further than max_gap apart, so
+        # that intervals on different chromosomes are never merged
+        chromosome_breaks = np.flatnonzero(
+            np.diff(chromosome_codes) != 0) + 1
+        offsets = np.zeros(len(starts), dtype=np.int64)
+        if len(chromosome_breaks) > 0:
+            chromosome_shifts = np.zeros(len(starts), dtype=np.int64)
+            chromosome_shifts[chromosome_breaks] = \
+                ends[chromosome_breaks - 1] + max_gap + 1
+            offsets = np.cumsum(chromosome_shifts)
+        self.starts = starts + offsets
+        self.ends = ends + offsets
+        # The first interval within max_gap of each interval (ends are
+        # sorted, as intervals don't overlap)
+        self._window_firsts = np.searchsorted(
+            self.ends, self.starts - max_gap, side="left")
+        self._window_lasts = np.searchsorted(
+            self.starts, self.ends + max_gap, side="right") - 1
+        self._is_added = np.zeros(len(starts), dtype=bool)
+        # Peak boundaries: the last interval of the peak starting at each
+        # first interval and the first interval of the peak ending at each
+        # last interval (-1 where an interval isn't a boundary)
+        self._last_of_first = np.full(len(starts), -1, dtype=np.int64)
+        self._first_of_last = np.full(len(starts), -1, dtype=np.int64)
+        self.number_of_peaks = 0
+        self.total_length = 0
+
+    def _nearest_added(self,
+                       intervals: np.ndarray,
+                       direction: int) -> np.ndarray:
+        """The nearest added interval within max_gap of each interval in one
+        direction (-1 for before, 1 for after), or -1 if there isn't one.
+        """
+        limits = self._window_firsts[intervals] if direction < 0 \
+            else self._window_lasts[intervals]
+        nearest = np.full(len(intervals), -1, dtype=np.int64)
+        candidates = intervals + direction
+        unresolved = np.arange(len(intervals))
+        # At most max_gap + 1 intervals fit within max_gap of another
+        while len(unresolved) > 0:
+            in_window = candidates[unresolved] >= limits[unresolved] \
+                if direction < 0 else \
+                candidates[unresolved] <= limits[unresolved]
+            unresolved = unresolved[in_window]
+            is_added = self._is_added[candidates[unresolved]]
+            nearest[unresolved[is_added]] = candidates[unresolved[is_added]]
+            unresolved = unresolved[~is_added]
+            candidates[unresolved] += direction
+        return nearest
+
+    def _counted(self,
+                 first_intervals: np.ndarray,
+                 last_intervals: np.ndarray) -> Tuple[int, int]:
+        lengths = self.ends[last_intervals] - self.starts[first_intervals]
+        lengths = lengths[lengths >= self.min_length]
+        return len(lengths), int(lengths.sum())
+
+    def add(self, intervals: np.ndarray) -> None:
+        """Adds intervals (that haven't been added yet), joining them to the
+        peaks within max_gap of them.
+        """
+        intervals = np.sort(intervals)
+        before = self._nearest_added(intervals, -1)
+        after = self._nearest_added(intervals, 1)
+        has_before = before >= 0
+        # An interval between two intervals of the same peak doesn't change
+        # the peak
+        is_inside = np.zeros(len(intervals), dtype=bool)
+        is_inside[has_before] = \
+            self._first_of_last[before[has_before]] < 0
+        # The peaks that the new intervals touch
+        touched_lasts = before[has_before & ~is_inside]
+        touched_firsts = np.concatenate((
+            self._first_of_last[touched_lasts],
+            after[(after >= 0) & ~is_inside]
+        ))
+        touched_firsts.sort()
+        is_distinct = np.ones(len(touched_firsts), dtype=bool)
+        is_distinct[1:] = touched_firsts[1:] != touched_firsts[:-1]
+        touched_firsts = touched_firsts[is_distinct]
+        touched_lasts = self._last_of_first[touched_firsts]
+
+        new_intervals = intervals[~is_inside]
+        firsts = np.concatenate((touched_firsts, new_intervals))
+        lasts = np.concatenate((touched_lasts, new_intervals))
+        order = np.argsort(firsts, kind="stable")
+        firsts = firsts[order]
+        lasts = lasts[order]
+        # Neighbouring pieces close enough together form one peak
+        is_new_peak = np.ones(len(firsts), dtype=bool)
+        is_new_peak[1:] = \
+            self.starts[firsts[1:]] - self.ends[lasts[:-1]] > self.max_gap
+        peak_firsts = firsts[is_new_peak]
+        peak_lasts = lasts[np.append(np.flatnonzero(is_new_peak)[1:] - 1,
+                                     len(lasts) - 1)] \
+            if len(lasts) > 0 else lasts
+
+        removed_peaks, removed_length = self._counted(
+            touched_firsts, touched_lasts)
+        added_peaks, added_length = self._counted(peak_firsts, peak_lasts)
+        self.number_of_peaks += added_peaks - removed_peaks
+        self.total_length += added_length - removed_length
+        self._last_of_first[touched_firsts] = -1
+        self._first_of_last[touched_lasts] = -1
+        self._last_of_first[peak_firsts] = peak_lasts
+        self._first_of_last[peak_lasts] = peak_firsts
+        self._is_added[intervals] = True
+
+
+def cutoff_analysis(pvalues: BedGraph,
+                    min_length: int = DEFAULT_MIN_LENGTH,
+                    max_gap: int = DEFAULT_MAX_GAP,
+                    steps: int = DEFAULT_STEPS) -> pd.DataFrame:
+    """Calculates the number of peaks, total peak length and average peak
+    length that each candidate cutoff would give.
+
+    The intervals are sorted by score once. Going from the strictest cutoff
+    to the most lenient, only the intervals that pass each new cutoff are
+    added to the peaks of the previous one (see IncrementalPeaks), so the
+    whole analysis is about one pass over the track.
+
+    Args:
+        pvalues: The p-value track (sorted by chromosome and position).
+        min_length: Minimum length of a peak.
+        max_gap: Maximum gap between intervals that are merged into a peak.
+        steps: Number of candidate cutoffs.
+
+    Returns:
+        pd.DataFrame: Columns score, npeaks, lpeaks and avelpeak (the same
+        columns as macs3 bdgpeakcall --cutoff-analysis) with the strictest
+        cutoff first. Cutoffs that give no peaks are left out.
+    """
+    scores = pvalues.get("SCORE").to_numpy()
+    peaks = IncrementalPeaks(
+        pd.factorize(pvalues.get("CHR"))[0],
+        pvalues.get("START").to_numpy(),
+        pvalues.get("END").to_numpy(),
+        max_gap,
+        min_length
+    )
+
+    # Intervals with the same score always pass together, so their order
+    # doesn't matter
+    score_order = np.argsort(-scores)
+    sorted_scores = -scores[score_order]
+    cutoffs = get_candidate_cutoffs(scores, steps)[::-1]
+
+    number_passing = 0
+    rows = []
+    for cutoff in cutoffs:
+        # Scores must be strictly above the cutoff
+        now_passing = int(np.searchsorted(sorted_scores, -cutoff, "left"))
+        peaks.add(score_order[number_passing:now_passing])
+        number_passing = now_passing
+        if peaks.number_of_peaks > 0:
+            rows.append((
+                cutoff,
+                peaks.number_of_peaks,
+                peaks.total_length,
+                peaks.total_length / peaks.number_of_peaks
+            ))
+    return pd.DataFrame(
+        rows,
+        columns=["score", "npeaks", "lpeaks", "avelpeak"]
+    )
+
+
+def write_cutoff_analysis(analysis: pd.DataFrame, file_path: str) -> None:
+    """Writes a cutoff analysis in the format used by MACS."""
+    with open(file_path, "w") as file:
+        file.write("score\tnpeaks\tlpeaks\tavelpeak\n")
+        for row in analysis.itertuples(index=False):
+            file.write(f"{row.score:.2f}\t{row.npeaks}\t{row.lpeaks}\t"
+                       f"{row.avelpeak:.2f}\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="CutoffAnalysis",
+        description=("Find the most stringent cutoff for a p-value track that "
+                     "gives peaks of a chosen average length.")
+    )
+    parser.add_argument(
+        "--min_length",
+        type=int,
+        default=DEFAULT_MIN_LENGTH,
+        help="Minimum length of a peak."
+    )
+    parser.add_argument(
+        "--max_gap",
+        type=int,
+        default=DEFAULT_MAX_GAP,
+        help="Maximum gap between regions that are merged into one peak."
+    )
+    parser.add_argument(
+        "--steps",
+        type=int,
+        default=DEFAULT_STEPS,
+        help="Number of cutoffs to try."
+    )
+    parser.add_argument(
+        "--output",
+        help="Write the full cutoff analysis table to this file."
+    )
+    parser.add_argument("pvalue_file", help="The p-value bedgraph file.")
+    parser.add_argument("average_peak_length", type=int)
+    args = parser.parse_args()
+
+    pvalues = BedGraph.read_from_file(args.pvalue_file)
+    if pvalues is None:
+        sys.exit(1)
+    analysis = cutoff_analysis(
+        pvalues,
+        min_length=args.min_length,
+        max_gap=args.max_gap,
+        steps=args.steps
+    )
+    if args.output is not None:
+        write_cutoff_analysis(analysis, args.output)
+    # Printed exactly as it appears in the analysis table
+    print(f"{select_cutoff(analysis, args.average_peak_length):.2f}")
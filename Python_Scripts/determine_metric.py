@@ -1,4 +1,16 @@
+import numpy as np
 from IO import BedBase, IncompatabilityError
+from typing import NamedTuple, Optional, Tuple
+
+
+class PeakCounts(NamedTuple):
+    """
+    Represents the counts that the metric is calculated from, and optionally
+    which bases are pseudopeaks.
+    """
+    number_of_pseudopeaks: int
+    number_of_reference_peaks: int
+    pseudopeaks: Optional[np.ndarray] = None
 
 
 def calculate_metric(reference_labelled_peaks: BedBase,
@@ -28,10 +40,122 @@ def calculate_metric(reference_labelled_peaks: BedBase,
         number_of_reference_peaks = (peaks_in_reference == 1).sum()
 
     number_of_pseudopeaks = (psuedopeaks.get("SCORE") == 1).sum()
-    metric = number_of_pseudopeaks / number_of_reference_peaks
+    metric = metric_from_counts(
+        number_of_pseudopeaks, number_of_reference_peaks)
+    warn_about_sample_order(metric)
+    return metric
+
+
+def metric_from_counts(number_of_pseudopeaks: int,
+                       number_of_reference_peaks: int) -> float:
+    """The metric, given the number of bases that are pseudopeaks and the
+    number of bases that are (counted) peaks in the reference dataset. This
+    is NaN for 0/0 and inf if there are pseudopeaks but no reference peaks.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.divide(number_of_pseudopeaks, number_of_reference_peaks)
+
+
+def warn_about_sample_order(metric: float) -> None:
+    """Suggests switching the samples around if the comparison has more
+    peaks than the reference.
+    """
     if metric > 1:
         print("Peaks in comparison dataset is greater than in reference "
               "dataset. For a better result, consider switching the order of ",
               "each dataset.")
 
-    return metric
+
+def count_peaks(reference_lower_pvalues: np.ndarray,
+                comparison_upper_pvalues: np.ndarray,
+                comparison_pvalues: np.ndarray,
+                peak_types: np.ndarray,
+                cutoff: float,
+                include_merged_peaks: bool = True,
+                keep_pseudopeaks: bool = False) -> PeakCounts:
+    """Goes straight from the per base arrays to the counts the metric needs,
+    doing the work of compare_pvalue_ci(), determine_psuedopeaks() and
+    calculate_metric() without building a BedBase for each step. The arrays
+    must all be over the same bases.
+
+    Args:
+        reference_lower_pvalues (np.ndarray): Lower bounds of the reference
+            dataset's p-value confidence intervals.
+        comparison_upper_pvalues (np.ndarray): Upper bounds of the comparison
+            dataset's p-value confidence intervals.
+        comparison_pvalues (np.ndarray): The comparison dataset's p-values.
+        peak_types (np.ndarray): Labelled peaks of the reference dataset (see
+            label_peak_type()).
+        cutoff (float): The cutoff used to call peaks in the reference.
+        include_merged_peaks (bool): See calculate_metric().
+        keep_pseudopeaks (bool): Whether to return which bases are
+            pseudopeaks as well as the counts.
+
+    Returns:
+        PeakCounts: The number of pseudopeaks and reference peaks.
+    """
+    is_pseudopeak = _is_pseudopeak(reference_lower_pvalues,
+                                   comparison_upper_pvalues,
+                                   comparison_pvalues,
+                                   peak_types,
+                                   cutoff)
+    return PeakCounts(
+        number_of_pseudopeaks=np.count_nonzero(is_pseudopeak),
+        number_of_reference_peaks=np.count_nonzero(
+            _is_reference_peak(peak_types, include_merged_peaks)),
+        pseudopeaks=is_pseudopeak if keep_pseudopeaks else None
+    )
+
+
+def count_peaks_segmented(reference_lower_pvalues: np.ndarray,
+                          comparison_upper_pvalues: np.ndarray,
+                          comparison_pvalues: np.ndarray,
+                          peak_types: np.ndarray,
+                          segment_starts: np.ndarray,
+                          cutoff: float,
+                          include_merged_peaks: bool = True
+                          ) -> Tuple[np.ndarray, np.ndarray]:
+    """count_peaks() for many segments (such as regions) laid end to end in
+    the arrays, counting each segment separately.
+
+    Args:
+        segment_starts (np.ndarray): Index of the first base of each
+            segment, in increasing order starting at 0. Segments can't be
+            empty.
+        See count_peaks() for the rest.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The number of pseudopeaks and
+        reference peaks in each segment.
+    """
+    is_pseudopeak = _is_pseudopeak(reference_lower_pvalues,
+                                   comparison_upper_pvalues,
+                                   comparison_pvalues,
+                                   peak_types,
+                                   cutoff)
+    is_reference_peak = _is_reference_peak(peak_types, include_merged_peaks)
+    return (
+        np.add.reduceat(is_pseudopeak.astype(np.int64), segment_starts),
+        np.add.reduceat(is_reference_peak.astype(np.int64), segment_starts)
+    )
+
+
+def _is_pseudopeak(reference_lower_pvalues: np.ndarray,
+                   comparison_upper_pvalues: np.ndarray,
+                   comparison_pvalues: np.ndarray,
+                   peak_types: np.ndarray,
+                   cutoff: float) -> np.ndarray:
+    # The same criteria as determine_psuedopeaks(), worked out in place
+    is_pseudopeak = comparison_upper_pvalues > reference_lower_pvalues
+    is_pseudopeak &= peak_types == 2
+    is_above_cutoff = comparison_pvalues > cutoff
+    is_above_cutoff &= peak_types == 1
+    is_pseudopeak |= is_above_cutoff
+    return is_pseudopeak
+
+
+def _is_reference_peak(peak_types: np.ndarray,
+                       include_merged_peaks: bool) -> np.ndarray:
+    if include_merged_peaks:
+        return peak_types > 1
+    return peak_types == 1
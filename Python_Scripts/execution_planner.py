@@ -0,0 +1,377 @@
+import gzip
+import math
+import os
+import resource
+import sys
+from bgzf import is_bgzf, is_gzipped
+from typing import List, NamedTuple, Optional, Sequence
+
+MEGABYTE = 1 << 20
+# Memory costs measured with peak_compare.py and batch_compare.py (on
+# tracks with a few hundred thousand intervals per chromosome). These are
+# rough, so plans only aim to use MEMORY_HEADROOM of the budget.
+# Python, numpy, pandas, scipy and pyarrow once imported
+BASELINE_MEMORY = 160 * MEGABYTE
+# Each base of a region calculated with DataFrames (peak_compare.py without
+# --chunk_size), which hold the chromosome name of every base
+DATAFRAME_BYTES_PER_BASE = 550
+# Each base of a region calculated with plain arrays (chunks of
+# peak_compare.py --chunk_size, or the regions of batch_compare.py)
+ARRAY_BYTES_PER_BASE = 200
+# Each line of a bedgraph file while it is parsed whole
+PARSED_BYTES_PER_INTERVAL = 200
+# Each line of a bedgraph file held in a streamed chunk
+STREAMED_BYTES_PER_INTERVAL = 60
+# Each interval kept in memory by batch_compare.load_tracks()
+LOADED_BYTES_PER_INTERVAL = 64
+# Each worker process on top of what it shares with its parent
+WORKER_MEMORY = 20 * MEGABYTE
+MEMORY_HEADROOM = 0.8
+# Lines read from the top of each file to estimate its density
+SAMPLE_LINES = 1 << 16
+# Used when a gzip file's compressed size can't be related to its lines
+GZIP_COMPRESSION_RATIO = 4
+MINIMUM_CHUNK_SIZE = 10_000
+# Workers are given about this many batches of regions each, so that
+# regions of different lengths even out
+BATCHES_PER_WORKER = 4
+MAXIMUM_BATCH_SIZE = 1000
+# Regions of a batch (on the same chromosome) are calculated together, up to
+# this many bases at a time
+GROUP_BASES = 1 << 18
+META_DATA_PREFIXES = (b"track", b"browser", b"#")
+
+
+class ResourceBudget(NamedTuple):
+    """
+    Represents the memory (in bytes) and cores a job is allowed to use.
+    """
+    memory: int
+    cores: int
+
+
+class TrackSample(NamedTuple):
+    """
+    Represents an estimate of the size of a bedgraph file, from its first
+    lines.
+    """
+    intervals: int
+    intervals_per_base: float
+
+
+class Plan(NamedTuple):
+    """
+    Represents how to run a calculation so that it fits in a budget.
+
+    chunk_size is None when the region is calculated all at once. Memory is
+    the predicted peak resident memory of the main process and of each worker
+    process (0 if there are none).
+    """
+    chunk_size: Optional[int]
+    workers: int
+    batch_size: int
+    predicted_memory: int
+    predicted_worker_memory: int
+    budget: ResourceBudget
+
+
+def _read_number(file_path: str) -> Optional[str]:
+    try:
+        with open(file_path) as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_files(v1_controller: str,
+                  v1_file: str,
+                  v2_file: str) -> List[str]:
+    """Paths to a setting of the cgroup this process is in, then of the
+    root cgroup (used when the cgroup's own directory isn't mounted, as in
+    some containers).
+    """
+    candidates = []
+    cgroups = _read_number("/proc/self/cgroup") or ""
+    for line in cgroups.splitlines():
+        _, controllers, path = line.split(":", 2)
+        if controllers == "":
+            candidates.append(f"/sys/fs/cgroup{path}/{v2_file}")
+        elif v1_controller in controllers.split(","):
+            candidates.append(
+                f"/sys/fs/cgroup/{controllers}{path}/{v1_file}")
+    candidates.append(f"/sys/fs/cgroup/{v2_file}")
+    candidates.append(f"/sys/fs/cgroup/{v1_controller}/{v1_file}")
+    return candidates
+
+
+def _cgroup_memory_limit() -> Optional[int]:
+    for file_path in _cgroup_files(
+            "memory", "memory.limit_in_bytes", "memory.max"):
+        limit = _read_number(file_path)
+        if limit is not None and limit.isdigit():
+            return int(limit)
+    return None
+
+
+def _cgroup_core_limit() -> Optional[int]:
+    for file_path in _cgroup_files("cpu", "cpu.cfs_quota_us", "cpu.max"):
+        quota = _read_number(file_path)
+        if quota is None:
+            continue
+        if file_path.endswith("cpu.max"):
+            quota, period = quota.split()
+        else:
+            period = _read_number(
+                file_path.replace("cpu.cfs_quota_us", "cpu.cfs_period_us"))
+        # "max" (v2) or -1 (v1) means there is no quota
+        if not quota.isdigit() or period is None or not period.isdigit():
+            return None
+        return max(math.ceil(int(quota) / int(period)), 1)
+    return None
+
+
+def _system_memory() -> int:
+    meminfo = _read_number("/proc/meminfo") or ""
+    for line in meminfo.splitlines():
+        if line.startswith("MemAvailable:"):
+            return int(line.split()[1]) * 1024
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def _environment_integer(name: str) -> Optional[int]:
+    # SLURM can give a count per node as e.g. "16(x2)"
+    value = os.environ.get(name, "").split("(")[0]
+    return int(value) if value.isdigit() else None
+
+
+def core_budget() -> int:
+    """The number of cores this process can use. Inside a SLURM job this is
+    the job's allocation, otherwise it is limited by the cgroup (such as a
+    container's CPU quota) and the cores this process is allowed to run on.
+    """
+    limits = [
+        _environment_integer("SLURM_CPUS_PER_TASK"),
+        _environment_integer("SLURM_CPUS_ON_NODE"),
+        _cgroup_core_limit()
+    ]
+    if hasattr(os, "sched_getaffinity"):
+        limits.append(len(os.sched_getaffinity(0)))
+    else:
+        limits.append(os.cpu_count() or 1)
+    return min(limit for limit in limits if limit is not None)
+
+
+def memory_budget(cores: Optional[int] = None) -> int:
+    """The number of bytes of memory this process can use. This is the
+    smallest of the SLURM allocation (--mem or --mem-per-cpu), the cgroup's
+    limit and the memory available on the machine.
+
+    Args:
+        cores (Optional[int]): Cores the job has, for --mem-per-cpu.
+            Defaults to core_budget().
+    """
+    limits = [_cgroup_memory_limit(), _system_memory()]
+    memory_per_node = _environment_integer("SLURM_MEM_PER_NODE")
+    if memory_per_node is not None:
+        limits.append(memory_per_node * MEGABYTE)
+    memory_per_core = _environment_integer("SLURM_MEM_PER_CPU")
+    if memory_per_core is not None:
+        limits.append(memory_per_core * MEGABYTE *
+                      (cores if cores is not None else core_budget()))
+    return min(limit for limit in limits if limit is not None)
+
+
+def resource_budget() -> ResourceBudget:
+    cores = core_budget()
+    return ResourceBudget(memory=memory_budget(cores), cores=cores)
+
+
+def sample_track(file_path: str) -> TrackSample:
+    """Estimates the number of intervals in a bedgraph file, and how many
+    there are per base, from its first SAMPLE_LINES lines.
+    """
+    is_compressed = is_gzipped(file_path)
+    with open(file_path, "rb") as raw_file:
+        file = gzip.GzipFile(fileobj=raw_file) if is_compressed \
+            else raw_file
+        intervals = 0
+        sample_bytes = 0
+        covered_bases = 0
+        for line in file:
+            sample_bytes += len(line)
+            if line.startswith(META_DATA_PREFIXES) or not line.strip():
+                continue
+            _, start, end = line.split(b"\t", 3)[:3]
+            covered_bases += int(end) - int(start)
+            intervals += 1
+            if intervals == SAMPLE_LINES:
+                break
+        else:
+            # The whole file was read
+            return TrackSample(intervals, intervals / max(covered_bases, 1))
+        compressed_bytes = raw_file.tell()
+    file_size = os.path.getsize(file_path)
+    if is_compressed:
+        # Reads are buffered, so this is only roughly the compressed size
+        # of the lines sampled
+        ratio = sample_bytes / compressed_bytes if compressed_bytes > 0 \
+            else GZIP_COMPRESSION_RATIO
+        file_size = file_size * ratio
+    return TrackSample(
+        intervals=int(file_size / sample_bytes * intervals),
+        intervals_per_base=intervals / max(covered_bases, 1)
+    )
+
+
+def _intervals_read(file_path: str,
+                    sample: TrackSample,
+                    region_length: int) -> int:
+    """The number of intervals of a bedgraph file parsed to read a region.
+    Only the blocks of a block gzipped file that overlap the region are
+    read, other files are read whole (see IO._read_table()).
+    """
+    if is_bgzf(file_path):
+        return min(int(region_length * sample.intervals_per_base),
+                   sample.intervals)
+    return sample.intervals
+
+
+def plan_region(track_files: Sequence[str],
+                region_length: int,
+                budget: ResourceBudget,
+                can_chunk: bool = True) -> Plan:
+    """Plans the calculation of one region by peak_compare.py, working
+    through it in chunks if calculating it all at once wouldn't fit in the
+    memory budget.
+
+    Args:
+        track_files (Sequence[str]): The bedgraph files being compared.
+        region_length (int): Number of bases in the region.
+        budget (ResourceBudget): What the job can use.
+        can_chunk (bool): Whether the region can be split into chunks (it
+            can't when caching or writing tracks).
+
+    Returns:
+        Plan: The chunk size (None if the region fits at once). A single
+        region is calculated by one process.
+    """
+    usable_memory = int(budget.memory * MEMORY_HEADROOM)
+    samples = [sample_track(file_path) for file_path in track_files]
+    # Files are read one at a time, keeping the bases but not the intervals
+    whole_region_memory = BASELINE_MEMORY + \
+        region_length * DATAFRAME_BYTES_PER_BASE + max(
+            _intervals_read(file_path, sample, region_length)
+            for file_path, sample in zip(track_files, samples)
+        ) * PARSED_BYTES_PER_INTERVAL
+    if whole_region_memory <= usable_memory or not can_chunk:
+        return Plan(None, 1, 1, whole_region_memory, 0, budget)
+
+    from IO import DEFAULT_CHUNK_SIZE
+    # Every file has a chunk of lines in memory at once
+    streaming_memory = BASELINE_MEMORY + sum(
+        min(sample.intervals, DEFAULT_CHUNK_SIZE)
+        for sample in samples
+    ) * STREAMED_BYTES_PER_INTERVAL
+    chunk_size = (usable_memory - streaming_memory) // ARRAY_BYTES_PER_BASE
+    chunk_size = min(max(chunk_size // 1000 * 1000, MINIMUM_CHUNK_SIZE),
+                     region_length)
+    return Plan(
+        chunk_size,
+        1,
+        1,
+        streaming_memory + chunk_size * ARRAY_BYTES_PER_BASE,
+        0,
+        budget
+    )
+
+
+def plan_batch(track_files: Sequence[str],
+               region_lengths: Sequence[int],
+               budget: ResourceBudget) -> Plan:
+    """Plans the calculation of many regions by batch_compare.py, which
+    loads the files once and then calculates batches of regions in worker
+    processes sharing the loaded files.
+
+    Args:
+        track_files (Sequence[str]): The bedgraph files being compared.
+        region_lengths (Sequence[int]): Number of bases in each region.
+        budget (ResourceBudget): What the job can use.
+
+    Returns:
+        Plan: The number of workers (as many as fit in the memory left once
+        the files are loaded, up to one per core) and regions per batch.
+    """
+    usable_memory = int(budget.memory * MEMORY_HEADROOM)
+    samples = [sample_track(file_path) for file_path in track_files]
+    # Files are parsed whole, one at a time, and only their intervals are
+    # kept (files with other chromosomes may keep fewer)
+    loaded_memory = BASELINE_MEMORY + \
+        max(sample.intervals for sample in samples) * \
+        PARSED_BYTES_PER_INTERVAL + \
+        sum(sample.intervals for sample in samples) * \
+        LOADED_BYTES_PER_INTERVAL
+    number_of_regions = len(region_lengths)
+    # Small regions are calculated in groups, larger ones on their own
+    worker_memory = WORKER_MEMORY + min(
+        max(max(region_lengths, default=0), GROUP_BASES),
+        sum(region_lengths)
+    ) * ARRAY_BYTES_PER_BASE
+    workers = min(
+        budget.cores,
+        (usable_memory - loaded_memory) // worker_memory,
+        number_of_regions
+    )
+    workers = max(int(workers), 1)
+    batch_size = regions_per_batch(number_of_regions, workers)
+    if workers == 1:
+        return Plan(None, 1, batch_size,
+                    loaded_memory + worker_memory - WORKER_MEMORY, 0,
+                    budget)
+    return Plan(None, workers, batch_size, loaded_memory, worker_memory,
+                budget)
+
+
+def regions_per_batch(number_of_regions: int, workers: int) -> int:
+    """Splits regions into about BATCHES_PER_WORKER batches per worker."""
+    batch_size = math.ceil(number_of_regions / (workers * BATCHES_PER_WORKER))
+    return min(max(batch_size, 1), MAXIMUM_BATCH_SIZE)
+
+
+def peak_memory() -> int:
+    """The peak resident memory (in bytes) of this process, and of the
+    largest of its finished child processes.
+    """
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    scale = 1 if sys.platform == "darwin" else 1024
+    return max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    ) * scale
+
+
+def log_plan(plan: Plan) -> None:
+    """Prints a plan (to stderr, so it doesn't mix with the metric)."""
+    how = "whole regions" if plan.chunk_size is None \
+        else f"chunks of {plan.chunk_size} bases"
+    batches = f", batches of {plan.batch_size} regions" \
+        if plan.batch_size > 1 else ""
+    print(f"Plan: {how}, {plan.workers} worker(s){batches}. Predicted peak "
+          f"memory "
+          f"{plan.predicted_memory / MEGABYTE:.0f}MB"
+          + (f" (plus {plan.predicted_worker_memory / MEGABYTE:.0f}MB per "
+             "worker)" if plan.workers > 1 else "")
+          + f" of {plan.budget.memory / MEGABYTE:.0f}MB, "
+          f"{plan.budget.cores} core(s).",
+          file=sys.stderr)
+    if plan.predicted_memory + plan.workers * plan.predicted_worker_memory \
+            > plan.budget.memory:
+        print("Warning: this is predicted to use more memory than the "
+              "budget.", file=sys.stderr)
+
+
+def log_peak_memory(plan: Plan) -> None:
+    """Prints the peak memory used next to what the plan predicted."""
+    predicted_memory = max(plan.predicted_memory,
+                           plan.predicted_worker_memory)
+    print(f"Peak memory: {peak_memory() / MEGABYTE:.0f}MB (predicted "
+          f"{predicted_memory / MEGABYTE:.0f}MB).", file=sys.stderr)
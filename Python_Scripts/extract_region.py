@@ -1,6 +1,6 @@
 import numpy as np
-import pandas as pd
 from IO import BedGraph, BedBase
+from typing import Optional
 
 
 def subset_bedgraph(bedgraph: BedGraph,
@@ -10,50 +10,104 @@ def subset_bedgraph(bedgraph: BedGraph,
     """Subset a BedGraph to a given region.
 
     Returns:
-        A BedGraph covering the region selected
+        A BedGraph of the intervals overlapping the region selected
     """
     bedgraph = bedgraph.get()
-    # Ranges in bedgraph do not overlap and so these should always yield a
-    # single index each.
-    start_index = bedgraph.loc[
-        (bedgraph["CHR"] == chromosome) &
-        (bedgraph["START"] <= start) &
-        (bedgraph["END"] >= start)
-    ].index[0]
-    end_index = bedgraph.loc[
+    overlaps_region = (
         (bedgraph["CHR"] == chromosome) &
         (bedgraph["START"] <= end) &
-        (bedgraph["END"] >= end)
-    ].index[0]
-    bedgraph = bedgraph.iloc[start_index:end_index+1]
+        (bedgraph["END"] > start)
+    )
+    bedgraph = bedgraph.loc[overlaps_region]
     bedgraph = BedGraph(
-        CHR=bedgraph["CHR"],
-        START=bedgraph["START"],
-        END=bedgraph["END"],
-        SCORE=bedgraph["SCORE"]
+        CHR=bedgraph["CHR"].to_numpy(),
+        START=bedgraph["START"].to_numpy(),
+        END=bedgraph["END"].to_numpy(),
+        SCORE=bedgraph["SCORE"].to_numpy()
     )
     return bedgraph
 
 
+def interval_scores_at_bases(starts: np.ndarray,
+                             ends: np.ndarray,
+                             scores: np.ndarray,
+                             first_base: int,
+                             last_base: int) -> np.ndarray:
+    """Looks up the score of every base from first_base to last_base
+    (inclusive) in a set of intervals, where base b is in [START, END) if
+    START <= b < END.
+
+    Args:
+        starts (np.ndarray): Starts of the intervals.
+        ends (np.ndarray): Ends of the intervals.
+        scores (np.ndarray): Scores of the intervals.
+        first_base (int): First base to look up.
+        last_base (int): Last base to look up.
+
+    Returns:
+        np.ndarray: The score of each base, or NaN for bases not in any
+        interval.
+    """
+    return interval_scores_at(
+        starts, ends, scores, np.arange(first_base, last_base + 1))
+
+
+def interval_scores_at(starts: np.ndarray,
+                       ends: np.ndarray,
+                       scores: np.ndarray,
+                       bases: np.ndarray) -> np.ndarray:
+    """interval_scores_at_bases() for any array of bases (such as the bases
+    of several regions one after another).
+    """
+    if np.any(starts[1:] < starts[:-1]):
+        order = np.argsort(starts, kind="stable")
+        starts = starts[order]
+        ends = ends[order]
+        scores = scores[order]
+    intervals = np.searchsorted(starts, bases, side="right") - 1
+    is_covered = intervals >= 0
+    intervals = np.maximum(intervals, 0)
+    if len(starts) > 0:
+        is_covered &= bases < ends[intervals]
+    else:
+        is_covered[:] = False
+    base_scores = np.full(len(bases), np.nan)
+    base_scores[is_covered] = scores[intervals[is_covered]]
+    return base_scores
+
+
 def convert_to_bedbase(bedgraph: BedGraph,
                        chromosome: str,
                        start: int,
-                       end: int) -> BedBase:
-    bases = pd.Series(list(range(start, end+1)))
-    chromosome_column = pd.Series([chromosome] * len(bases))
-    bins = list(bedgraph.get("START")) + [bedgraph.get("END").iloc[-1]]
-    score = pd.cut(
-        bases,
-        bins=bins,
-        labels=bedgraph.get("SCORE"),
-        include_lowest=True,
-        ordered=False,
-        right=False
+                       end: int,
+                       fill_value: Optional[float] = None) -> BedBase:
+    """Converts a bedgraph (on one chromosome) into the score of each base
+    of a region.
+
+    Args:
+        bedgraph (BedGraph): Bedgraph to convert.
+        chromosome (str): Chromosome of the region.
+        start (int): Start of region.
+        end (int): End of region (included).
+        fill_value (Optional[float]): Score given to bases not in the
+            bedgraph. Defaults to the smallest score in the region.
+
+    Returns:
+        A BedBase covering the region selected
+    """
+    score = interval_scores_at_bases(
+        bedgraph.get("START").to_numpy(),
+        bedgraph.get("END").to_numpy(),
+        bedgraph.get("SCORE").to_numpy(),
+        start,
+        end
     )
-    score = np.nan_to_num(score, nan=np.nanmin(score))
+    if fill_value is None:
+        fill_value = np.nanmin(score)
+    score = np.nan_to_num(score, nan=fill_value)
     bedbase = BedBase(
-        CHR=chromosome_column,
-        BASE=bases,
+        CHR=np.full(len(score), chromosome, dtype=object),
+        BASE=np.arange(start, end + 1),
         SCORE=score
     )
     return bedbase
@@ -62,7 +116,8 @@ def convert_to_bedbase(bedgraph: BedGraph,
 def extract_bedbase_region(bedgraph: BedGraph,
                            chromosome: str,
                            start: int,
-                           end: int) -> BedBase:
+                           end: int,
+                           fill_value: Optional[float] = None) -> BedBase:
     """Extract a region of a bedgraph data frame and convert it into bedbase
     format
 
@@ -71,10 +126,12 @@ def extract_bedbase_region(bedgraph: BedGraph,
         chromosome (str): Chromosome to extract.
         start (int): Start of region.
         end (int): End of region.
+        fill_value (Optional[float]): See convert_to_bedbase().
 
     Returns:
         A BedBase covering the region selected
     """
     bedgraph = subset_bedgraph(bedgraph, chromosome, start, end)
-    bedbase = convert_to_bedbase(bedgraph, chromosome, start, end)
+    bedbase = convert_to_bedbase(
+        bedgraph, chromosome, start, end, fill_value)
     return bedbase
@@ -0,0 +1,82 @@
+import hashlib
+import os
+import threading
+from typing import Callable, Dict, List, Optional
+
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def hash_file(file_path: str) -> str:
+    """The SHA-256 digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_values(values: List[str]) -> str:
+    digest = hashlib.sha256()
+    for value in values:
+        # Lengths are included so that ("ab", "c") and ("a", "bc") differ
+        encoded_value = value.encode()
+        digest.update(f"{len(encoded_value)}:".encode())
+        digest.update(encoded_value)
+    return digest.hexdigest()
+
+
+class FileDigests:
+    """
+    The digests of files' contents, remembered along with the size and
+    modification time they were calculated for so that unchanged files are
+    only hashed once. Files are keyed by their real path.
+
+    Where the digests are kept between runs is up to the owner (a JSON
+    manifest, a SQLite table, ...), which gives the entries it has saved and
+    is told about each new one.
+    """
+
+    def __init__(self,
+                 entries: Optional[Dict[str, dict]] = None,
+                 on_update: Optional[Callable[[str, dict], None]] = None):
+        """
+        Args:
+            entries (Optional[Dict[str, dict]]): Previously saved entries
+                (see entries()), keyed by real path.
+            on_update (Optional[Callable[[str, dict], None]]): Called with
+                the real path and entry of each newly hashed file.
+        """
+        self._entries: Dict[str, dict] = dict(entries or {})
+        self._on_update = on_update
+        # Reentrant so that on_update can save entries()
+        self._lock = threading.RLock()
+
+    def entries(self) -> Dict[str, dict]:
+        """A copy of every entry (size, mtime_ns and digest) to be saved."""
+        with self._lock:
+            return dict(self._entries)
+
+    def digest(self, file_path: str) -> str:
+        """The digest of a file's contents.
+
+        Raises:
+            FileNotFoundError: If the file doesn't exist.
+        """
+        file_path = os.path.realpath(file_path)
+        stat = os.stat(file_path)
+        with self._lock:
+            cached = self._entries.get(file_path)
+        if cached is not None and \
+                cached["size"] == stat.st_size and \
+                cached["mtime_ns"] == stat.st_mtime_ns:
+            return cached["digest"]
+        entry = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "digest": hash_file(file_path)
+        }
+        with self._lock:
+            self._entries[file_path] = entry
+            if self._on_update is not None:
+                self._on_update(file_path, entry)
+        return entry["digest"]
@@ -1,12 +1,42 @@
-import pandas as pd
 import argparse
+import csv
+from typing import Mapping, Sequence
+
+
+def select_cutoff(cutoffs: Mapping[str, Sequence[float]],
+                  average_peak_length: int) -> float:
+    """Picks the most stringent cutoff that gives peaks that are at least the
+    given length on average.
+
+    Args:
+        cutoffs: Cutoff analysis with the most stringent cutoff first, with
+            (at least) the columns score and avelpeak. This can be a
+            pd.DataFrame or a dictionary of lists.
+        average_peak_length: The desired average peak length.
+    """
+    for score, average_length in zip(cutoffs["score"], cutoffs["avelpeak"]):
+        if average_length >= average_peak_length:
+            return score
+    raise ValueError("No cutoff gives peaks that are at least "
+                     f"{average_peak_length} long on average.")
+
+
+def read_cutoff_analysis(filepath: str) -> Mapping[str, Sequence[float]]:
+    """Reads the table written by macs3 callpeak --cutoff-analysis (or
+    cutoff_analysis.py). This is a small file, so it is read with the csv
+    module rather than importing pandas.
+    """
+    with open(filepath, "r", newline="") as cutoffs_file:
+        rows = list(csv.DictReader(cutoffs_file, delimiter="\t"))
+    return {
+        column: [float(row[column]) for row in rows]
+        for column in ("score", "avelpeak")
+    }
 
 
 def get_cutoff(filepath: str, average_peak_length: int) -> float:
-    cutoffs = pd.read_csv(filepath, sep="\t", header=0)
-    cutoff_to_use = cutoffs.loc[cutoffs['avelpeak']
-                                >= average_peak_length].iloc[0].score
-    return cutoff_to_use
+    cutoffs = read_cutoff_analysis(filepath)
+    return select_cutoff(cutoffs, average_peak_length)
 
 
 if __name__ == "__main__":
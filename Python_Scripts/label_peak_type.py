@@ -27,14 +27,10 @@ def convert_narrow_peak_to_bedbase(peak_data: Bed,
         END=peak_data.get("END"),
         SCORE=pd.Series(np.ones(len(peak_data.get("START"))))
     )
-    peak_data = extract_bedbase_region(peak_data, chromosome, start, end)
-
-    # extract_bedbase_region() will return NaN values in the SCORE column for
-    # all bases that do not exist in the narrow peak file. This is exactly the
-    # bases that are not within a peak. A trick here is to convert to Boolean
-    # values to convert all non-NaN scores into 1 and all NaN scores to 0.
-    score = peak_data.get("SCORE").fillna(0).astype(bool).astype(int)
-    peak_data.get()["SCORE"] = score
+    # Bases that are not in the narrow peak file are exactly the bases that
+    # are not within a peak
+    peak_data = extract_bedbase_region(
+        peak_data, chromosome, start, end, fill_value=0)
     return peak_data
 
 
@@ -0,0 +1,628 @@
+import argparse
+import gzip
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from checkpoints import Checkpoints
+from config_file_functions import get_config_variables
+from execution_planner import core_budget
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+PYTHON_SCRIPTS = os.path.dirname(os.path.realpath(__file__))
+MODEL_FAILURE_MESSAGE = """WARNING
+MACS was unable to build the model.
+Consider increasing the range of MFOLD variables in config file.
+Alternatively, you can specify your own model parameters in the config file.
+If you do this, be sure to set $BUILD_MODEL to 0."""
+TRACKS_TO_COMPRESS = (
+    "coverage.bdg",
+    "bias_track.bdg",
+    "pvalues.bdg",
+    "unmerged_peaks.bed",
+    "merged_peaks.bed"
+)
+
+# Config file variables (upper case) and values found while running the
+# pipeline, such as the fragment length (lower case).
+Context = Dict[str, str]
+
+
+class Stage(NamedTuple):
+    """
+    Represents one step of the peak calling pipeline. run() is given the
+    context (with every update made by the stages it depends on) and the
+    path of its log file. It returns any values it adds to the context.
+
+    parameters are the context values the stage uses, inputs are the config
+    variables holding paths of files from outside the pipeline that it
+    reads and outputs are the suffixes (after the sample name) of the files
+    it writes. Together with the outputs of its dependencies, these decide
+    whether a stage needs to be rerun.
+
+    compresses are the suffixes of files written by earlier stages that the
+    stage writes compressed copies of (as <suffix>.gz). Once the stage has
+    finished (or been skipped), these files are removed. The checkpoints
+    still count them as present while their compressed copies are
+    unchanged, and they are decompressed again if a stage that reads them
+    has to rerun.
+    """
+    name: str
+    dependencies: Tuple[str, ...]
+    run: Callable[[Context, str], Context]
+    parameters: Tuple[str, ...] = ()
+    inputs: Tuple[str, ...] = ()
+    outputs: Tuple[str, ...] = ()
+    compresses: Tuple[str, ...] = ()
+
+
+class StageTiming(NamedTuple):
+    name: str
+    start: float
+    end: float
+    status: str
+
+
+class StageFailedError(Exception):
+    """Exception raised when a stage of the pipeline fails."""
+    pass
+
+
+def output_path(context: Context, suffix: str) -> str:
+    return os.path.join(
+        context["OUTPUT_DIRECTORY"], f"{context['SAMPLE_NAME']}_{suffix}")
+
+
+def run_command(command: List[str],
+                log_file: str,
+                stderr_file: Optional[str] = None) -> None:
+    """Runs a command, streaming its output to the stage's log file.
+
+    Args:
+        command (List[str]): The command and its arguments.
+        log_file (str): Path of the log file to append to.
+        stderr_file (Optional[str]): Write standard error here instead of to
+            the log file.
+    """
+    with open(log_file, "a") as log:
+        log.write("$ " + " ".join(command) + "\n")
+        log.flush()
+        if stderr_file is None:
+            result = subprocess.run(
+                command, stdout=log, stderr=subprocess.STDOUT)
+        else:
+            with open(stderr_file, "w") as stderr:
+                result = subprocess.run(command, stdout=log, stderr=stderr)
+    if result.returncode != 0:
+        raise StageFailedError(
+            f"{command[0]} exited with status {result.returncode}.")
+
+
+def _search_model(pattern: str, model_file: str, model: str) -> str:
+    match = re.search(pattern, model)
+    if match is None:
+        raise StageFailedError(
+            f"Could not find '{pattern}' in {model_file}.")
+    return match.group(1)
+
+
+def parse_model(model_file: str) -> Context:
+    """Reads the fragment length, read length and number of reads from the
+    log of macs3 predictd (MACS has no parsable model file).
+
+    Returns:
+        Context: fragment_length, read_length and number_of_reads.
+    """
+    with open(model_file, "r") as file:
+        model = file.read()
+    if "mfold" in model.lower():
+        raise StageFailedError(MODEL_FAILURE_MESSAGE)
+    return {
+        "fragment_length": _search_model(
+            r"predicted fragment.*?(\d+) bps", model_file, model),
+        "read_length": _search_model(
+            r"tag size.*?(\d+) bps", model_file, model),
+        "number_of_reads": _search_model(
+            r"total tags.*?: (\d+)", model_file, model)
+    }
+
+
+def pileup_format(context: Context) -> str:
+    return "BEDPE" if "PE" in context["FILE_TYPE"] else "BED"
+
+
+def remove_duplicates(input_variable: str, prefix: str) -> Stage:
+    def run(context: Context, log_file: str) -> Context:
+        run_command([
+            "macs3", "filterdup",
+            "-i", context[input_variable],
+            "-f", context["FILE_TYPE"],
+            "-o", output_path(context, f"{prefix}filtered.bed")
+        ], log_file)
+        return {}
+    return Stage(
+        f"{prefix}filterdup",
+        (),
+        run,
+        parameters=("FILE_TYPE",),
+        inputs=(input_variable,),
+        outputs=(f"{prefix}filtered.bed",)
+    )
+
+
+def build_model(prefix: str) -> Stage:
+    def run(context: Context, log_file: str) -> Context:
+        model_file = output_path(context, f"{prefix}model.txt")
+        # Each model needs its own R script, else concurrent runs of
+        # predictd overwrite each other's
+        run_command([
+            "macs3", "predictd",
+            "-i", output_path(context, f"{prefix}filtered.bed"),
+            "-g", context["GENOME_SIZE"],
+            "-m", context["MFOLD_LOWER"], context["MFOLD_UPPER"],
+            "--outdir", context["OUTPUT_DIRECTORY"],
+            "--rfile", f"{context['SAMPLE_NAME']}_{prefix}predictd_model.R"
+        ], log_file, stderr_file=model_file)
+        return {
+            f"{prefix}{key}": value
+            for key, value in parse_model(model_file).items()
+        }
+    return Stage(
+        f"{prefix}predictd",
+        (f"{prefix}filterdup",),
+        run,
+        parameters=("GENOME_SIZE", "MFOLD_LOWER", "MFOLD_UPPER"),
+        outputs=(f"{prefix}model.txt",)
+    )
+
+
+def get_coverage_track(model_dependencies: Tuple[str, ...]) -> Stage:
+    def run(context: Context, log_file: str) -> Context:
+        run_command([
+            "macs3", "pileup",
+            "-i", output_path(context, "filtered.bed"),
+            "-f", pileup_format(context),
+            "--extsize", context["fragment_length"],
+            "-o", output_path(context, "coverage.bdg")
+        ], log_file)
+        return {}
+    return Stage(
+        "coverage",
+        ("filterdup",) + model_dependencies,
+        run,
+        parameters=("FILE_TYPE", "fragment_length"),
+        outputs=("coverage.bdg",)
+    )
+
+
+def get_bias_track(has_control: bool,
+                   model_dependencies: Tuple[str, ...]) -> Stage:
+    prefix = "control_" if has_control else ""
+
+    def run(context: Context, log_file: str) -> Context:
+        command = [
+            sys.executable, os.path.join(PYTHON_SCRIPTS, "build_bias_track.py")
+        ]
+        if pileup_format(context) == "BEDPE":
+            command.append("--paired")
+        if has_control:
+            command.extend(["--treatment_reads", context["number_of_reads"]])
+        command.extend([
+            output_path(context, f"{prefix}filtered.bed"),
+            context[f"{prefix}fragment_length"],
+            context[f"{prefix}number_of_reads"],
+            context["SMALL_LOCAL_SIZE"],
+            context["LARGE_LOCAL_SIZE"],
+            context["GENOME_SIZE"],
+            output_path(context, "bias_track.bdg")
+        ])
+        run_command(command, log_file)
+        return {}
+    parameters = (
+        "FILE_TYPE",
+        f"{prefix}fragment_length",
+        f"{prefix}number_of_reads",
+        "SMALL_LOCAL_SIZE",
+        "LARGE_LOCAL_SIZE",
+        "GENOME_SIZE"
+    )
+    if has_control:
+        parameters += ("number_of_reads",)
+    return Stage(
+        "bias_track",
+        (f"{prefix}filterdup",) + model_dependencies,
+        run,
+        parameters=parameters,
+        outputs=("bias_track.bdg",)
+    )
+
+
+def get_p_values() -> Stage:
+    def run(context: Context, log_file: str) -> Context:
+        run_command([
+            sys.executable, os.path.join(PYTHON_SCRIPTS, "compare_tracks.py"),
+            "-m", "ppois",
+            output_path(context, "coverage.bdg"),
+            output_path(context, "bias_track.bdg"),
+            output_path(context, "pvalues.bdg")
+        ], log_file)
+        return {}
+    return Stage(
+        "pvalues",
+        ("coverage", "bias_track"),
+        run,
+        outputs=("pvalues.bdg",)
+    )
+
+
+def get_best_cutoff() -> Stage:
+    def run(context: Context, log_file: str) -> Context:
+        command = [
+            sys.executable, os.path.join(PYTHON_SCRIPTS, "cutoff_analysis.py"),
+            "--output", output_path(context, "cutoff_analysis.txt"),
+            output_path(context, "pvalues.bdg"),
+            context["AVERAGE_PEAK_LENGTH"]
+        ]
+        with open(log_file, "a") as log:
+            log.write("$ " + " ".join(command) + "\n")
+            result = subprocess.run(
+                command, stdout=subprocess.PIPE, stderr=log, text=True)
+            log.write(result.stdout)
+        if result.returncode != 0:
+            raise StageFailedError(
+                f"cutoff_analysis.py exited with status {result.returncode}.")
+        # Only the last line holds the cutoff, in case of any warnings
+        cutoff = result.stdout.strip().splitlines()[-1]
+        print(f"Using a cutoff value of {cutoff}.")
+        return {"cutoff": cutoff}
+    return Stage(
+        "cutoff",
+        ("pvalues",),
+        run,
+        parameters=("AVERAGE_PEAK_LENGTH",),
+        outputs=("cutoff_analysis.txt",)
+    )
+
+
+def call_peaks(cutoff_dependencies: Tuple[str, ...]) -> Stage:
+    def run(context: Context, log_file: str) -> Context:
+        # Both sets of peaks come from one pass over the p-value track. The
+        # unmerged peaks use the bdgpeakcall default gap, the merged peaks
+        # use the read length.
+        run_command([
+            sys.executable, os.path.join(PYTHON_SCRIPTS, "call_peaks.py"),
+            "--min_length", context["fragment_length"],
+            "--output", "30", output_path(context, "unmerged_peaks.bed"),
+            "--output", context["read_length"],
+            output_path(context, "merged_peaks.bed"),
+            output_path(context, "pvalues.bdg"),
+            context["cutoff"]
+        ], log_file)
+        return {}
+    return Stage(
+        "peaks",
+        ("pvalues",) + cutoff_dependencies,
+        run,
+        parameters=("cutoff", "fragment_length", "read_length"),
+        outputs=("unmerged_peaks.bed", "merged_peaks.bed")
+    )
+
+
+def build_zoom_track() -> Stage:
+    def run(context: Context, log_file: str) -> Context:
+        run_command([
+            sys.executable, os.path.join(PYTHON_SCRIPTS, "zoom_track.py"),
+            "convert", output_path(context, "tracks.zoom"),
+            "--coverage", output_path(context, "coverage.bdg"),
+            "--bias", output_path(context, "bias_track.bdg"),
+            "--pvalue", output_path(context, "pvalues.bdg")
+        ], log_file)
+        return {}
+    return Stage(
+        "zoom_track",
+        ("coverage", "bias_track", "pvalues"),
+        run,
+        outputs=("tracks.zoom",)
+    )
+
+
+def compress_track(suffix: str, dependencies: Tuple[str, ...]) -> Stage:
+    def run(context: Context, log_file: str) -> Context:
+        run_command([
+            sys.executable, os.path.join(PYTHON_SCRIPTS, "bgzf.py"),
+            "compress", "--keep", output_path(context, suffix)
+        ], log_file)
+        return {}
+    return Stage(
+        f"compress_{suffix.split('.')[0]}",
+        dependencies,
+        run,
+        outputs=(f"{suffix}.gz",),
+        compresses=(suffix,)
+    )
+
+
+def build_stages(config: Context) -> List[Stage]:
+    """Lays out the stages of the peak calling pipeline for a config file.
+
+    Returns:
+        List[Stage]: The stages, listed so that stages on the longest path
+        through the pipeline come first.
+    """
+    has_control = "CONTROL_FILE" in config
+    build_models = config["BUILD_MODEL"] == "1"
+    stages = [remove_duplicates("INPUT_FILE", "")]
+    treatment_model = ()
+    background_model = ()
+    if build_models:
+        stages.append(build_model(""))
+        treatment_model = ("predictd",)
+        background_model = ("predictd",)
+    if has_control:
+        stages.append(remove_duplicates("CONTROL_FILE", "control_"))
+        if build_models:
+            stages.append(build_model("control_"))
+            background_model = ("predictd", "control_predictd")
+    stages.append(get_coverage_track(treatment_model))
+    stages.append(get_bias_track(has_control, background_model))
+    stages.append(get_p_values())
+    cutoff_stage = ()
+    if "CUTOFF" not in config:
+        stages.append(get_best_cutoff())
+        cutoff_stage = ("cutoff",)
+    stages.append(call_peaks(cutoff_stage))
+    if config.get("BUILD_ZOOM_TRACK") == "1":
+        stages.append(build_zoom_track())
+    if config.get("COMPRESS_TRACKS") == "1":
+        # Files are only compressed once nothing else needs to read them
+        readers = tuple(stage.name for stage in stages)
+        stages.extend(
+            compress_track(suffix, readers) for suffix in TRACKS_TO_COMPRESS)
+    return stages
+
+
+def initial_context(config: Context) -> Context:
+    context = dict(config)
+    if config["BUILD_MODEL"] != "1":
+        context["fragment_length"] = config["FRAGMENT_LENGTH"]
+        context["read_length"] = config["READ_LENGTH"]
+        context["number_of_reads"] = config["NUMBER_OF_READS"]
+        if "CONTROL_FILE" in config:
+            context["control_fragment_length"] = \
+                config["CONTROL_FRAGMENT_LENGTH"]
+            context["control_number_of_reads"] = \
+                config["NUMBER_OF_CONTROL_READS"]
+    if "CUTOFF" in config:
+        context["cutoff"] = config["CUTOFF"]
+    return context
+
+
+def validate_stages(stages: List[Stage]) -> None:
+    """Checks that every dependency exists and that there are no cycles."""
+    names = {stage.name for stage in stages}
+    for stage in stages:
+        for dependency in stage.dependencies:
+            if dependency not in names:
+                raise ValueError(
+                    f"{stage.name} depends on unknown stage {dependency}.")
+    remaining = {stage.name: set(stage.dependencies) for stage in stages}
+    while remaining:
+        ready = [name for name, dependencies in remaining.items()
+                 if not dependencies & remaining.keys()]
+        if not ready:
+            raise ValueError(
+                f"Stages {', '.join(remaining)} depend on each other.")
+        for name in ready:
+            del remaining[name]
+
+
+def _decompress(compressed_path: str, file_path: str) -> None:
+    # Stages running at the same time can need the same file, so each writes
+    # its own temporary copy
+    temporary_path = f"{file_path}.{threading.get_ident()}.tmp"
+    with gzip.open(compressed_path, "rb") as compressed_file, \
+            open(temporary_path, "wb") as file:
+        shutil.copyfileobj(compressed_file, file)
+    os.replace(temporary_path, file_path)
+
+
+def restore_compressed(file_paths: List[str],
+                       checkpoints: Optional[Checkpoints]) -> None:
+    """Decompresses any of the files that have been replaced by compressed
+    copies, so that a stage which reads them can be rerun.
+    """
+    if checkpoints is None:
+        return
+    for file_path in file_paths:
+        if os.path.exists(file_path):
+            continue
+        compressed_path = checkpoints.compressed_path(file_path)
+        if compressed_path is not None:
+            _decompress(compressed_path, file_path)
+
+
+def remove_compressed(stage: Stage,
+                      context: Context,
+                      checkpoints: Optional[Checkpoints]) -> None:
+    """Removes the files that a stage has written compressed copies of."""
+    for suffix in stage.compresses:
+        file_path = output_path(context, suffix)
+        if not os.path.exists(file_path):
+            continue
+        if checkpoints is not None:
+            checkpoints.record_compressed(file_path, f"{file_path}.gz")
+        os.remove(file_path)
+
+
+def _timed_run(stage: Stage,
+               context: Context,
+               log_file: str,
+               checkpoints: Optional[Checkpoints],
+               dependency_outputs: List[str]
+               ) -> Tuple[StageTiming, Context]:
+    start = time.time()
+    try:
+        if checkpoints is not None:
+            fingerprint = checkpoints.fingerprint(
+                stage.name,
+                {name: context[name] for name in stage.parameters},
+                [context[variable] for variable in stage.inputs],
+                list(stage.dependencies)
+            )
+            updates = checkpoints.completed_run(stage.name, fingerprint)
+            if updates is not None:
+                remove_compressed(stage, context, checkpoints)
+                return (StageTiming(stage.name, start, time.time(), "skipped"),
+                        updates)
+            checkpoints.invalidate(stage.name)
+        restore_compressed(dependency_outputs, checkpoints)
+        updates = stage.run(context, log_file)
+        if checkpoints is not None:
+            checkpoints.record(
+                stage.name,
+                fingerprint,
+                [output_path(context, suffix) for suffix in stage.outputs],
+                updates
+            )
+        remove_compressed(stage, context, checkpoints)
+    except (StageFailedError, OSError) as error:
+        with open(log_file, "a") as log:
+            log.write(f"{error}\n")
+        print(f"Stage {stage.name} failed: {error}", file=sys.stderr)
+        return StageTiming(stage.name, start, time.time(), "failed"), {}
+    return StageTiming(stage.name, start, time.time(), "done"), updates
+
+
+def run_pipeline(stages: List[Stage],
+                 context: Context,
+                 cores: int,
+                 log_directory: str,
+                 checkpoints: Optional[Checkpoints] = None
+                 ) -> List[StageTiming]:
+    """Runs each stage as soon as the stages it depends on have finished,
+    with at most one stage per core running at once.
+
+    If a stage fails, no further stages are started, but those already
+    running are allowed to finish. Stages that have checkpoints from a
+    previous run with the same fingerprint are skipped.
+
+    Args:
+        stages (List[Stage]): Stages in order of priority.
+        context (Context): Config variables and known values. Updated with
+            the values found by each stage.
+        cores (int): Maximum number of stages to run at once.
+        log_directory (str): Directory to write a log file per stage to.
+        checkpoints (Optional[Checkpoints]): Records of previous runs. If
+            None, every stage is run.
+
+    Returns:
+        List[StageTiming]: Timings in order of completion.
+    """
+    validate_stages(stages)
+    os.makedirs(log_directory, exist_ok=True)
+    outputs = {stage.name: stage.outputs for stage in stages}
+    pending = list(stages)
+    completed = set()
+    running = {}
+    timings = []
+    has_failed = False
+    with ThreadPoolExecutor(max_workers=cores) as executor:
+        while pending or running:
+            if not has_failed:
+                for stage in list(pending):
+                    if len(running) >= cores:
+                        break
+                    if not set(stage.dependencies) <= completed:
+                        continue
+                    pending.remove(stage)
+                    print(f"Starting {stage.name}.")
+                    future = executor.submit(
+                        _timed_run,
+                        stage,
+                        dict(context),
+                        os.path.join(log_directory, f"{stage.name}.log"),
+                        checkpoints,
+                        [output_path(context, suffix)
+                         for dependency in stage.dependencies
+                         for suffix in outputs[dependency]]
+                    )
+                    running[future] = stage
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                timing, updates = future.result()
+                timings.append(timing)
+                if timing.status == "failed":
+                    has_failed = True
+                    continue
+                context.update(updates)
+                completed.add(stage.name)
+                if timing.status == "skipped":
+                    print(f"Skipped {stage.name}, its inputs are unchanged.")
+                else:
+                    print(f"Finished {stage.name} in "
+                          f"{timing.end - timing.start:.1f}s.")
+    return timings
+
+
+def write_timings(timings: List[StageTiming], file_path: str) -> None:
+    with open(file_path, "w") as file:
+        file.write("stage\tstart\tend\tseconds\tstatus\n")
+        for timing in timings:
+            file.write(
+                f"{timing.name}\t{timing.start:.3f}\t{timing.end:.3f}\t"
+                f"{timing.end - timing.start:.3f}\t{timing.status}\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="PeakCallPipeline",
+        description=("Run the stages of peak calling, running stages that "
+                     "don't depend on each other at the same time.")
+    )
+    parser.add_argument(
+        "--cores",
+        type=int,
+        default=core_budget(),
+        help=("Maximum number of stages to run at once. Defaults to the "
+              "cores given to the SLURM job (or the machine).")
+    )
+    parser.add_argument(
+        "--log_directory",
+        help=("Directory for the log file of each stage. Defaults to "
+              "LogFiles/stages in the output directory.")
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help=("Rerun every stage, even those whose inputs and parameters are "
+              "unchanged since the last run.")
+    )
+    parser.add_argument("config_file")
+    args = parser.parse_args()
+
+    config = get_config_variables(args.config_file)
+    log_directory = args.log_directory or os.path.join(
+        config["OUTPUT_DIRECTORY"], "LogFiles", "stages")
+    stages = build_stages(config)
+    context = initial_context(config)
+    manifest_path = output_path(context, "checkpoints.json")
+    if args.force and os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    timings = run_pipeline(
+        stages,
+        context,
+        max(args.cores, 1),
+        log_directory,
+        Checkpoints(manifest_path)
+    )
+    write_timings(timings, output_path(context, "stage_timings.tsv"))
+    if len(timings) != len(stages) or \
+            any(timing.status == "failed" for timing in timings):
+        sys.exit(1)
@@ -1,95 +1,372 @@
 import argparse
-from create_confidence_intervals import generate_pvalue_ci
-from determine_metric import calculate_metric
-from determine_psuedo_peaks import compare_pvalue_ci, determine_psuedopeaks
-from extract_region import extract_bedbase_region
-from label_peak_type import label_peak_type, convert_narrow_peak_to_bedbase
-from IO import BedGraph, Bed
+import os
+from typing import TYPE_CHECKING, Optional
 
+# Importing pandas and scipy takes longer than running a small region, so
+# the modules that use them are imported by the functions that need them
+# (see benchmark_startup.py). This keeps --help and argument errors instant
+# and avoids loading what a run doesn't use.
+if TYPE_CHECKING:
+    from artifact_cache import ArtifactCache
+    from chunked_compare import ComparisonFiles
+    from IO import BedBase, BedBaseCI
 
-def main(args: argparse.Namespace) -> None:
-    chromosome = args.chromosome
-    start = args.start
-    end = args.end
+MEGABYTE = 1 << 20
+TRACK_DECIMALS = 5
 
-    reference_merged_peaks = convert_narrow_peak_to_bedbase(
-        Bed.read_from_file(args.reference_merged_peaks_file),
-        chromosome,
-        start,
-        end
+
+def read_peak_labels(merged_peaks_file: str,
+                     unmerged_peaks_file: str,
+                     chromosome: str,
+                     start: int,
+                     end: int) -> "BedBase":
+    """Labels each base of a region by the type of peak it is in (see
+    label_peak_type()).
+    """
+    from IO import Bed
+    from label_peak_type import (
+        convert_narrow_peak_to_bedbase,
+        label_peak_type
     )
-    reference_unmerged_peaks = convert_narrow_peak_to_bedbase(
-        Bed.read_from_file(args.reference_unmerged_peaks_file),
+    merged_peaks = convert_narrow_peak_to_bedbase(
+        Bed.read_region(merged_peaks_file, chromosome, start, end),
         chromosome,
         start,
         end
     )
-    reference_bias_track = extract_bedbase_region(
-        BedGraph.read_from_file(args.reference_bias_track_file),
+    unmerged_peaks = convert_narrow_peak_to_bedbase(
+        Bed.read_region(unmerged_peaks_file, chromosome, start, end),
         chromosome,
         start,
         end
     )
-    reference_coverage_track = extract_bedbase_region(
-        BedGraph.read_from_file(args.reference_coverage_track_file),
+    return label_peak_type(merged_peaks, unmerged_peaks)
+
+
+def read_track(file_path: str,
+               chromosome: str,
+               start: int,
+               end: int) -> "BedBase":
+    """Reads the bases of a region of a bedgraph file."""
+    from execution_planner import core_budget
+    from extract_region import extract_bedbase_region
+    from IO import BedGraph
+    return extract_bedbase_region(
+        BedGraph.read_region(
+            file_path, chromosome, start, end, workers=core_budget()),
         chromosome,
         start,
         end
     )
-    comparison_bias_track = extract_bedbase_region(
-        BedGraph.read_from_file(args.comparison_bias_track_file),
-        chromosome,
-        start,
-        end
+
+
+def read_pvalue_ci(bias_track_file: str,
+                   coverage_track_file: str,
+                   chromosome: str,
+                   start: int,
+                   end: int,
+                   significance: float,
+                   window_size: int) -> "BedBaseCI":
+    """Calculates the p-value confidence intervals of a region of a sample."""
+    from create_confidence_intervals import generate_pvalue_ci
+    return generate_pvalue_ci(
+        read_track(bias_track_file, chromosome, start, end),
+        read_track(coverage_track_file, chromosome, start, end),
+        significance,
+        window_size
+    )
+
+
+def cached_peak_labels(cache: Optional["ArtifactCache"],
+                       merged_peaks_file: str,
+                       unmerged_peaks_file: str,
+                       chromosome: str,
+                       start: int,
+                       end: int) -> "BedBase":
+    """read_peak_labels(), loading the labels from the cache if they have
+    been calculated before (and adding them if not).
+    """
+    import numpy as np
+    from IO import BedBase
+    if cache is None:
+        return read_peak_labels(
+            merged_peaks_file, unmerged_peaks_file, chromosome, start, end)
+    key = cache.key(
+        "peak_labels",
+        [merged_peaks_file, unmerged_peaks_file],
+        {"chromosome": chromosome, "start": start, "end": end}
     )
-    comparison_coverage_track = extract_bedbase_region(
-        BedGraph.read_from_file(args.comparison_coverage_track_file),
+    arrays = cache.load(key)
+    if arrays is not None:
+        return BedBase(chromosome, arrays["BASE"], arrays["SCORE"])
+    labelled_peaks = read_peak_labels(
+        merged_peaks_file, unmerged_peaks_file, chromosome, start, end)
+    cache.store(key, {
+        "BASE": labelled_peaks.get("BASE").to_numpy(),
+        # Labels are 0, 1 or 2
+        "SCORE": labelled_peaks.get("SCORE").to_numpy().astype(np.uint8)
+    })
+    return labelled_peaks
+
+
+def cached_pvalue_ci(cache: Optional["ArtifactCache"],
+                     bias_track_file: str,
+                     coverage_track_file: str,
+                     chromosome: str,
+                     start: int,
+                     end: int,
+                     significance: float,
+                     window_size: int) -> "BedBaseCI":
+    """read_pvalue_ci(), loading the confidence intervals from the cache if
+    they have been calculated before (and adding them if not).
+    """
+    from IO import BedBaseCI
+    if cache is None:
+        return read_pvalue_ci(bias_track_file, coverage_track_file,
+                              chromosome, start, end, significance,
+                              window_size)
+    key = cache.key(
+        "pvalue_ci",
+        [bias_track_file, coverage_track_file],
+        {
+            "chromosome": chromosome,
+            "start": start,
+            "end": end,
+            "significance": repr(significance),
+            "window_size": window_size
+        }
+    )
+    arrays = cache.load(key)
+    if arrays is not None:
+        return BedBaseCI(chromosome,
+                         arrays["BASE"],
+                         arrays["LOWER_SCORE"],
+                         arrays["UPPER_SCORE"])
+    pvalue_ci = read_pvalue_ci(bias_track_file, coverage_track_file,
+                               chromosome, start, end, significance,
+                               window_size)
+    cache.store(key, {
+        column: pvalue_ci.get(column).to_numpy()
+        for column in ("BASE", "LOWER_SCORE", "UPPER_SCORE")
+    })
+    return pvalue_ci
+
+
+def write_tracks(output_directory: str,
+                 region_name: str,
+                 reference_labelled_peaks: "BedBase",
+                 pseudopeaks: "BedBase",
+                 reference_pvalue_ci: "BedBaseCI",
+                 comparison_pvalue_ci: "BedBaseCI") -> None:
+    """Writes the per base results as bedgraph tracks (neighbouring bases
+    with the same value are joined into one line) for viewing in a genome
+    browser.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    tracks = {
+        "reference_peak_types": reference_labelled_peaks.to_bedgraph(),
+        "pseudopeaks": pseudopeaks.to_bedgraph(),
+        "reference_pvalue_lower": reference_pvalue_ci.to_bedgraph(
+            "LOWER_SCORE"),
+        "reference_pvalue_upper": reference_pvalue_ci.to_bedgraph(
+            "UPPER_SCORE"),
+        "comparison_pvalue_lower": comparison_pvalue_ci.to_bedgraph(
+            "LOWER_SCORE"),
+        "comparison_pvalue_upper": comparison_pvalue_ci.to_bedgraph(
+            "UPPER_SCORE")
+    }
+    for track_name, track in tracks.items():
+        name = f"{region_name}_{track_name}"
+        track.write_track(
+            os.path.join(output_directory, f"{name}.bdg"),
+            name=name,
+            decimals=TRACK_DECIMALS
+        )
+
+
+def comparison_files(args: argparse.Namespace) -> "ComparisonFiles":
+    from chunked_compare import ComparisonFiles
+    return ComparisonFiles(
+        args.reference_merged_peaks_file,
+        args.reference_unmerged_peaks_file,
+        args.reference_bias_track_file,
+        args.reference_coverage_track_file,
+        args.comparison_bias_track_file,
+        args.comparison_coverage_track_file,
+        args.comparison_pvalue_file
+    )
+
+
+def main_in_chunks(args: argparse.Namespace) -> float:
+    from chunked_compare import calculate_metric_in_chunks
+    return calculate_metric_in_chunks(
+        comparison_files(args),
+        args.chromosome,
+        args.start,
+        args.end,
+        args.cutoff,
+        significance=args.significance,
+        window_size=args.window_size,
+        include_merged_peaks=(not args.unmerged),
+        chunk_size=args.chunk_size
+    )
+
+
+def main_sparse(args: argparse.Namespace) -> float:
+    from sparse_compare import calculate_metric_sparse
+    return calculate_metric_sparse(
+        comparison_files(args),
+        args.chromosome,
+        args.start,
+        args.end,
+        args.cutoff,
+        significance=args.significance,
+        window_size=args.window_size,
+        include_merged_peaks=(not args.unmerged)
+    )
+
+
+def main(args: argparse.Namespace) -> None:
+    store = None
+    if args.store is not None:
+        from results_store import ResultsStore, comparison_parameters
+        store = ResultsStore(args.store)
+        comparison = store.comparison_key(
+            comparison_files(args),
+            comparison_parameters(
+                args.cutoff,
+                args.significance,
+                args.window_size,
+                include_merged_peaks=(not args.unmerged)
+            )
+        )
+        metric = store.stored_metric(
+            comparison, args.chromosome, args.start, args.end)
+        # Tracks still need calculating if they were asked for
+        if metric is not None and args.output_directory is None:
+            store.close()
+            report_metric(metric, args)
+            return
+
+    plan = None
+    if args.plan:
+        from execution_planner import log_plan, plan_region, resource_budget
+        plan = plan_region(
+            comparison_files(args)[2:],
+            args.end - args.start + 1,
+            resource_budget(),
+            can_chunk=(args.cache_directory is None and
+                       args.output_directory is None)
+        )
+        log_plan(plan)
+        args.chunk_size = plan.chunk_size
+
+    if args.chunk_size is not None:
+        metric = main_in_chunks(args)
+    elif args.sparse:
+        metric = main_sparse(args)
+    else:
+        metric = main_whole_region(args)
+    if plan is not None:
+        from execution_planner import log_peak_memory
+        log_peak_memory(plan)
+    if store is not None:
+        store.insert_metric(
+            comparison, args.chromosome, args.start, args.end, metric)
+        store.close()
+    report_metric(metric, args)
+
+
+def main_whole_region(args: argparse.Namespace) -> float:
+    from determine_metric import count_peaks, metric_from_counts
+    from IO import BedBase, IncompatabilityError
+    chromosome = args.chromosome
+    start = args.start
+    end = args.end
+    cache = None
+    if args.cache_directory is not None:
+        from artifact_cache import ArtifactCache
+        cache = ArtifactCache(
+            args.cache_directory, max_size=args.cache_size * MEGABYTE)
+
+    # Only the reference's artifacts are cached, as it is usually the sample
+    # that stays the same when comparing many samples against one another
+    reference_labelled_peaks = cached_peak_labels(
+        cache,
+        args.reference_merged_peaks_file,
+        args.reference_unmerged_peaks_file,
         chromosome,
         start,
         end
     )
-    comparison_pvalue_track = extract_bedbase_region(
-        BedGraph.read_from_file(args.comparison_pvalue_file),
+    comparison_pvalue_track = read_track(
+        args.comparison_pvalue_file, chromosome, start, end)
+    reference_pvalue_ci = cached_pvalue_ci(
+        cache,
+        args.reference_bias_track_file,
+        args.reference_coverage_track_file,
         chromosome,
         start,
-        end
-    )
-    reference_labelled_peaks = label_peak_type(
-        reference_merged_peaks,
-        reference_unmerged_peaks
-    )
-    reference_pvalue_ci = generate_pvalue_ci(
-        reference_bias_track,
-        reference_coverage_track,
+        end,
         args.significance,
         args.window_size
     )
-    comparison_pvalue_ci = generate_pvalue_ci(
-        comparison_bias_track,
-        comparison_coverage_track,
+    comparison_pvalue_ci = read_pvalue_ci(
+        args.comparison_bias_track_file,
+        args.comparison_coverage_track_file,
+        chromosome,
+        start,
+        end,
         args.significance,
         args.window_size
     )
-    compared_pvalues = compare_pvalue_ci(
-        reference_pvalue_ci,
-        comparison_pvalue_ci
+    for bedbase in (comparison_pvalue_ci,
+                    comparison_pvalue_track,
+                    reference_labelled_peaks):
+        if not reference_pvalue_ci.has_same_positions(bedbase):
+            raise IncompatabilityError(
+                "All BedBase files must be over the same region.")
+    peak_counts = count_peaks(
+        reference_pvalue_ci.get("LOWER_SCORE").to_numpy(),
+        comparison_pvalue_ci.get("UPPER_SCORE").to_numpy(),
+        comparison_pvalue_track.get("SCORE").to_numpy(),
+        reference_labelled_peaks.get("SCORE").to_numpy(),
+        args.cutoff,
+        include_merged_peaks=(not args.unmerged),
+        keep_pseudopeaks=(args.output_directory is not None)
     )
-    pseudopeaks = determine_psuedopeaks(
-        comparison_pvalue_track,
-        compared_pvalues,
-        reference_labelled_peaks,
-        args.cutoff
-    )
-    metric = calculate_metric(
-        reference_labelled_peaks,
-        pseudopeaks,
-        include_merged_peaks=(not args.unmerged)
+    metric = metric_from_counts(
+        peak_counts.number_of_pseudopeaks,
+        peak_counts.number_of_reference_peaks
     )
+    if args.output_directory is not None:
+        pseudopeaks = BedBase(
+            CHR=reference_labelled_peaks.get("CHR"),
+            BASE=reference_labelled_peaks.get("BASE"),
+            SCORE=peak_counts.pseudopeaks.astype(int)
+        )
+        write_tracks(
+            args.output_directory,
+            f"{chromosome}_{start}_{end}",
+            reference_labelled_peaks,
+            pseudopeaks,
+            reference_pvalue_ci,
+            comparison_pvalue_ci
+        )
+    return metric
+
+
+def report_metric(metric: float, args: argparse.Namespace) -> None:
+    # Here rather than where the metric is calculated, so that stored
+    # metrics get the same warning
+    from determine_metric import warn_about_sample_order
+    warn_about_sample_order(metric)
     if args.parsable:
         print(metric)
     else:
         print("The metric for these datasets over the range ",
-              f"{start} to {end} for chromosome {chromosome} is: {metric}.")
+              f"{args.start} to {args.end} for chromosome {args.chromosome} "
+              f"is: {metric}.")
 
 
 if __name__ == "__main__":
@@ -101,7 +378,7 @@ if __name__ == "__main__":
         "-p",
         "--parsable",
         action="store_true",
-        help=("Set this if you want the output of the script to be computer ",
+        help=("Set this if you want the output of the script to be computer "
               "parsable (and not human readable).")
     )
     parser.add_argument(
@@ -126,6 +403,58 @@ if __name__ == "__main__":
         type=int,
         help=("The window size used when calculating confidence intervals.")
     )
+    parser.add_argument(
+        "--cache_directory",
+        help=("Directory to cache the reference's peak labels and confidence "
+              "intervals in, so later runs over the same region can reuse "
+              "them. Nothing is cached if this isn't given.")
+    )
+    parser.add_argument(
+        "--cache_size",
+        default=1024,
+        type=int,
+        help=("The cache is kept under this size (in megabytes) by deleting "
+              "the least recently used entries.")
+    )
+    parser.add_argument(
+        "--output_directory",
+        help=("If given, the reference's peak types, the pseudopeaks and "
+              "both samples' p-value confidence intervals are written to "
+              "this directory as bedgraph files.")
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        help=("Work through the region this many bases at a time, so that "
+              "memory use doesn't grow with the length of the region (for "
+              "regions as large as whole chromosomes). Can't be used with "
+              "--cache_directory or --output_directory.")
+    )
+    parser.add_argument(
+        "--sparse",
+        action="store_true",
+        help=("Only look at the bases in the reference's peaks (and the "
+              "bases either side needed for confidence intervals), so that "
+              "the time taken grows with the total width of the peaks rather "
+              "than the length of the region. Can't be used with "
+              "--chunk_size, --cache_directory or --output_directory.")
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help=("Choose whether to work through the region in chunks (and "
+              "how large they are) from the memory the job has, the length "
+              "of the region and the size of the files. The plan and its "
+              "predicted and actual peak memory are printed to stderr. Can't "
+              "be used with --chunk_size or --sparse.")
+    )
+    parser.add_argument(
+        "--store",
+        help=("SQLite results store (see results_store.py). If the metric "
+              "for these files, parameters and region is already in it, it "
+              "is printed without being calculated again. Otherwise it is "
+              "calculated and added to the store.")
+    )
     parser.add_argument(
         "chromosome",
         help="The chromosome of the region you wish to inspect."
@@ -144,12 +473,12 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "reference_merged_peaks_file",
-        help=("The narrow peak file from reference dataset where peaks are"
+        help=("The narrow peak file from reference dataset where peaks are "
               "merged.")
     )
     parser.add_argument(
         "reference_unmerged_peaks_file",
-        help=("The narrow peak file from reference dataset where peaks are"
+        help=("The narrow peak file from reference dataset where peaks are "
               "not merged.")
     )
     parser.add_argument(
@@ -178,4 +507,17 @@ if __name__ == "__main__":
         help="The cutoff used to call peaks in the reference dataset."
     )
     args = parser.parse_args()
+    if args.chunk_size is not None and (
+            args.cache_directory is not None or
+            args.output_directory is not None):
+        parser.error("--chunk_size can't be used with --cache_directory or "
+                     "--output_directory.")
+    if args.sparse and (
+            args.chunk_size is not None or
+            args.cache_directory is not None or
+            args.output_directory is not None):
+        parser.error("--sparse can't be used with --chunk_size, "
+                     "--cache_directory or --output_directory.")
+    if args.plan and (args.chunk_size is not None or args.sparse):
+        parser.error("--plan can't be used with --chunk_size or --sparse.")
     main(args)
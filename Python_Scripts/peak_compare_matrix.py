@@ -0,0 +1,201 @@
+import argparse
+import sys
+import numpy as np
+import pandas as pd
+from peak_compare import read_peak_labels, read_pvalue_ci, read_track
+from typing import List, NamedTuple
+
+SAMPLE_COLUMNS = [
+    "sample",
+    "merged_peaks",
+    "unmerged_peaks",
+    "bias_track",
+    "coverage_track",
+    "pvalues",
+    "cutoff"
+]
+
+
+class SampleArrays(NamedTuple):
+    """
+    Represents everything the metric needs from one sample over a region,
+    with one value per base.
+    """
+    name: str
+    peak_types: np.ndarray
+    pvalues: np.ndarray
+    lower_pvalues: np.ndarray
+    upper_pvalues: np.ndarray
+    cutoff: float
+
+
+def read_samples_file(file_path: str) -> pd.DataFrame:
+    """Reads a tab separated file with one line per sample and the columns
+    in SAMPLE_COLUMNS (with a header line).
+    """
+    samples = pd.read_csv(file_path, sep="\t", dtype={"sample": str})
+    missing_columns = [
+        column for column in SAMPLE_COLUMNS if column not in samples.columns
+    ]
+    if missing_columns:
+        raise ValueError(f"{file_path} is missing the columns: "
+                         f"{', '.join(missing_columns)}.")
+    if samples["sample"].duplicated().any():
+        raise ValueError(f"Sample names in {file_path} must be unique.")
+    return samples
+
+
+def prepare_sample(sample: pd.Series,
+                   chromosome: str,
+                   start: int,
+                   end: int,
+                   significance: float,
+                   window_size: int) -> SampleArrays:
+    """Does the expensive work for one sample: labelling its peaks and
+    calculating its p-value confidence intervals.
+    """
+    pvalue_ci = read_pvalue_ci(
+        sample["bias_track"],
+        sample["coverage_track"],
+        chromosome,
+        start,
+        end,
+        significance,
+        window_size
+    )
+    return SampleArrays(
+        name=sample["sample"],
+        peak_types=read_peak_labels(
+            sample["merged_peaks"],
+            sample["unmerged_peaks"],
+            chromosome,
+            start,
+            end
+        ).get("SCORE").to_numpy(),
+        pvalues=read_track(
+            sample["pvalues"], chromosome, start, end
+        ).get("SCORE").to_numpy(),
+        lower_pvalues=pvalue_ci.get("LOWER_SCORE").to_numpy(),
+        upper_pvalues=pvalue_ci.get("UPPER_SCORE").to_numpy(),
+        cutoff=float(sample["cutoff"])
+    )
+
+
+def calculate_metric_matrix(samples: List[SampleArrays],
+                            include_merged_peaks: bool = True
+                            ) -> pd.DataFrame:
+    """Calculates the metric for every ordered pair of samples.
+
+    For each reference, every comparison sample is scored at once. Only the
+    bases in the reference's peaks are looked at, as the other bases can't
+    be pseudopeaks.
+
+    Args:
+        samples (List[SampleArrays]): Samples over the same region.
+        include_merged_peaks (bool): See determine_metric.calculate_metric().
+
+    Returns:
+        pd.DataFrame: The metric with the reference sample as the row and the
+        comparison sample as the column. Comparing a sample with itself is
+        left as NaN.
+    """
+    names = [sample.name for sample in samples]
+    upper_pvalues = np.stack([sample.upper_pvalues for sample in samples])
+    pvalues = np.stack([sample.pvalues for sample in samples])
+    metric = np.full((len(samples), len(samples)), np.nan)
+    for row, reference in enumerate(samples):
+        merged_only = reference.peak_types == 1
+        unmerged = reference.peak_types == 2
+        # The same criteria as determine_psuedopeaks(), for all comparison
+        # samples at once
+        number_of_pseudopeaks = (
+            (upper_pvalues[:, unmerged] >
+             reference.lower_pvalues[unmerged]).sum(axis=1) +
+            (pvalues[:, merged_only] > reference.cutoff).sum(axis=1)
+        )
+        if include_merged_peaks:
+            number_of_reference_peaks = np.count_nonzero(
+                reference.peak_types > 1)
+        else:
+            number_of_reference_peaks = np.count_nonzero(merged_only)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            metric[row] = number_of_pseudopeaks / number_of_reference_peaks
+        metric[row, row] = np.nan
+    return pd.DataFrame(metric, index=names, columns=names)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="PeakCompareMatrix",
+        description=("Determine the metric for every pair of samples in a "
+                     "list, over one region.")
+    )
+    parser.add_argument(
+        "--unmerged",
+        action="store_true",
+        help=("Set this if you want to discount peaks that are a result of "
+              "merging when calculating the metric.")
+    )
+    parser.add_argument(
+        "--significance",
+        default=0.95,
+        type=float,
+        help="The significance used when calculating confidence intervals."
+    )
+    parser.add_argument(
+        "--window_size",
+        default=50,
+        type=int,
+        help="The window size used when calculating confidence intervals."
+    )
+    parser.add_argument(
+        "--output",
+        help=("File to write the matrix to (tab separated). Defaults to "
+              "standard output.")
+    )
+    parser.add_argument(
+        "samples_file",
+        help=("Tab separated file with a header line and the columns "
+              f"{', '.join(SAMPLE_COLUMNS)}.")
+    )
+    parser.add_argument(
+        "chromosome",
+        help="The chromosome of the region you wish to inspect."
+    )
+    parser.add_argument(
+        "start",
+        type=int,
+        help=("The base pair position at the start of the region you wish to "
+              "inspect")
+    )
+    parser.add_argument(
+        "end",
+        type=int,
+        help=("The base pair position at the end of the region you wish to "
+              "inspect")
+    )
+    args = parser.parse_args()
+
+    try:
+        samples_table = read_samples_file(args.samples_file)
+    except (FileNotFoundError, ValueError) as error:
+        print(error)
+        sys.exit(1)
+    samples = [
+        prepare_sample(
+            sample,
+            args.chromosome,
+            args.start,
+            args.end,
+            args.significance,
+            args.window_size
+        )
+        for _, sample in samples_table.iterrows()
+    ]
+    metric_matrix = calculate_metric_matrix(
+        samples, include_merged_peaks=(not args.unmerged))
+    metric_matrix.to_csv(
+        args.output if args.output is not None else sys.stdout,
+        sep="\t",
+        index_label="reference"
+    )
@@ -0,0 +1,302 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import pandas as pd
+from file_digests import FileDigests, hash_values
+from typing import Dict, Optional, Sequence
+
+# Increase this whenever the way the metric is calculated changes, so that
+# metrics stored by older versions are no longer used.
+STORE_VERSION = "1"
+# How long (in seconds) to wait for another job writing to the store
+LOCK_TIMEOUT = 600
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_digests (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS comparisons (
+    comparison TEXT PRIMARY KEY,
+    files TEXT NOT NULL,
+    parameters TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    comparison TEXT NOT NULL,
+    chromosome TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    "end" INTEGER NOT NULL,
+    pseudopeaks INTEGER,
+    reference_peaks INTEGER,
+    metric REAL,
+    PRIMARY KEY (comparison, chromosome, start, "end")
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS metrics_by_position
+    ON metrics (chromosome, start);
+"""
+METRIC_COLUMNS = [
+    "chromosome",
+    "start",
+    "end",
+    "pseudopeaks",
+    "reference_peaks",
+    "metric"
+]
+
+
+def comparison_parameters(cutoff: float,
+                          significance: float,
+                          window_size: int,
+                          include_merged_peaks: bool) -> Dict[str, str]:
+    """Everything other than the input files that the metric depends on."""
+    return {
+        "cutoff": str(float(cutoff)),
+        "significance": str(float(significance)),
+        "window_size": str(int(window_size)),
+        "include_merged_peaks": str(bool(include_merged_peaks))
+    }
+
+
+class ResultsStore:
+    """
+    A SQLite database of metrics that have been calculated, so that they can
+    be looked up rather than calculated again.
+
+    Metrics are keyed by the comparison (the contents of the input files and
+    the parameters used) and the region. Digests of input files are kept in
+    the database (keyed by size and modification time) so unchanged files
+    are only hashed once. Several jobs can write to one store, each waiting
+    for the others' transactions to finish.
+    """
+
+    def __init__(self, file_path: str):
+        """
+        Args:
+            file_path (str): The database file (created if it doesn't
+                exist).
+        """
+        self.file_path = file_path
+        self._connection = sqlite3.connect(file_path, timeout=LOCK_TIMEOUT)
+        with self._connection:
+            self._connection.executescript(SCHEMA)
+        saved_digests = {
+            path: {"size": size, "mtime_ns": mtime_ns, "digest": digest}
+            for path, size, mtime_ns, digest in self._connection.execute(
+                "SELECT path, size, mtime_ns, digest FROM file_digests"
+            )
+        }
+        self._digests = FileDigests(saved_digests, self._save_digest)
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def _save_digest(self, file_path: str, entry: dict) -> None:
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO file_digests VALUES (?, ?, ?, ?)",
+                (file_path, entry["size"], entry["mtime_ns"], entry["digest"])
+            )
+
+    def comparison_key(self,
+                       input_files: Sequence[str],
+                       parameters: Dict[str, str]) -> str:
+        """Fingerprints a comparison, recording what it was made from.
+
+        Args:
+            input_files (Sequence[str]): Files the metric is calculated from
+                (in a fixed order, such as a ComparisonFiles).
+            parameters (Dict[str, str]): See comparison_parameters().
+
+        Returns:
+            str: The key of the comparison.
+        """
+        values = [STORE_VERSION]
+        for file_path in input_files:
+            values.append(self._digests.digest(file_path))
+        for name in sorted(parameters):
+            values.extend([name, str(parameters[name])])
+        comparison = hash_values(values)
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO comparisons VALUES (?, ?, ?)",
+                (
+                    comparison,
+                    json.dumps([os.path.realpath(file_path)
+                                for file_path in input_files]),
+                    json.dumps(parameters, sort_keys=True)
+                )
+            )
+        return comparison
+
+    def insert(self, comparison: str, results: pd.DataFrame) -> None:
+        """Stores the metrics of many regions in one transaction.
+
+        Args:
+            comparison (str): Key from comparison_key().
+            results (pd.DataFrame): One row per region, with the columns in
+                METRIC_COLUMNS (the counts can be missing).
+        """
+        rows = (
+            (comparison, row.chromosome, int(row.start), int(row.end),
+             None if pd.isna(row.pseudopeaks) else int(row.pseudopeaks),
+             None if pd.isna(row.reference_peaks)
+             else int(row.reference_peaks),
+             float(row.metric))
+            for row in results[METRIC_COLUMNS].itertuples(index=False)
+        )
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+
+    def insert_metric(self,
+                      comparison: str,
+                      chromosome: str,
+                      start: int,
+                      end: int,
+                      metric: float) -> None:
+        """Stores the metric of one region (without its counts)."""
+        self.insert(comparison, pd.DataFrame([{
+            "chromosome": chromosome,
+            "start": start,
+            "end": end,
+            "pseudopeaks": None,
+            "reference_peaks": None,
+            "metric": metric
+        }]))
+
+    def stored_metric(self,
+                      comparison: str,
+                      chromosome: str,
+                      start: int,
+                      end: int) -> Optional[float]:
+        """The stored metric of one region, or None if it isn't stored."""
+        stored = self._connection.execute(
+            "SELECT metric FROM metrics WHERE comparison = ? "
+            "AND chromosome = ? AND start = ? AND \"end\" = ?",
+            (comparison, chromosome, start, end)
+        ).fetchone()
+        if stored is None:
+            return None
+        # SQLite stores NaN (from regions without reference peaks) as NULL
+        return float("nan") if stored[0] is None else stored[0]
+
+    def lookup(self, comparison: str, regions: pd.DataFrame) -> pd.DataFrame:
+        """Finds the stored metrics of a list of regions.
+
+        Args:
+            comparison (str): Key from comparison_key().
+            regions (pd.DataFrame): Regions with the columns chromosome,
+                start and end.
+
+        Returns:
+            pd.DataFrame: The regions (METRIC_COLUMNS) that have been stored.
+        """
+        with self._connection:
+            self._connection.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS requested ("
+                "chromosome TEXT, start INTEGER, \"end\" INTEGER)")
+            self._connection.execute("DELETE FROM requested")
+            self._connection.executemany(
+                "INSERT INTO requested VALUES (?, ?, ?)",
+                ((row.chromosome, int(row.start), int(row.end))
+                 for row in regions.itertuples(index=False))
+            )
+        return pd.read_sql_query(
+            "SELECT metrics.chromosome, metrics.start, metrics.\"end\", "
+            "pseudopeaks, reference_peaks, metric FROM requested "
+            "JOIN metrics ON metrics.comparison = ? "
+            "AND metrics.chromosome = requested.chromosome "
+            "AND metrics.start = requested.start "
+            "AND metrics.\"end\" = requested.\"end\"",
+            self._connection,
+            params=(comparison,),
+            dtype={"pseudopeaks": "Int64", "reference_peaks": "Int64"}
+        )
+
+    def query(self,
+              chromosome: str,
+              start: int,
+              end: int,
+              comparison: Optional[str] = None) -> pd.DataFrame:
+        """Finds the stored metrics of every region overlapping a range.
+
+        Args:
+            chromosome (str): Chromosome of the range.
+            start (int): Start of the range.
+            end (int): End of the range (included).
+            comparison (Optional[str]): Only give the metrics of this
+                comparison. Defaults to every comparison.
+
+        Returns:
+            pd.DataFrame: The comparison key and METRIC_COLUMNS of each
+            region, sorted by position.
+        """
+        sql = (
+            "SELECT comparison, chromosome, start, \"end\", pseudopeaks, "
+            "reference_peaks, metric FROM metrics "
+            "WHERE chromosome = ? AND start <= ? AND \"end\" >= ?"
+        )
+        params = [chromosome, end, start]
+        if comparison is not None:
+            sql += " AND comparison = ?"
+            params.append(comparison)
+        sql += " ORDER BY start, \"end\", comparison"
+        return pd.read_sql_query(
+            sql,
+            self._connection,
+            params=params,
+            dtype={"pseudopeaks": "Int64", "reference_peaks": "Int64"}
+        )
+
+    def comparisons(self) -> pd.DataFrame:
+        """Every comparison in the store, with its files and parameters."""
+        return pd.read_sql_query(
+            "SELECT comparisons.comparison, files, parameters, "
+            "COUNT(metrics.comparison) AS regions FROM comparisons "
+            "LEFT JOIN metrics USING (comparison) "
+            "GROUP BY comparisons.comparison",
+            self._connection
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="ResultsStore",
+        description="Look up the metrics kept in a results store."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    query_parser = subparsers.add_parser(
+        "query",
+        help="Print the stored metrics of regions overlapping a range."
+    )
+    query_parser.add_argument("store_file")
+    query_parser.add_argument(
+        "--comparison",
+        help="Only print the metrics of this comparison."
+    )
+    query_parser.add_argument("chromosome")
+    query_parser.add_argument("start", type=int)
+    query_parser.add_argument("end", type=int)
+    comparisons_parser = subparsers.add_parser(
+        "comparisons",
+        help="Print the comparisons in the store."
+    )
+    comparisons_parser.add_argument("store_file")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.store_file):
+        print(f"{args.store_file} does not exist.")
+        sys.exit(1)
+    store = ResultsStore(args.store_file)
+    if args.command == "query":
+        results = store.query(
+            args.chromosome, args.start, args.end, args.comparison)
+    else:
+        results = store.comparisons()
+    store.close()
+    results.to_csv(sys.stdout, sep="\t", index=False, na_rep="NA")
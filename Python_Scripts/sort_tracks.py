@@ -0,0 +1,176 @@
+import argparse
+import gzip
+import heapq
+import os
+import sys
+import tempfile
+from bgzf import build_index, compress_file, is_gzipped, write_index
+from IO import is_sorted
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+DEFAULT_MEMORY = 1024
+MEGABYTE = 1 << 20
+# Rough size of the python objects kept for each line on top of its text
+LINE_OVERHEAD = 150
+META_DATA_PREFIXES = (b"track", b"browser", b"#")
+
+
+def sort_key(line: bytes) -> Tuple[bytes, int, int]:
+    """Sorts by chromosome name, then start, then end (as MACS writes its
+    files).
+    """
+    chromosome, start, end = line.split(b"\t", 3)[:3]
+    return chromosome, int(start), int(end)
+
+
+def _open_input(file_path: str) -> BinaryIO:
+    return gzip.open(file_path, "rb") if is_gzipped(file_path) \
+        else open(file_path, "rb")
+
+
+def _write_run(lines: List[bytes], directory: str) -> str:
+    lines.sort(key=sort_key)
+    file_descriptor, run_path = tempfile.mkstemp(
+        suffix=".run", dir=directory)
+    with os.fdopen(file_descriptor, "wb") as run_file:
+        run_file.writelines(lines)
+    return run_path
+
+
+def _read_run(run_path: str) -> Iterator[bytes]:
+    with open(run_path, "rb") as run_file:
+        yield from run_file
+
+
+def sort_file(input_path: str,
+              output_path: str,
+              memory: int = DEFAULT_MEMORY * MEGABYTE,
+              temporary_directory: Optional[str] = None) -> int:
+    """Sorts a bedgraph or narrow peak file by chromosome name and position
+    without holding all of it in memory (an external merge sort).
+
+    Lines are read until they fill the memory given, sorted and written to a
+    temporary file (a run). The runs are then merged, reading one line of
+    each at a time. Meta data lines at the top of the file (such as a track
+    line) are kept at the top.
+
+    Args:
+        input_path (str): The file to sort (can be gzip compressed).
+        output_path (str): Where to write the sorted file. If this ends in
+            .gz, it is block gzipped and indexed (see bgzf.py).
+        memory (int): Roughly how many bytes of lines to hold at once.
+        temporary_directory (str): Where to write the runs. Defaults to the
+            directory of the output file, as runs take up as much space as
+            the file.
+
+    Returns:
+        int: The number of runs the file was split into.
+    """
+    if temporary_directory is None:
+        temporary_directory = os.path.dirname(os.path.abspath(output_path))
+    is_compressed = output_path.endswith(".gz")
+    plain_output_path = output_path[:-len(".gz")] if is_compressed \
+        else output_path
+    temporary_output_path = f"{plain_output_path}.{os.getpid()}.tmp"
+
+    meta_data = []
+    run_paths = []
+    lines = []
+    lines_size = 0
+    try:
+        with _open_input(input_path) as input_file:
+            for line in input_file:
+                if not line.strip():
+                    continue
+                if not lines and not run_paths and \
+                        line.startswith(META_DATA_PREFIXES):
+                    meta_data.append(line)
+                    continue
+                if not line.endswith(b"\n"):
+                    line += b"\n"
+                lines.append(line)
+                lines_size += len(line) + LINE_OVERHEAD
+                if lines_size >= memory:
+                    run_paths.append(
+                        _write_run(lines, temporary_directory))
+                    lines = []
+                    lines_size = 0
+        with open(temporary_output_path, "wb") as output_file:
+            output_file.writelines(meta_data)
+            if not run_paths:
+                # Everything fit in memory, so there is nothing to merge
+                lines.sort(key=sort_key)
+                output_file.writelines(lines)
+            else:
+                if lines:
+                    run_paths.append(
+                        _write_run(lines, temporary_directory))
+                lines = []
+                output_file.writelines(heapq.merge(
+                    *(_read_run(run_path) for run_path in run_paths),
+                    key=sort_key
+                ))
+    finally:
+        for run_path in run_paths:
+            os.remove(run_path)
+
+    if is_compressed:
+        compress_file(temporary_output_path, output_path)
+        os.remove(temporary_output_path)
+        write_index(output_path, build_index(output_path))
+    else:
+        os.replace(temporary_output_path, output_path)
+    return max(len(run_paths), 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="SortTracks",
+        description=("Check that bedgraph and narrow peak files are sorted "
+                     "by chromosome name and position, or sort them.")
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    check_parser = subparsers.add_parser(
+        "check",
+        help="Exit with an error if any of the files aren't sorted."
+    )
+    check_parser.add_argument("file_paths", nargs="+")
+    sort_parser = subparsers.add_parser(
+        "sort",
+        help="Write a sorted copy of a file."
+    )
+    sort_parser.add_argument("input_file")
+    sort_parser.add_argument(
+        "output_file",
+        help=("Where to write the sorted file. If this ends in .gz, it is "
+              "block gzipped and indexed.")
+    )
+    sort_parser.add_argument(
+        "--memory",
+        default=DEFAULT_MEMORY,
+        type=int,
+        help="Roughly how much memory (in megabytes) to use."
+    )
+    sort_parser.add_argument(
+        "--temporary_directory",
+        help=("Where to write temporary files (as large as the input file "
+              "in total). Defaults to the directory of the output file.")
+    )
+    args = parser.parse_args()
+
+    if args.command == "check":
+        unsorted_files = [
+            file_path for file_path in args.file_paths
+            if not is_sorted(file_path)
+        ]
+        for file_path in unsorted_files:
+            print(f"{file_path} is not sorted.")
+        if unsorted_files:
+            sys.exit(1)
+    else:
+        sort_file(
+            args.input_file,
+            args.output_file,
+            args.memory * MEGABYTE,
+            args.temporary_directory
+        )
@@ -0,0 +1,301 @@
+import numpy as np
+from chunked_compare import ComparisonFiles
+from create_confidence_intervals import (
+    ConfidenceInterval,
+    calculate_lambda_ci,
+    calculate_pvalue_ci
+)
+from determine_metric import count_peaks, metric_from_counts
+from extract_region import interval_scores_at_bases
+from IO import (
+    BEDGRAPH_DTYPES,
+    Bed,
+    Region,
+    SortOrderCheck,
+    read_region_chunks
+)
+from typing import Dict, List, NamedTuple, Tuple
+
+
+class Segments(NamedTuple):
+    """
+    Represents stretches of bases (first and last base of each, both
+    included), sorted and not overlapping.
+    """
+    firsts: np.ndarray
+    lasts: np.ndarray
+
+
+class PeakIndex:
+    """
+    An index of the peaks in one or more narrow peak files, for finding the
+    peaks that overlap a region without looking at every peak.
+    """
+
+    def __init__(self, peak_files: List[Bed]):
+        """
+        Args:
+            peak_files (List[Bed]): Peaks to index (such as the merged and
+                unmerged peaks of a sample).
+        """
+        starts: Dict[str, List[np.ndarray]] = {}
+        ends: Dict[str, List[np.ndarray]] = {}
+        for peaks in peak_files:
+            for chromosome, chromosome_peaks in peaks.get().groupby(
+                    "CHR", sort=False):
+                starts.setdefault(chromosome, []).append(
+                    chromosome_peaks["START"].to_numpy())
+                ends.setdefault(chromosome, []).append(
+                    chromosome_peaks["END"].to_numpy())
+        self._chromosomes: Dict[str, Tuple[np.ndarray, ...]] = {}
+        for chromosome in starts:
+            chromosome_starts = np.concatenate(starts[chromosome])
+            chromosome_ends = np.concatenate(ends[chromosome])
+            order = np.argsort(chromosome_starts, kind="stable")
+            chromosome_ends = chromosome_ends[order]
+            self._chromosomes[chromosome] = (
+                chromosome_starts[order],
+                chromosome_ends,
+                # Peaks can overlap (and contain one another), so the
+                # furthest end so far is what can be binary searched
+                np.maximum.accumulate(chromosome_ends)
+            )
+
+    def overlapping(self,
+                    chromosome: str,
+                    start: int,
+                    end: int) -> Tuple[np.ndarray, np.ndarray]:
+        """The starts and ends of the peaks that overlap a region (with the
+        end of the region included).
+        """
+        if chromosome not in self._chromosomes:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty
+        starts, ends, furthest_ends = self._chromosomes[chromosome]
+        first = int(np.searchsorted(furthest_ends, start, side="right"))
+        last = int(np.searchsorted(starts, end, side="right"))
+        overlaps = ends[first:last] > start
+        return starts[first:last][overlaps], ends[first:last][overlaps]
+
+    def segments(self,
+                 chromosome: str,
+                 start: int,
+                 end: int,
+                 gap: int = 0) -> Segments:
+        """The bases of a region that are in a peak, as sorted stretches.
+
+        Args:
+            chromosome (str): Chromosome of the region.
+            start (int): Start of the region.
+            end (int): End of the region (included).
+            gap (int): Stretches this close to one another are joined, so
+                that there are fewer of them.
+
+        Returns:
+            Segments: The stretches of bases, which only cover bases in the
+            region.
+        """
+        starts, ends = self.overlapping(chromosome, start, end)
+        firsts = np.maximum(starts, start)
+        lasts = np.minimum(ends - 1, end)
+        if len(firsts) == 0:
+            return Segments(firsts, lasts)
+        # A peak starts a new stretch if it begins after every peak before
+        # it has ended (plus the gap)
+        furthest_lasts = np.maximum.accumulate(lasts)
+        is_new = np.ones(len(firsts), dtype=bool)
+        is_new[1:] = firsts[1:] > furthest_lasts[:-1] + gap + 1
+        stretch_starts = np.flatnonzero(is_new)
+        stretch_ends = np.append(stretch_starts[1:], len(firsts)) - 1
+        return Segments(firsts[stretch_starts], furthest_lasts[stretch_ends])
+
+
+class _WindowedTrack:
+    """
+    The intervals of a bedgraph file that overlap a set of windows within a
+    region, along with the smallest score over the whole region. The file is
+    streamed once (only the blocks around the region for BGZF files),
+    keeping only the intervals that are needed, and must be sorted by
+    chromosome name and then position.
+    """
+
+    def __init__(self,
+                 file_path: str,
+                 chromosome: str,
+                 start: int,
+                 end: int,
+                 windows: Segments,
+                 parser: str = "auto"):
+        order = SortOrderCheck(file_path)
+        self.minimum = np.nan
+        kept = {
+            column: []
+            for column in BEDGRAPH_DTYPES
+            if column != "CHR"
+        }
+        for chunk in read_region_chunks(
+                file_path, BEDGRAPH_DTYPES, Region(chromosome, start, end),
+                parser=parser):
+            order.update(chunk["CHR"], chunk["START"])
+            on_chromosome = chunk["CHR"] == chromosome
+            overlaps_region = on_chromosome & \
+                (chunk["START"] <= end) & (chunk["END"] > start)
+            if np.any(overlaps_region):
+                self.minimum = np.fmin(
+                    self.minimum, chunk["SCORE"][overlaps_region].min())
+                starts = chunk["START"][overlaps_region]
+                ends = chunk["END"][overlaps_region]
+                # An interval overlaps a window only if it overlaps the
+                # first window that ends at or after its start
+                nearest = np.searchsorted(windows.lasts, starts, side="left")
+                in_window = nearest < len(windows.lasts)
+                in_window[in_window] = \
+                    ends[in_window] > windows.firsts[nearest[in_window]]
+                for column in kept:
+                    kept[column].append(
+                        chunk[column][overlaps_region][in_window])
+            # Nothing after this can overlap the region
+            if np.any(on_chromosome & (chunk["START"] > end)):
+                break
+        self.columns = {
+            column: np.concatenate(values) if values
+            else np.empty(0, dtype=BEDGRAPH_DTYPES[column])
+            for column, values in kept.items()
+        }
+
+    def scores(self, first_base: int, last_base: int) -> np.ndarray:
+        """The score of each base from first_base to last_base (inclusive),
+        with bases not in the file given the smallest score in the region.
+        These bases must be within one of the windows.
+        """
+        first = int(np.searchsorted(
+            self.columns["END"], first_base, side="right"))
+        last = int(np.searchsorted(
+            self.columns["START"], last_base, side="right"))
+        return np.nan_to_num(interval_scores_at_bases(
+            self.columns["START"][first:last],
+            self.columns["END"][first:last],
+            self.columns["SCORE"][first:last],
+            first_base,
+            last_base
+        ), nan=self.minimum)
+
+
+def _pvalue_ci(bias: _WindowedTrack,
+               coverage: _WindowedTrack,
+               segment_first: int,
+               segment_last: int,
+               halo_first: int,
+               halo_last: int,
+               significance: float,
+               window_size: int) -> ConfidenceInterval:
+    lambda_ci = calculate_lambda_ci(
+        bias.scores(halo_first, halo_last),
+        significance,
+        window_size,
+        minimum_lambda=bias.minimum
+    )
+    segment = slice(segment_first - halo_first,
+                    segment_last - halo_first + 1)
+    return calculate_pvalue_ci(
+        coverage.scores(segment_first, segment_last),
+        ConfidenceInterval(lower=lambda_ci.lower[segment],
+                           upper=lambda_ci.upper[segment])
+    )
+
+
+def _peak_bases(index: PeakIndex,
+                chromosome: str,
+                first_base: int,
+                last_base: int) -> np.ndarray:
+    """1 for bases within a peak, 0 for those that aren't."""
+    starts, ends = index.overlapping(chromosome, first_base, last_base)
+    return np.nan_to_num(interval_scores_at_bases(
+        starts, ends, np.ones(len(starts)), first_base, last_base), nan=0)
+
+
+def calculate_metric_sparse(files: ComparisonFiles,
+                            chromosome: str,
+                            start: int,
+                            end: int,
+                            cutoff: float,
+                            significance: float = 0.95,
+                            window_size: int = 50,
+                            include_merged_peaks: bool = True) -> float:
+    """Calculates the metric by only looking at the bases in the reference's
+    peaks, rather than every base of the region.
+
+    Bases outside of peaks can't be pseudopeaks or reference peaks, so they
+    never change the metric. Each stretch of peaks is calculated with a halo
+    of window_size // 2 bases on either side (so that the confidence
+    intervals are the same as for the whole region), and only the intervals
+    of the bedgraph files that overlap these are kept. The result is the same
+    as peak_compare.main() gives, but the time taken grows with the total
+    width of the peaks instead of the length of the region.
+
+    Args:
+        files (ComparisonFiles): The files to compare.
+        chromosome (str): Chromosome of the region.
+        start (int): Start of the region.
+        end (int): End of the region (included).
+        cutoff (float): The cutoff used to call peaks in the reference.
+        significance (float): See calculate_lambda_ci().
+        window_size (int): See calculate_lambda_ci().
+        include_merged_peaks (bool): See calculate_metric().
+
+    Returns:
+        float: The metric.
+    """
+    merged_peaks = Bed.read_region(
+        files.reference_merged_peaks, chromosome, start, end)
+    unmerged_peaks = Bed.read_region(
+        files.reference_unmerged_peaks, chromosome, start, end)
+    halo = window_size // 2
+    # Stretches whose halos would overlap are joined, so that each base of
+    # the bedgraph files belongs to at most one of them
+    segments = PeakIndex([merged_peaks, unmerged_peaks]).segments(
+        chromosome, start, end, gap=2 * halo)
+    halos = Segments(np.maximum(segments.firsts - halo, start),
+                     np.minimum(segments.lasts + halo, end))
+    merged_index = PeakIndex([merged_peaks])
+    unmerged_index = PeakIndex([unmerged_peaks])
+
+    tracks = {
+        name: _WindowedTrack(getattr(files, name), chromosome, start, end,
+                             halos)
+        for name in ("reference_bias_track",
+                     "reference_coverage_track",
+                     "comparison_bias_track",
+                     "comparison_coverage_track",
+                     "comparison_pvalues")
+    }
+
+    number_of_pseudopeaks = 0
+    number_of_reference_peaks = 0
+    for segment_first, segment_last, halo_first, halo_last in zip(
+            segments.firsts, segments.lasts, halos.firsts, halos.lasts):
+        peak_type = np.zeros(segment_last - segment_first + 1)
+        for index in (merged_index, unmerged_index):
+            peak_type += _peak_bases(
+                index, chromosome, segment_first, segment_last)
+        reference_pvalue_ci = _pvalue_ci(
+            tracks["reference_bias_track"],
+            tracks["reference_coverage_track"],
+            segment_first, segment_last, halo_first, halo_last,
+            significance, window_size)
+        comparison_pvalue_ci = _pvalue_ci(
+            tracks["comparison_bias_track"],
+            tracks["comparison_coverage_track"],
+            segment_first, segment_last, halo_first, halo_last,
+            significance, window_size)
+        peak_counts = count_peaks(
+            reference_pvalue_ci.lower,
+            comparison_pvalue_ci.upper,
+            tracks["comparison_pvalues"].scores(segment_first, segment_last),
+            peak_type,
+            cutoff,
+            include_merged_peaks
+        )
+        number_of_pseudopeaks += peak_counts.number_of_pseudopeaks
+        number_of_reference_peaks += peak_counts.number_of_reference_peaks
+    return metric_from_counts(number_of_pseudopeaks, number_of_reference_peaks)
@@ -56,6 +56,12 @@ def all_variables_correct(config_variables: dict) -> bool:
         config_variables["CUTOFF"],
         "CUTOFF"
     )
+    for variable in ["CACHE_SIZE", "CHUNK_SIZE", "SCREEN_BIN_SIZE"]:
+        if not is_variable_missing(variable, config_variables, quiet=True):
+            variables_correct = variables_correct and is_positive_integer(
+                config_variables[variable],
+                variable
+            )
     variables_correct = variables_correct and is_larger(
         config_variables["START"],
         config_variables["END"]
@@ -78,6 +84,13 @@ def any_file_paths_missing(config_variables: dict) -> bool:
         file_missing = file_missing or path_does_not_exist(
             config_variables[path], path, dir=True
         )
+    if not is_variable_missing("REGIONS_FILE", config_variables, quiet=True):
+        file_missing = file_missing or path_does_not_exist(
+            config_variables["REGIONS_FILE"], "REGIONS_FILE"
+        )
+        # Shards' results need somewhere to go
+        file_missing = file_missing or is_variable_missing(
+            "RESULTS_DIRECTORY", config_variables)
     return file_missing
 
 
@@ -0,0 +1,343 @@
+import argparse
+import json
+import struct
+import sys
+import numpy as np
+from IO import BedGraph, BedGraphSummary
+from typing import Dict, List, Optional, Sequence
+
+# File layout:
+#   magic | arrays (each aligned to ARRAY_ALIGNMENT) | JSON header | footer
+# The footer holds the offset and length of the JSON header followed by the
+# magic again, so a reader only needs the tail of the file to find any
+# array. Arrays are memory mapped, so a query only touches the pages it needs.
+ZOOM_TRACK_MAGIC = b"PCZOOM01"
+FOOTER = struct.Struct("<QQ8s")
+ARRAY_ALIGNMENT = 64
+DEFAULT_ZOOM_LEVELS = (100, 1000, 10000)
+SUMMARY_COLUMNS = ("MIN", "MAX", "MEAN", "SUM")
+TRACK_NAMES = ("coverage", "bias", "pvalue")
+
+
+def summarise_bins(starts: np.ndarray,
+                   ends: np.ndarray,
+                   scores: np.ndarray,
+                   bin_size: int,
+                   number_of_bins: int) -> Dict[str, np.ndarray]:
+    """Summarises the sorted, non-overlapping intervals of one chromosome over
+    fixed size bins.
+
+    Args:
+        starts: Start of each interval.
+        ends: End of each interval.
+        scores: Score of each interval.
+        bin_size: Width of each bin in bases.
+        number_of_bins: Number of bins covering the chromosome.
+
+    Returns:
+        Dict[str, np.ndarray]: MIN, MAX, MEAN and SUM for each bin. Bins that
+        no interval overlaps have NaN for MIN, MAX and MEAN and 0 for SUM.
+    """
+    non_empty = ends > starts
+    starts = starts[non_empty]
+    ends = ends[non_empty]
+    scores = scores[non_empty]
+
+    # Split every interval at the bin edges it crosses so that each piece
+    # lies in exactly one bin.
+    first_bins = starts // bin_size
+    bins_spanned = (ends - 1) // bin_size - first_bins + 1
+    piece_interval = np.repeat(np.arange(len(starts)), bins_spanned)
+    piece_offsets = np.arange(len(piece_interval)) - np.repeat(
+        np.cumsum(bins_spanned) - bins_spanned, bins_spanned)
+    piece_bins = first_bins[piece_interval] + piece_offsets
+    piece_starts = np.maximum(starts[piece_interval], piece_bins * bin_size)
+    piece_ends = np.minimum(ends[piece_interval], (piece_bins + 1) * bin_size)
+    piece_scores = scores[piece_interval]
+    piece_lengths = piece_ends - piece_starts
+
+    summary = {
+        "MIN": np.full(number_of_bins, np.nan),
+        "MAX": np.full(number_of_bins, np.nan),
+        "MEAN": np.full(number_of_bins, np.nan),
+        "SUM": np.zeros(number_of_bins)
+    }
+    if len(piece_bins) == 0:
+        return summary
+    group_starts = np.flatnonzero(
+        np.concatenate(([True], piece_bins[1:] != piece_bins[:-1])))
+    bins = piece_bins[group_starts]
+    covered_bases = np.add.reduceat(piece_lengths, group_starts)
+    summary["MIN"][bins] = np.minimum.reduceat(piece_scores, group_starts)
+    summary["MAX"][bins] = np.maximum.reduceat(piece_scores, group_starts)
+    summary["SUM"][bins] = np.add.reduceat(
+        piece_scores * piece_lengths, group_starts)
+    summary["MEAN"][bins] = summary["SUM"][bins] / covered_bases
+    return summary
+
+
+def _array_key(track: str, chromosome: str, level: str, column: str) -> str:
+    return f"{track}/{chromosome}/{level}/{column}"
+
+
+def convert_to_zoom_track(track_files: Dict[str, str],
+                          output_path: str,
+                          zoom_levels: Sequence[int] = DEFAULT_ZOOM_LEVELS
+                          ) -> None:
+    """Converts bedgraph files into a single zoom track file holding the base
+    resolution intervals and precomputed bin summaries.
+
+    Args:
+        track_files: Track name (e.g. "coverage") to bedgraph file path.
+        output_path: Path to write the zoom track to.
+        zoom_levels: Bin sizes to precompute summaries for.
+    """
+    header = {
+        "tracks": list(track_files),
+        "zoom_levels": sorted(int(level) for level in zoom_levels),
+        "chromosomes": {},
+        "arrays": {}
+    }
+    with open(output_path, "wb") as output_file:
+        output_file.write(ZOOM_TRACK_MAGIC)
+
+        def write_array(key: str, array: np.ndarray) -> None:
+            padding = -output_file.tell() % ARRAY_ALIGNMENT
+            output_file.write(b"\0" * padding)
+            header["arrays"][key] = {
+                "offset": output_file.tell(),
+                "dtype": array.dtype.str,
+                "length": len(array)
+            }
+            output_file.write(np.ascontiguousarray(array).tobytes())
+
+        # Tracks are converted one at a time so only one is ever in memory
+        for track, file_path in track_files.items():
+            bedgraph = BedGraph.read_from_file(file_path)
+            if bedgraph is None:
+                raise FileNotFoundError(f"Could not read {file_path}.")
+            for chromosome, intervals in bedgraph.get().groupby(
+                    "CHR", sort=False):
+                starts = intervals["START"].to_numpy()
+                ends = intervals["END"].to_numpy()
+                scores = intervals["SCORE"].to_numpy()
+                chromosome_end = max(
+                    header["chromosomes"].get(chromosome, 0),
+                    int(ends.max())
+                )
+                header["chromosomes"][chromosome] = chromosome_end
+                write_array(_array_key(track, chromosome, "base", "START"),
+                            starts)
+                write_array(_array_key(track, chromosome, "base", "END"),
+                            ends)
+                write_array(_array_key(track, chromosome, "base", "SCORE"),
+                            scores)
+                for bin_size in header["zoom_levels"]:
+                    summary = summarise_bins(
+                        starts,
+                        ends,
+                        scores,
+                        bin_size,
+                        -(-int(ends.max()) // bin_size)
+                    )
+                    for column in SUMMARY_COLUMNS:
+                        write_array(
+                            _array_key(track, chromosome, bin_size, column),
+                            summary[column]
+                        )
+
+        header_bytes = json.dumps(header).encode()
+        header_offset = output_file.tell()
+        output_file.write(header_bytes)
+        output_file.write(FOOTER.pack(
+            header_offset, len(header_bytes), ZOOM_TRACK_MAGIC))
+
+
+class ZoomTrack:
+    """
+    Reader for zoom track files made by convert_to_zoom_track().
+    """
+
+    def __init__(self, file_path: str):
+        """
+        Opens a zoom track file.
+
+        Args:
+            file_path (str): Path to the zoom track file.
+        """
+        self.file_path = file_path
+        self._buffer = np.memmap(file_path, dtype=np.uint8, mode="r")
+        header_offset, header_length, magic = FOOTER.unpack(
+            self._buffer[-FOOTER.size:].tobytes())
+        if magic != ZOOM_TRACK_MAGIC or \
+                self._buffer[:len(ZOOM_TRACK_MAGIC)].tobytes() != magic:
+            raise ValueError(f"{file_path} is not a zoom track file.")
+        self._header = json.loads(
+            self._buffer[header_offset:header_offset + header_length]
+            .tobytes())
+
+    @property
+    def tracks(self) -> List[str]:
+        return self._header["tracks"]
+
+    @property
+    def zoom_levels(self) -> List[int]:
+        return self._header["zoom_levels"]
+
+    @property
+    def chromosomes(self) -> Dict[str, int]:
+        """Chromosome names and the furthest position covered by a track."""
+        return self._header["chromosomes"]
+
+    def _array(self,
+               track: str,
+               chromosome: str,
+               level: str,
+               column: str) -> np.ndarray:
+        key = _array_key(track, chromosome, level, column)
+        if key not in self._header["arrays"]:
+            return np.empty(0)
+        description = self._header["arrays"][key]
+        dtype = np.dtype(description["dtype"])
+        offset = description["offset"]
+        return self._buffer[
+            offset:offset + description["length"] * dtype.itemsize
+        ].view(dtype)
+
+    def best_zoom_level(self, resolution: int) -> Optional[int]:
+        """Finds the coarsest stored zoom level that is no coarser than the
+        requested resolution.
+
+        Returns:
+            Optional[int]: The bin size, or None if only the base resolution
+            intervals are fine enough.
+        """
+        suitable_levels = [
+            level for level in self.zoom_levels if level <= resolution
+        ]
+        return max(suitable_levels) if suitable_levels else None
+
+    def read_intervals(self,
+                       track: str,
+                       chromosome: str,
+                       start: int,
+                       end: int) -> BedGraph:
+        """Reads the base resolution intervals of a track overlapping a region.
+
+        Args:
+            track (str): Name of the track, e.g. "pvalue".
+            chromosome (str): Chromosome of the region.
+            start (int): Start of region.
+            end (int): End of region (included).
+
+        Returns:
+            BedGraph: The overlapping intervals, where an interval covers
+            [START, END).
+        """
+        starts = self._array(track, chromosome, "base", "START")
+        ends = self._array(track, chromosome, "base", "END")
+        # Intervals ending at start don't cover it
+        first = np.searchsorted(ends, start, side="right")
+        last = np.searchsorted(starts, end, side="right")
+        return BedGraph(
+            CHR=np.full(max(last - first, 0), chromosome, dtype=object),
+            START=np.array(starts[first:last]),
+            END=np.array(ends[first:last]),
+            SCORE=np.array(
+                self._array(track, chromosome, "base", "SCORE")[first:last])
+        )
+
+    def read_summary(self,
+                     track: str,
+                     chromosome: str,
+                     start: int,
+                     end: int,
+                     bin_size: int) -> BedGraphSummary:
+        """Reads the precomputed bin summaries of a track over a region.
+
+        Args:
+            track (str): Name of the track, e.g. "pvalue".
+            chromosome (str): Chromosome of the region.
+            start (int): Start of region.
+            end (int): End of region (included).
+            bin_size (int): One of the stored zoom levels.
+
+        Returns:
+            BedGraphSummary: Summary of every bin overlapping the region.
+        """
+        if bin_size not in self.zoom_levels:
+            raise ValueError(f"{bin_size} is not a stored zoom level. "
+                             f"Available levels are {self.zoom_levels}.")
+        summary = {
+            column: self._array(track, chromosome, bin_size, column)
+            for column in SUMMARY_COLUMNS
+        }
+        first_bin = max(start // bin_size, 0)
+        last_bin = min(end // bin_size + 1, len(summary["SUM"]))
+        bins = np.arange(first_bin, max(last_bin, first_bin))
+        return BedGraphSummary(
+            CHR=np.full(len(bins), chromosome, dtype=object),
+            START=bins * bin_size,
+            END=(bins + 1) * bin_size,
+            **{
+                column: np.array(values[first_bin:last_bin])
+                for column, values in summary.items()
+            }
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="ZoomTrack",
+        description=("Convert the tracks of a sample into a multi-resolution "
+                     "zoom track file, or query a zoom track file.")
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert_parser = subparsers.add_parser(
+        "convert",
+        help="Convert bedgraph files into a zoom track file."
+    )
+    convert_parser.add_argument("output_file")
+    for track_name in TRACK_NAMES:
+        convert_parser.add_argument(
+            f"--{track_name}",
+            help=f"The {track_name} bedgraph file."
+        )
+    convert_parser.add_argument(
+        "--zoom_levels",
+        nargs="+",
+        type=int,
+        default=list(DEFAULT_ZOOM_LEVELS),
+        help="Bin sizes to precompute summaries for."
+    )
+    summary_parser = subparsers.add_parser(
+        "summary",
+        help="Print the bin summaries of a track over a region."
+    )
+    summary_parser.add_argument("zoom_track_file")
+    summary_parser.add_argument("track", choices=TRACK_NAMES)
+    summary_parser.add_argument("chromosome")
+    summary_parser.add_argument("start", type=int)
+    summary_parser.add_argument("end", type=int)
+    summary_parser.add_argument("bin_size", type=int)
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        track_files = {
+            track_name: getattr(args, track_name)
+            for track_name in TRACK_NAMES
+            if getattr(args, track_name) is not None
+        }
+        if not track_files:
+            print("At least one track must be given to convert.")
+            sys.exit(1)
+        convert_to_zoom_track(track_files, args.output_file, args.zoom_levels)
+    else:
+        summary = ZoomTrack(args.zoom_track_file).read_summary(
+            args.track,
+            args.chromosome,
+            args.start,
+            args.end,
+            args.bin_size
+        )
+        summary.get().to_csv(sys.stdout, sep="\t", header=False, index=False)
@@ -0,0 +1,130 @@
+import argparse
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                    "Python_Scripts"))
+
+CHROMOSOME_LENGTH = 20000
+
+
+def _write_track(file_path, rng, score):
+    with open(file_path, "w") as file:
+        for chromosome in ("chr1", "chr2"):
+            position = 0
+            while position < CHROMOSOME_LENGTH:
+                length = int(rng.integers(1, 40))
+                file.write(f"{chromosome}\t{position}\t{position + length}\t"
+                           f"{score()}\n")
+                position += length
+
+
+def _write_peaks(unmerged_path, merged_path, rng):
+    unmerged_lines = []
+    merged_lines = []
+    for chromosome in ("chr1", "chr2"):
+        peaks = []
+        position = 100
+        while position < CHROMOSOME_LENGTH - 1000:
+            length = int(rng.integers(100, 400))
+            peaks.append([position, position + length])
+            position += length + int(rng.integers(20, 600))
+        for start, end in peaks:
+            unmerged_lines.append(f"{chromosome}\t{start}\t{end}")
+        # Peaks close together are merged, as MACS does with a larger gap
+        merged = [peaks[0]]
+        for start, end in peaks[1:]:
+            if start - merged[-1][1] <= 300:
+                merged[-1][1] = end
+            else:
+                merged.append([start, end])
+        for start, end in merged:
+            merged_lines.append(f"{chromosome}\t{start}\t{end}")
+    for file_path, lines in ((unmerged_path, unmerged_lines),
+                             (merged_path, merged_lines)):
+        with open(file_path, "w") as file:
+            file.write('track type=narrowPeak name="peaks"\n')
+            for line in lines:
+                file.write(f"{line}\tpeak\t10\t.\t1\t1\t1\t5\n")
+
+
+@pytest.fixture(scope="session")
+def comparison_files(tmp_path_factory):
+    """Small random samples to compare, as a ComparisonFiles."""
+    from chunked_compare import ComparisonFiles
+    directory = tmp_path_factory.mktemp("samples")
+    rng = np.random.default_rng(7)
+    files = ComparisonFiles(*(
+        os.path.join(directory, name) for name in (
+            "reference_merged.narrowPeak",
+            "reference_unmerged.narrowPeak",
+            "reference_bias.bdg",
+            "reference_coverage.bdg",
+            "comparison_bias.bdg",
+            "comparison_coverage.bdg",
+            "comparison_pvalues.bdg"
+        )
+    ))
+    _write_peaks(files.reference_unmerged_peaks,
+                 files.reference_merged_peaks,
+                 rng)
+    for file_path in files[2:]:
+        if "coverage" in file_path:
+            def score():
+                return int(rng.poisson(5))
+        elif "pvalues" in file_path:
+            def score():
+                return round(float(rng.gamma(2, 1)), 4)
+        else:
+            def score():
+                return round(float(rng.gamma(5, 1)), 4)
+        _write_track(file_path, rng, score)
+    return files
+
+
+@pytest.fixture
+def whole_region_metric():
+    """The metric of peak_compare.py without chunking or sparse mode."""
+    from peak_compare import main_whole_region
+
+    def calculate(files, chromosome, start, end, cutoff,
+                  include_merged_peaks=True):
+        return main_whole_region(argparse.Namespace(
+            chromosome=chromosome,
+            start=start,
+            end=end,
+            cutoff=cutoff,
+            significance=0.95,
+            window_size=50,
+            unmerged=not include_merged_peaks,
+            cache_directory=None,
+            output_directory=None,
+            reference_merged_peaks_file=files.reference_merged_peaks,
+            reference_unmerged_peaks_file=files.reference_unmerged_peaks,
+            reference_bias_track_file=files.reference_bias_track,
+            reference_coverage_track_file=files.reference_coverage_track,
+            comparison_bias_track_file=files.comparison_bias_track,
+            comparison_coverage_track_file=files.comparison_coverage_track,
+            comparison_pvalue_file=files.comparison_pvalues
+        ))
+    return calculate
+
+
+@pytest.fixture(scope="session")
+def bgzf_comparison_files(comparison_files, tmp_path_factory):
+    """comparison_files block gzipped, so regions are read through the
+    block index.
+    """
+    from bgzf import compress_file
+    from chunked_compare import ComparisonFiles
+    directory = tmp_path_factory.mktemp("bgzf_samples")
+    compressed_files = []
+    for file_path in comparison_files:
+        compressed_path = os.path.join(
+            directory, os.path.basename(file_path) + ".gz")
+        compress_file(file_path, compressed_path)
+        compressed_files.append(compressed_path)
+    return ComparisonFiles(*compressed_files)
@@ -0,0 +1,81 @@
+import os
+import numpy as np
+import pandas as pd
+from batch_compare import (
+    Shard,
+    merge_partials,
+    run_shard,
+    screen_shard,
+    write_partial
+)
+
+CUTOFF = 2
+
+
+def random_regions(rng, number_of_regions):
+    lengths = rng.integers(1, 3000, number_of_regions)
+    starts = rng.integers(0, 19000 - lengths)
+    return pd.DataFrame({
+        "region": np.arange(number_of_regions),
+        "chromosome": rng.choice(["chr1", "chr2"], number_of_regions),
+        "start": starts,
+        "end": starts + lengths
+    })
+
+
+def test_grouped_regions_match_each_region_on_its_own(comparison_files,
+                                                      whole_region_metric):
+    regions = random_regions(np.random.default_rng(48), 30)
+    for include_merged_peaks in (True, False):
+        expected = [
+            whole_region_metric(comparison_files, region.chromosome,
+                                region.start, region.end, CUTOFF,
+                                include_merged_peaks)
+            for region in regions.itertuples(index=False)
+        ]
+        # Small batches give each worker several groups of regions
+        for workers, batch_size in ((1, None), (2, 4)):
+            results = run_shard(regions,
+                                Shard(0, 1),
+                                comparison_files,
+                                CUTOFF,
+                                significance=0.95,
+                                window_size=50,
+                                include_merged_peaks=include_merged_peaks,
+                                workers=workers,
+                                batch_size=batch_size)
+            assert list(results["region"]) == list(regions["region"])
+            np.testing.assert_array_equal(results["metric"], expected)
+
+
+def test_screen_marks_the_refined_regions(comparison_files, tmp_path):
+    regions = random_regions(np.random.default_rng(43), 20)
+    exact = run_shard(regions, Shard(0, 1), comparison_files, CUTOFF,
+                      significance=0.95, window_size=50,
+                      include_merged_peaks=True)
+    # No threshold refines nothing, a huge tolerance refines all it can
+    for threshold, tolerance in ((None, 0), (1, 1e9)):
+        shards = [
+            screen_shard(regions, Shard(index, 2), comparison_files, CUTOFF,
+                         significance=0.95, window_size=50,
+                         include_merged_peaks=True, threshold=threshold,
+                         tolerance=tolerance)
+            for index in range(2)
+        ]
+        file_paths = []
+        for index, results in enumerate(shards):
+            file_paths.append(os.path.join(tmp_path, f"shard_{index}.tsv"))
+            write_partial(results, Shard(index, 2), file_paths[-1])
+        merged, missing_shards = merge_partials(file_paths, regions)
+        assert missing_shards == []
+        assert merged["refined"].dtype == bool
+        if threshold is None:
+            assert not merged["refined"].any()
+        else:
+            # Regions without reference peaks have no finite metric to be
+            # near the threshold
+            np.testing.assert_array_equal(
+                merged["refined"], np.isfinite(merged["approximate_metric"]))
+        np.testing.assert_array_equal(
+            merged["metric"],
+            exact["metric"].where(merged["refined"], np.nan))
@@ -0,0 +1,34 @@
+import os
+from bgzf import compress_file, fetch_region, index_path, load_index
+
+
+def write_track(tmp_path):
+    plain_path = os.path.join(tmp_path, "track.bdg")
+    with open(plain_path, "w") as file:
+        for chromosome in ("chr1", "chr2"):
+            for start in range(0, 200000, 10):
+                file.write(f"{chromosome}\t{start}\t{start + 10}\t1.5\n")
+    compressed_path = plain_path + ".gz"
+    compress_file(plain_path, compressed_path)
+    return compressed_path
+
+
+def test_index_is_written_whole(tmp_path):
+    file_path = write_track(tmp_path)
+    entries = load_index(file_path)
+    assert len(entries) > 2
+    assert not any(name.endswith(".tmp") for name in os.listdir(tmp_path))
+    assert load_index(file_path) == entries
+
+
+def test_truncated_index_is_rebuilt(tmp_path):
+    file_path = write_track(tmp_path)
+    entries = load_index(file_path)
+    with open(index_path(file_path), "r") as index_file:
+        lines = index_file.readlines()
+    for kept_lines in (lines[:len(lines) // 2], lines[:-1] + ["123\t4"]):
+        with open(index_path(file_path), "w") as index_file:
+            index_file.writelines(kept_lines)
+        assert load_index(file_path) == entries
+    lines = fetch_region(file_path, "chr2", 199980, 200000).splitlines()
+    assert lines[-1] == b"chr2\t199990\t200000\t1.5"
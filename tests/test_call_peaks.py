@@ -0,0 +1,71 @@
+import os
+from call_peaks import call_peaks, write_narrow_peak
+from IO import BedGraph
+
+# Called with a cutoff of 2 and a minimum length of 20. chr2 comes first to
+# check that peaks are sorted by chromosome name.
+TRACK = [
+    ("chr2", 0, 25, 3.0),
+    ("chr2", 25, 50, 1.0),
+    # Too short to be a peak
+    ("chr2", 50, 60, 9.0),
+    ("chr1", 0, 10, 1.0),
+    ("chr1", 10, 20, 3.0),
+    ("chr1", 20, 30, 5.0),
+    ("chr1", 30, 40, 3.0),
+    # A gap of 5, so only joined when max_gap is at least 5. On its own the
+    # last interval is too short to be a peak.
+    ("chr1", 40, 45, 1.0),
+    ("chr1", 45, 60, 4.0),
+    ("chr1", 60, 100, 1.0),
+    # Flat topped: the two intervals scoring 6 are joined into [100, 120)
+    # before the summit is chosen, which moves it from 115 (the middle of
+    # three intervals) to 110 (the earlier of two)
+    ("chr1", 100, 110, 6.0),
+    ("chr1", 110, 120, 6.0),
+    ("chr1", 120, 125, 2.5),
+    ("chr1", 125, 130, 6.0),
+    ("chr1", 130, 140, 3.0),
+    ("chr1", 140, 200, 1.0),
+    # Three separate highest intervals, the summit is in the middle one
+    ("chr1", 200, 210, 7.0),
+    ("chr1", 210, 215, 3.0),
+    ("chr1", 215, 225, 7.0),
+    ("chr1", 225, 230, 3.0),
+    ("chr1", 230, 240, 7.0),
+    ("chr1", 240, 300, 1.0),
+    # Above the cutoff as a double, but not as a single precision float
+    ("chr1", 300, 330, 2.0000001),
+    ("chr1", 330, 400, 1.0),
+]
+EXPECTED_PEAKS = {
+    10: [
+        "chr1\t10\t60\tpeaks_narrowPeak1\t50\t.\t0\t0\t0\t15",
+        "chr1\t100\t140\tpeaks_narrowPeak2\t60\t.\t0\t0\t0\t10",
+        "chr1\t200\t240\tpeaks_narrowPeak3\t70\t.\t0\t0\t0\t20",
+        "chr2\t0\t25\tpeaks_narrowPeak4\t30\t.\t0\t0\t0\t12",
+    ],
+    0: [
+        "chr1\t10\t40\tpeaks_narrowPeak1\t50\t.\t0\t0\t0\t15",
+        "chr1\t100\t140\tpeaks_narrowPeak2\t60\t.\t0\t0\t0\t10",
+        "chr1\t200\t240\tpeaks_narrowPeak3\t70\t.\t0\t0\t0\t20",
+        "chr2\t0\t25\tpeaks_narrowPeak4\t30\t.\t0\t0\t0\t12",
+    ],
+}
+
+
+def test_peaks_match_bdgpeakcall(tmp_path):
+    chromosomes, starts, ends, scores = zip(*TRACK)
+    pvalues = BedGraph(CHR=list(chromosomes),
+                       START=list(starts),
+                       END=list(ends),
+                       SCORE=list(scores))
+    peaks = call_peaks(pvalues, 2, min_length=20, max_gaps=[10, 0])
+    for max_gap, expected_lines in EXPECTED_PEAKS.items():
+        file_path = os.path.join(tmp_path, f"gap_{max_gap}.narrowPeak")
+        write_narrow_peak(peaks[max_gap], file_path, "peaks")
+        with open(file_path, "r") as file:
+            lines = file.read().splitlines()
+        assert lines[0] == ('track type=narrowPeak name="peaks" '
+                            'description="peaks" nextItemButton=on')
+        assert lines[1:] == expected_lines
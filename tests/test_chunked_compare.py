@@ -0,0 +1,35 @@
+import numpy as np
+from chunked_compare import calculate_metric_in_chunks
+
+CUTOFF = 2
+# Including regions starting at the start of a chromosome and regions
+# whose ends fall between peaks
+REGIONS = [
+    ("chr1", 0, 19999),
+    ("chr1", 250, 4321),
+    ("chr2", 5000, 5100),
+    ("chr2", 12345, 18765),
+]
+
+
+def test_chunked_metric_matches_whole_region(comparison_files,
+                                             bgzf_comparison_files,
+                                             whole_region_metric):
+    for chromosome, start, end in REGIONS:
+        for include_merged_peaks in (True, False):
+            expected = whole_region_metric(
+                comparison_files, chromosome, start, end, CUTOFF,
+                include_merged_peaks)
+            for files in (comparison_files, bgzf_comparison_files):
+                # Chunks smaller than half a window (only on the shorter
+                # regions, as they are slow), not dividing the region and
+                # larger than the region
+                chunk_sizes = [997, 100000]
+                if end - start < 5000:
+                    chunk_sizes.append(17)
+                for chunk_size in chunk_sizes:
+                    metric = calculate_metric_in_chunks(
+                        files, chromosome, start, end, CUTOFF,
+                        include_merged_peaks=include_merged_peaks,
+                        chunk_size=chunk_size)
+                    np.testing.assert_equal(metric, expected)
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+from call_peaks import group_into_peaks
+from cutoff_analysis import cutoff_analysis, get_candidate_cutoffs
+from IO import BedGraph
+
+
+def random_track(rng):
+    chromosomes, starts, ends = [], [], []
+    for chromosome in ("chr1", "chr2", "chr3")[:rng.integers(1, 4)]:
+        lengths = rng.integers(1, 40, rng.integers(1, 200))
+        # Most intervals follow on from one another, some have gaps
+        gaps = rng.integers(0, 30, len(lengths))
+        gaps[rng.random(len(lengths)) > 0.3] = 0
+        chromosome_ends = np.cumsum(lengths + gaps)
+        chromosomes.extend([chromosome] * len(lengths))
+        starts.append(chromosome_ends - lengths)
+        ends.append(chromosome_ends)
+    starts = np.concatenate(starts)
+    # Few distinct scores, so that many intervals pass at the same cutoff
+    scores = np.round(rng.exponential(3, len(starts)), 1)
+    return BedGraph(CHR=chromosomes,
+                    START=starts,
+                    END=np.concatenate(ends),
+                    SCORE=scores)
+
+
+def cutoff_analysis_per_cutoff(pvalues, min_length, max_gap, steps):
+    chromosome_codes = pd.factorize(pvalues.get("CHR"))[0]
+    starts = pvalues.get("START").to_numpy()
+    ends = pvalues.get("END").to_numpy()
+    scores = pvalues.get("SCORE").to_numpy()
+    rows = []
+    for cutoff in get_candidate_cutoffs(scores, steps)[::-1]:
+        passing = scores > cutoff
+        first_intervals, last_intervals = group_into_peaks(
+            chromosome_codes[passing], starts[passing], ends[passing],
+            max_gap)
+        lengths = ends[passing][last_intervals] - \
+            starts[passing][first_intervals]
+        lengths = lengths[lengths >= min_length]
+        if len(lengths) > 0:
+            rows.append((cutoff, len(lengths), int(lengths.sum()),
+                         lengths.sum() / len(lengths)))
+    return pd.DataFrame(
+        rows, columns=["score", "npeaks", "lpeaks", "avelpeak"])
+
+
+def test_incremental_analysis_matches_each_cutoff_on_its_own():
+    rng = np.random.default_rng(29)
+    for _ in range(200):
+        pvalues = random_track(rng)
+        min_length = int(rng.integers(1, 60))
+        max_gap = int(rng.integers(0, 40))
+        steps = int(rng.integers(5, 60))
+        pd.testing.assert_frame_equal(
+            cutoff_analysis(pvalues, min_length, max_gap, steps),
+            cutoff_analysis_per_cutoff(pvalues, min_length, max_gap, steps)
+        )
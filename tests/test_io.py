@@ -0,0 +1,32 @@
+import os
+import numpy as np
+import pytest
+from IO import BEDGRAPH_DTYPES, read_columns
+
+
+@pytest.mark.parametrize("ends_with_newline", [True, False])
+def test_parallel_parser_matches_pandas(tmp_path, ends_with_newline):
+    rng = np.random.default_rng(47)
+    lines = ['track type=bedGraph name="pvalues"']
+    for chromosome in ("chr1", "chr10", "chr2", "chrX"):
+        # Some chromosomes are short, so that blocks start and end on them
+        position = 0
+        for length in rng.integers(1, 50, rng.integers(1, 400)):
+            score = rng.choice([
+                f"{rng.gamma(2, 1):.5f}", "0", str(int(rng.integers(1, 9)))
+            ])
+            lines.append(f"{chromosome}\t{position}\t{position + length}\t"
+                         f"{score}")
+            position += length
+    file_path = os.path.join(tmp_path, "track.bdg")
+    with open(file_path, "w") as file:
+        file.write("\n".join(lines) + ("\n" if ends_with_newline else ""))
+
+    expected = read_columns(file_path, BEDGRAPH_DTYPES, 1, parser="pandas")
+    for parser, workers in (("numpy", 1), ("parallel", 1), ("parallel", 2),
+                            ("parallel", 3), ("parallel", 7)):
+        columns = read_columns(file_path, BEDGRAPH_DTYPES, 1, parser=parser,
+                               workers=workers)
+        for column, dtype in BEDGRAPH_DTYPES.items():
+            assert columns[column].dtype == dtype
+            np.testing.assert_array_equal(columns[column], expected[column])
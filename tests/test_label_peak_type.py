@@ -0,0 +1,28 @@
+import numpy as np
+from extract_region import extract_bedbase_region
+from IO import Bed, BedGraph
+from label_peak_type import convert_narrow_peak_to_bedbase
+
+# Peaks cover bases 10-19 and 30-39, with a gap of 20-29 between them
+PEAKS = Bed(CHR=["chr1", "chr1"], START=[10, 30], END=[20, 40])
+
+
+def test_bases_between_peaks_are_not_peaks():
+    peaks = convert_narrow_peak_to_bedbase(PEAKS, "chr1", 15, 35)
+    expected = np.r_[np.ones(5), np.zeros(10), np.ones(6)]
+    assert np.array_equal(peaks.get("SCORE").to_numpy(), expected)
+
+
+def test_region_can_end_outside_of_a_peak():
+    peaks = convert_narrow_peak_to_bedbase(PEAKS, "chr1", 5, 25)
+    expected = np.r_[np.zeros(5), np.ones(10), np.zeros(6)]
+    assert np.array_equal(peaks.get("SCORE").to_numpy(), expected)
+
+
+def test_base_on_a_boundary_takes_the_interval_it_starts():
+    track = BedGraph(CHR=["chr1", "chr1"],
+                     START=[0, 10],
+                     END=[10, 20],
+                     SCORE=[1.0, 2.0])
+    bedbase = extract_bedbase_region(track, "chr1", 8, 10)
+    assert np.array_equal(bedbase.get("SCORE").to_numpy(), [1.0, 1.0, 2.0])
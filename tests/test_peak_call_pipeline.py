@@ -0,0 +1,100 @@
+import os
+from checkpoints import Checkpoints
+from peak_call_pipeline import (
+    Stage,
+    compress_track,
+    output_path,
+    run_pipeline
+)
+
+TRACK = "chr1\t0\t100\t1.5\nchr1\t100\t250\t2.0\nchr2\t0\t50\t0.5\n"
+
+
+def build_stages(runs):
+    def write_track(context, log_file):
+        runs.append("track")
+        with open(output_path(context, "track.bdg"), "w") as file:
+            file.write(TRACK)
+        return {}
+
+    def summarise(context, log_file):
+        runs.append("summary")
+        with open(output_path(context, "track.bdg"), "r") as file:
+            lines = len(file.readlines())
+        with open(output_path(context, "summary.txt"), "w") as file:
+            file.write(f"{context['LABEL']}\t{lines}\n")
+        return {}
+
+    return [
+        Stage("track", (), write_track, outputs=("track.bdg",)),
+        Stage("summary", ("track",), summarise, parameters=("LABEL",),
+              outputs=("summary.txt",)),
+        compress_track("track.bdg", ("track", "summary"))
+    ]
+
+
+def run(tmp_path, label, runs):
+    context = {
+        "OUTPUT_DIRECTORY": str(tmp_path),
+        "SAMPLE_NAME": "sample",
+        "LABEL": label
+    }
+    return run_pipeline(
+        build_stages(runs),
+        context,
+        1,
+        str(tmp_path / "logs"),
+        Checkpoints(output_path(context, "checkpoints.json"))
+    )
+
+
+def test_rerun_with_compression_skips_every_stage(tmp_path):
+    runs = []
+    first = run(tmp_path, "a", runs)
+    assert [timing.status for timing in first] == ["done"] * 3
+    assert not os.path.exists(tmp_path / "sample_track.bdg")
+    assert os.path.exists(tmp_path / "sample_track.bdg.gz")
+
+    runs.clear()
+    second = run(tmp_path, "a", runs)
+    assert [timing.status for timing in second] == ["skipped"] * 3
+    assert runs == []
+
+
+def test_rerun_decompresses_files_a_changed_stage_reads(tmp_path):
+    runs = []
+    run(tmp_path, "a", runs)
+
+    runs.clear()
+    timings = run(tmp_path, "b", runs)
+    assert {timing.name: timing.status for timing in timings} == {
+        "track": "skipped",
+        "summary": "done",
+        "compress_track": "done"
+    }
+    assert runs == ["summary"]
+    with open(tmp_path / "sample_summary.txt") as file:
+        assert file.read() == "b\t3\n"
+    assert not os.path.exists(tmp_path / "sample_track.bdg")
+
+    runs.clear()
+    timings = run(tmp_path, "b", runs)
+    assert [timing.status for timing in timings] == ["skipped"] * 3
+
+
+def test_changed_compressed_copy_reruns_stages(tmp_path):
+    runs = []
+    run(tmp_path, "a", runs)
+    os.remove(tmp_path / "sample_track.bdg.gz")
+
+    runs.clear()
+    timings = run(tmp_path, "a", runs)
+    # The track is written again, but is the same as before so the summary
+    # of it is still up to date
+    assert {timing.name: timing.status for timing in timings} == {
+        "track": "done",
+        "summary": "skipped",
+        "compress_track": "done"
+    }
+    assert runs == ["track"]
+    assert not os.path.exists(tmp_path / "sample_track.bdg")
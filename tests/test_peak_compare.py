@@ -0,0 +1,25 @@
+import os
+import subprocess
+import sys
+
+PEAK_COMPARE = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)),
+    "Python_Scripts",
+    "peak_compare.py"
+)
+
+
+def test_stored_metric_is_reported_the_same(comparison_files, tmp_path):
+    store_path = os.path.join(tmp_path, "results.db")
+    # Merged peaks aren't counted, so the metric is over 1 and the sample
+    # order warning is printed
+    command = [sys.executable, PEAK_COMPARE, "--unmerged",
+               "--store", store_path, "chr1", "250", "4321",
+               *comparison_files, "2"]
+    outputs = [
+        subprocess.run(command, capture_output=True, text=True,
+                       check=True).stdout
+        for _ in range(2)
+    ]
+    assert "consider switching the order" in outputs[0]
+    assert outputs[1] == outputs[0]
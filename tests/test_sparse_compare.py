@@ -0,0 +1,27 @@
+import numpy as np
+from sparse_compare import calculate_metric_sparse
+
+CUTOFF = 2
+# Including regions starting at the start of a chromosome and regions
+# whose ends fall between peaks
+REGIONS = [
+    ("chr1", 0, 19999),
+    ("chr1", 250, 4321),
+    ("chr2", 5000, 5100),
+    ("chr2", 12345, 18765),
+]
+
+
+def test_sparse_metric_matches_whole_region(comparison_files,
+                                            bgzf_comparison_files,
+                                            whole_region_metric):
+    for chromosome, start, end in REGIONS:
+        for include_merged_peaks in (True, False):
+            expected = whole_region_metric(
+                comparison_files, chromosome, start, end, CUTOFF,
+                include_merged_peaks)
+            for files in (comparison_files, bgzf_comparison_files):
+                metric = calculate_metric_sparse(
+                    files, chromosome, start, end, CUTOFF,
+                    include_merged_peaks=include_merged_peaks)
+                np.testing.assert_equal(metric, expected)
@@ -0,0 +1,16 @@
+import os
+import numpy as np
+from zoom_track import ZoomTrack, convert_to_zoom_track
+
+
+def test_intervals_ending_at_the_start_are_not_read(tmp_path):
+    track_path = os.path.join(tmp_path, "pvalue.bdg")
+    with open(track_path, "w") as file:
+        file.write("chr1\t0\t100\t1.0\nchr1\t100\t200\t2.0\n"
+                   "chr1\t200\t300\t3.0\n")
+    zoom_path = os.path.join(tmp_path, "sample.zoom")
+    convert_to_zoom_track({"pvalue": track_path}, zoom_path, [100])
+    intervals = ZoomTrack(zoom_path).read_intervals(
+        "pvalue", "chr1", 100, 200)
+    assert np.array_equal(intervals.get("START"), [100, 200])
+    assert np.array_equal(intervals.get("SCORE"), [2.0, 3.0])